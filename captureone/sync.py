@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Synchronize the files scanned by RoboScan to a local folder.
+Only the new files are transferred: the scanner is asked for its change feed
+(long polling), then rsync is run on the new files only.
+
+Usage: python3 sync.py [destination]
+"""
+
+import argparse
+import hashlib
+import json
+import pathlib
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+CURSOR_FILE = ".roboscan_cursor"
+WAIT_TIME = 30          # seconds, long polling
+RETRY_TIME = 10         # seconds, when the scanner is not reachable or the transfer failed
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class ChecksumMismatch(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def fetch_changes(host: str, since: int) -> dict:
+    query = urllib.parse.urlencode({"since": since, "wait": WAIT_TIME})
+    url = f"http://{host}/scanner/files/changes/?{query}"
+    with urllib.request.urlopen(url, timeout=WAIT_TIME + 10) as response:
+        return json.load(response)
+
+
+def transfer(host: str, files: list, destination: pathlib.Path) -> None:
+    file_list = "\n".join(f["name"] for f in files) + "\n"
+    subprocess.run(["rsync", "-a", "--ignore-missing-args", "--files-from=-",
+                    f"rsync://{host}/share/", str(destination)],
+                   input=file_list.encode("utf-8"), check=True)
+
+
+def verify(files: list, destination: pathlib.Path) -> None:
+    """
+    :raises ChecksumMismatch: Some files are corrupted, they are removed to be transferred again
+    """
+    corrupted = []
+    for f in files:
+        local_file = destination / f["name"]
+        if not local_file.exists():
+            # Probably already archived on the scanner
+            print(f"Missing: {f['name']}", file=sys.stderr)
+            continue
+
+        h = hashlib.sha256()
+        with open(local_file, "rb") as content:
+            for chunk in iter(lambda: content.read(HASH_CHUNK_SIZE), b""):
+                h.update(chunk)
+        if h.hexdigest() != f["sha256"]:
+            local_file.unlink()
+            corrupted.append(f["name"])
+
+    if corrupted:
+        raise ChecksumMismatch(f"Checksum mismatch: {', '.join(corrupted)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Synchronize the files scanned by RoboScan")
+    parser.add_argument("destination", nargs="?", default=".", help="Target folder")
+    parser.add_argument("--host", default="piscanner", help="Hostname of the scanner")
+    parser.add_argument("--verify", action="store_true", help="Check the SHA-256 of the transferred files")
+    args = parser.parse_args()
+
+    destination = pathlib.Path(args.destination)
+    cursor_file = destination / CURSOR_FILE
+    cursor = int(cursor_file.read_text()) if cursor_file.exists() else 0
+
+    print(f"Synchronization started from {args.host} to {destination}, cursor {cursor}")
+
+    while True:
+        try:
+            changes = fetch_changes(args.host, cursor)
+        except (urllib.error.URLError, OSError) as e:
+            print(f"Scanner not reachable: {e}", file=sys.stderr)
+            time.sleep(RETRY_TIME)
+            continue
+
+        files = changes["files"]
+        if files:
+            try:
+                transfer(args.host, files, destination)
+                if args.verify:
+                    verify(files, destination)
+            except subprocess.CalledProcessError as e:
+                # Same changes again, from the same cursor
+                print(f"Transfer failed: {e}", file=sys.stderr)
+                time.sleep(RETRY_TIME)
+                continue
+            except ChecksumMismatch as e:
+                print(e.message, file=sys.stderr)
+                time.sleep(RETRY_TIME)
+                continue
+            print(f"Synchronized {len(files)} files")
+
+        cursor = changes["cursor"]
+        cursor_file.write_text(str(cursor))
+
+
+if __name__ == "__main__":
+    main()
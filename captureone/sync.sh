@@ -6,13 +6,5 @@ else
 	DEST="."
 fi
 
-RSYNC_SRC="rsync://piscanner/share"
-SLEEP_TIME=10
-
-echo "Synchronization started from $RSYNC_SRC to $DEST every ${SLEEP_TIME}s"
-
-while [ : ]
-do
-    rsync -aP "$RSYNC_SRC" "$DEST"
-    sleep $SLEEP_TIME
-done
+# Only the new files are transferred, as soon as they are available
+python3 "$(dirname "$0")/sync.py" "$DEST"
@@ -1,29 +1,330 @@
+"""
+Archive of the scanned photos.
+Archive operations are jobs processed in the background, one after the other:
+files are renamed when the archive is on the same file system, otherwise they
+are copied, verified and synced in batches, in parallel.
+The search of the duplicate files, and their replacement by hard links, are jobs
+too: they read the whole share and archive.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 import logging
 import pathlib
-import shutil
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from dataclasses_json import dataclass_json
+
+from scanner import dedupe, file_index, file_transfer, manifest
 
 log = logging.getLogger(__name__)
 
+OPERATION_MOVE = "move"
+OPERATION_DELETE = "delete"
+OPERATION_FIND_DUPLICATES = "find_duplicates"
+OPERATION_LINK_DUPLICATES = "link_duplicates"
+
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+
+COPY_WORKERS = 4
+MAX_FINISHED_JOBS = 20
+PROGRESS_INTERVAL = 0.5     # seconds
+
+
+@dataclass_json
+@dataclass
+class ArchiveJob:
+    id: int
+    operation: str
+    session: Optional[int] = None
+    roll_id: Optional[str] = None
+    status: str = STATUS_PENDING
+    total: int = 0
+    processed: int = 0
+    failed: int = 0
+    created_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    # Duplicate files, once the search is finished
+    duplicates: Optional[dedupe.DuplicateReport] = None
+
+
+class ArchiveJobDoesNotExist(Exception):
+    def __init__(self, message):
+        self.message = message
+
 
 class Archive:
-    __slots__ = ['archive_path', 'photos_path', ]
+    __slots__ = ['archive_path', 'photos_path', 'active_folders', '_callback', '_jobs', '_cancelled',
+                 '_next_id', '_lock', '_changed', '_thread', '_executor', ]
 
     def __init__(self) -> None:
         self.archive_path = pathlib.Path(".")
         self.photos_path = pathlib.Path(".")
+        # Destination folders of the sessions, kept even if empty
+        self.active_folders: Callable[[], Iterable[pathlib.Path]] = lambda: []
+        self._callback: Callable[[str, Any], None] = lambda subject, data: None
+        self._jobs: Dict[int, ArchiveJob] = {}
+        self._cancelled: Dict[int, threading.Event] = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def start(self, callback: Callable[[str, Any], None]) -> None:
+        with self._lock:
+            self._callback = callback
+            if self._thread is None:
+                self._executor = ThreadPoolExecutor(max_workers=COPY_WORKERS, thread_name_prefix="archive")
+                self._thread = threading.Thread(target=self._process, daemon=True)
+                self._thread.start()
+
+    def move_to_archive(self, session: Optional[int] = None, roll_id: Optional[str] = None) -> ArchiveJob:
+        return self._submit(OPERATION_MOVE, session, roll_id)
+
+    def delete_archive(self, session: Optional[int] = None, roll_id: Optional[str] = None) -> ArchiveJob:
+        return self._submit(OPERATION_DELETE, session, roll_id)
+
+    def find_duplicates(self) -> ArchiveJob:
+        return self._submit(OPERATION_FIND_DUPLICATES, None, None)
+
+    def link_duplicates(self) -> ArchiveJob:
+        return self._submit(OPERATION_LINK_DUPLICATES, None, None)
+
+    def cancel(self, job_id: int) -> None:
+        """
+        Cancel the job. Files already processed stay where they are.
+        """
+        with self._lock:
+            self._find(job_id)
+            self._cancelled[job_id].set()
+
+    def get_job(self, job_id: int) -> ArchiveJob:
+        with self._lock:
+            return self._find(job_id)
+
+    def list_jobs(self) -> List[ArchiveJob]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _submit(self, operation: str, session: Optional[int], roll_id: Optional[str]) -> ArchiveJob:
+        # The total is known once the worker lists the files: never walk the folders in the request
+        with self._lock:
+            job = ArchiveJob(id=self._next_id, operation=operation, session=session, roll_id=roll_id,
+                             created_at=time.time())
+            self._next_id += 1
+            self._jobs[job.id] = job
+            self._cancelled[job.id] = threading.Event()
+            self._forget_finished_jobs()
+            self._changed.notify_all()
+
+        self._notify(job)
+        return job
+
+    def _process(self) -> None:
+        while True:
+            with self._lock:
+                job = self._next_pending()
+                while job is None:
+                    self._changed.wait()
+                    job = self._next_pending()
+                job.status = STATUS_RUNNING
+                cancelled = self._cancelled[job.id]
+
+            log.info("Archive job %s started: %s", job.id, job.operation)
+            self._notify(job)
+
+            try:
+                if job.operation == OPERATION_MOVE:
+                    self._move_files(job, cancelled)
+                    _remove_empty_folders(self.photos_path, self.active_folders())
+                elif job.operation == OPERATION_DELETE:
+                    self._delete_files(job, cancelled)
+                    _remove_empty_folders(self.archive_path, self.active_folders())
+                else:
+                    self._dedupe_files(job, cancelled)
+                status, error = (STATUS_CANCELLED if cancelled.is_set() else STATUS_DONE), None
+            except Exception as e:
+                log.exception("Archive job %s failed", job.id)
+                status, error = STATUS_FAILED, str(e)
+
+            with self._lock:
+                job.status = status
+                job.error = error
+                job.finished_at = time.time()
+
+            log.info("Archive job %s finished: %s, %s/%s files", job.id, status, job.processed, job.total)
+            self._notify(job)
+
+    def _move_files(self, job: ArchiveJob, cancelled: threading.Event) -> None:
+        files = self._select_files(self.photos_path, job.session, job.roll_id)
+        job.total = len(files)
+        self._notify(job)
+        self.archive_path.mkdir(parents=True, exist_ok=True)
+
+        with file_transfer.SyncBatch() as batch:
+            def process(f: pathlib.Path) -> None:
+                file_transfer.move_file(f, self._archive_destination(f), file_transfer.VERIFY_HASH, batch)
+
+            # Renames are cheap: no need for parallelism
+            parallel = not _is_same_file_system(self.photos_path, self.archive_path)
+            self._run(job, files, process, cancelled, parallel=parallel, batch=batch)
+
+    def _delete_files(self, job: ArchiveJob, cancelled: threading.Event) -> None:
+        files = self._select_files(self.archive_path, job.session, job.roll_id)
+        job.total = len(files)
+        self._notify(job)
+        self._run(job, files, lambda f: f.unlink(), cancelled, parallel=False)
+
+    def _dedupe_files(self, job: ArchiveJob, cancelled: threading.Event) -> None:
+        roots = {
+            file_index.LOCATION_SHARE: self.photos_path,
+            file_index.LOCATION_ARCHIVE: self.archive_path,
+        }
+        last_progress = time.monotonic()
+
+        def progress(processed: int, total: int) -> None:
+            nonlocal last_progress
+            job.processed = processed
+            job.total = total
+            now = time.monotonic()
+            if now - last_progress >= PROGRESS_INTERVAL:
+                last_progress = now
+                self._notify(job)
+
+        if job.operation == OPERATION_LINK_DUPLICATES:
+            job.duplicates = dedupe.link_duplicates(roots, progress, cancelled)
+        else:
+            job.duplicates = dedupe.find_duplicates(roots, progress, cancelled)
+
+    def _run(self, job: ArchiveJob, files: List[pathlib.Path], process: Callable[[pathlib.Path], None],
+             cancelled: threading.Event, parallel: bool, batch: Optional[file_transfer.SyncBatch] = None) -> None:
+        """
+        :param batch: Files moved by the processing: they're only done once synced
+        """
+        last_progress = time.monotonic()
+
+        def process_file(f: pathlib.Path) -> Optional[bool]:
+            if cancelled.is_set():
+                return None
+            try:
+                process(f)
+                return True
+            except Exception:
+                log.exception("Unable to %s file %s", job.operation, f)
+                return False
+
+        # Files processed since the last index update
+        done: List[pathlib.Path] = []
+
+        def take_synced() -> None:
+            if batch is not None:
+                moved, failed = batch.take_results()
+                done.extend(moved)
+                job.failed += len(failed)
+
+        results = self._executor.map(process_file, files) if parallel else map(process_file, files)
+        for f, success in zip(files, results):
+            if success is None:
+                # Cancelled
+                continue
+            job.processed += 1
+            if not success:
+                job.failed += 1
+            elif batch is None:
+                done.append(f)
+            take_synced()
+            now = time.monotonic()
+            if now - last_progress >= PROGRESS_INTERVAL:
+                last_progress = now
+                self._update_index(job, done)
+                done = []
+                self._notify(job)
+
+        if batch is not None:
+            batch.flush()
+            take_synced()
+        self._update_index(job, done)
+
+    def _update_index(self, job: ArchiveJob, files: List[pathlib.Path]) -> None:
+        index = file_index.get_file_index()
+        if index is None or not files:
+            return
+
+        if job.operation == OPERATION_MOVE:
+            names = [f.relative_to(self.photos_path).as_posix() for f in files]
+            index.move(file_index.LOCATION_SHARE, file_index.LOCATION_ARCHIVE, names)
+        else:
+            names = [f.relative_to(self.archive_path).as_posix() for f in files]
+            index.remove(file_index.LOCATION_ARCHIVE, names)
+
+    def _select_files(self, root: pathlib.Path, session: Optional[int],
+                      roll_id: Optional[str]) -> List[pathlib.Path]:
+        if session is None and roll_id is None:
+            return list(_list_files(root))
+
+        # The manifest knows which files belong to the session or the roll
+        the_manifest = manifest.get_manifest()
+        if the_manifest is None:
+            return []
+        files = (root / e.name for e in the_manifest.find(session, roll_id))
+        return [f for f in files if f.is_file()]
+
+    def _archive_destination(self, f: pathlib.Path) -> pathlib.Path:
+        # Per-roll folders are kept in the archive
+        return self.archive_path / f.relative_to(self.photos_path)
+
+    def _next_pending(self) -> Optional[ArchiveJob]:
+        return next((j for j in self._jobs.values() if j.status == STATUS_PENDING), None)
+
+    def _find(self, job_id: int) -> ArchiveJob:
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise ArchiveJobDoesNotExist(f"Archive job not found: {job_id}")
+        return job
+
+    def _forget_finished_jobs(self) -> None:
+        finished = [j.id for j in self._jobs.values()
+                    if j.status in (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED)]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+            del self._cancelled[job_id]
+
+    def _notify(self, job: ArchiveJob) -> None:
+        data = job.to_dict()
+        # Can be large: read with the job
+        del data["duplicates"]
+        self._callback("archive", data)
+
+
+def _is_same_file_system(path1: pathlib.Path, path2: pathlib.Path) -> bool:
+    return path1.stat().st_dev == path2.stat().st_dev
+
 
-    def move_to_archive(self) -> int:
-        count = 0
+def _list_files(root: pathlib.Path) -> Iterable[pathlib.Path]:
+    for f in root.glob('*.*'):
+        if f.is_file():
+            yield f
 
-        for f in self.photos_path.glob('*.*'):
-            shutil.move(str(f), str(self.archive_path / f.name))
-            count += 1
-        return count
+    for folder in root.iterdir():
+        if folder.is_dir():
+            yield from _list_files(folder)
 
-    def delete_archive(self) -> int:
-        count = 0
 
-        for f in self.archive_path.glob('*.*'):
-            f.unlink()
-            count += 1
-        return count
+def _remove_empty_folders(root: pathlib.Path, kept_folders: Iterable[pathlib.Path]) -> None:
+    kept = {f.resolve() for f in kept_folders}
+    for folder in sorted((d for d in root.glob('**/*') if d.is_dir()), reverse=True):
+        if folder.resolve() in kept:
+            continue
+        try:
+            folder.rmdir()
+        except OSError:
+            # Not empty
+            pass
@@ -0,0 +1,159 @@
+"""
+Automatic calibration of the camera exposure, before scanning a roll.
+The backlit film base is the brightest part of the preview: the exposure is
+searched so that it's bright, without clipping any channel.
+"""
+
+from dataclasses import dataclass
+import fractions
+import logging
+import time
+from typing import Callable, List, Optional
+
+from dataclasses_json import dataclass_json
+import numpy as np
+from PIL import Image
+
+from scanner.hardware import camera
+
+log = logging.getLogger(__name__)
+
+PARAMETER_SHUTTER_SPEED = "shutter_speed"
+PARAMETER_EXPOSURE_COMPENSATION = "exposure_compensation"
+
+# Level of the film base, on a 0-255 scale
+TARGET_LEVEL = 230
+TOLERANCE = 8
+# Percentile of the pixels considered as the film base
+FILM_BASE_PERCENTILE = 99.5
+# The preview takes a frame to show the new exposure
+SETTLE_PREVIEWS = 1
+
+
+@dataclass_json
+@dataclass
+class CalibrationResult:
+    iso: Optional[str]
+    shutter_speed: Optional[str]
+    aperture: Optional[str]
+    exposure_compensation: Optional[str]
+    level: float
+    preview_count: int
+    duration: float
+
+
+class CalibrationError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class CalibrationDoesNotExist(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def film_base_level(image: Image.Image) -> float:
+    """
+    Level of the brightest pixels, on the channel closest to clipping
+    """
+    pixels = np.asarray(image.convert('RGB'), dtype=np.uint8).reshape(-1, 3)
+    level = 0.0
+    for channel in range(3):
+        histogram = np.bincount(pixels[:, channel], minlength=256)
+        cumulated = np.cumsum(histogram)
+        threshold = cumulated[-1] * FILM_BASE_PERCENTILE / 100.0
+        level = max(level, float(np.searchsorted(cumulated, threshold)))
+    return level
+
+
+def calibrate(the_camera: camera.Camera, parameter: str = PARAMETER_SHUTTER_SPEED) -> CalibrationResult:
+    """
+    Binary search of the setting which brings the film base to the target level.
+    Settings are sorted from the darkest to the brightest exposure.
+    """
+    start_time = time.monotonic()
+
+    if parameter == PARAMETER_SHUTTER_SPEED:
+        choices = _sorted_choices(the_camera.accepted_shutter_speed, _shutter_speed_seconds)
+    elif parameter == PARAMETER_EXPOSURE_COMPENSATION:
+        choices = _sorted_choices(the_camera.accepted_exposure_compensation, _exposure_compensation_ev)
+    else:
+        raise CalibrationError(f"Unsupported calibration parameter: {parameter}")
+    if not choices:
+        raise CalibrationError(f"No value available for {parameter}")
+
+    initial_value = getattr(the_camera, parameter)
+    preview_count = 0
+
+    def measure(index: int) -> float:
+        nonlocal preview_count
+        setattr(the_camera, parameter, choices[index])
+        for _ in range(SETTLE_PREVIEWS):
+            the_camera.capture_preview()
+        level = film_base_level(the_camera.capture_preview())
+        preview_count += SETTLE_PREVIEWS + 1
+        log.info("Calibration: %s %s => level %s", parameter, choices[index], level)
+        return level
+
+    try:
+        low, high = 0, len(choices) - 1
+        best_index, best_level = None, None
+        while low <= high:
+            middle = (low + high) // 2
+            level = measure(middle)
+            if _is_better(level, best_level):
+                best_index, best_level = middle, level
+
+            if abs(level - TARGET_LEVEL) <= TOLERANCE:
+                break
+            if level < TARGET_LEVEL:
+                low = middle + 1
+            else:
+                high = middle - 1
+    finally:
+        # The result is applied afterwards, with the other settings
+        setattr(the_camera, parameter, initial_value)
+
+    result = CalibrationResult(
+        iso=the_camera.iso,
+        shutter_speed=the_camera.shutter_speed,
+        aperture=the_camera.aperture,
+        exposure_compensation=the_camera.exposure_compensation,
+        level=best_level,
+        preview_count=preview_count,
+        duration=time.monotonic() - start_time,
+    )
+    setattr(result, parameter, choices[best_index])
+    log.info("Calibration done: %s", result)
+    return result
+
+
+def _is_better(level: float, best_level: Optional[float]) -> bool:
+    # Clipping the film base is worse than underexposing it
+    if best_level is None:
+        return True
+    is_clipped = level > TARGET_LEVEL + TOLERANCE
+    is_best_clipped = best_level > TARGET_LEVEL + TOLERANCE
+    if is_clipped != is_best_clipped:
+        return not is_clipped
+    return level < best_level if is_clipped else level > best_level
+
+
+def _sorted_choices(choices: List[str], key: Callable[[str], Optional[float]]) -> List[str]:
+    # Values which aren't exposures (bulb, auto...) are ignored
+    values = [(key(c), c) for c in choices]
+    return [c for k, c in sorted((v for v in values if v[0] is not None), key=lambda v: v[0])]
+
+
+def _shutter_speed_seconds(value: str) -> Optional[float]:
+    try:
+        return float(fractions.Fraction(value.strip().rstrip('s')))
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def _exposure_compensation_ev(value: str) -> Optional[float]:
+    try:
+        return float(value)
+    except ValueError:
+        return None
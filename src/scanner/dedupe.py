@@ -0,0 +1,250 @@
+"""
+Duplicate files of the share and the archive, such as the frames of a roll scanned twice.
+Files are grouped by size first: only the files sharing their size with another one
+are read. The first block is hashed before the whole file, so that RAW files of the
+same size are told apart cheaply.
+Duplicates on the same file system can be replaced by hard links to reclaim space.
+On an SD card, reading the files takes minutes: the search reports its progress and
+can be cancelled, the groups found so far are kept.
+"""
+
+from dataclasses import dataclass, field
+import hashlib
+import logging
+import os
+import pathlib
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from dataclasses_json import dataclass_json
+
+from scanner import manifest
+
+log = logging.getLogger(__name__)
+
+PARTIAL_HASH_SIZE = 64 * 1024
+# Files being written
+IGNORED_SUFFIXES = {".tmp"}
+
+
+@dataclass_json
+@dataclass(frozen=True)
+class DuplicateFile:
+    location: str
+    name: str   # Relative to the location
+
+
+@dataclass_json
+@dataclass
+class DuplicateGroup:
+    size: int
+    content_hash: str
+    files: List[DuplicateFile]
+    # Space used by the copies which aren't hard links of the first file
+    reclaimable_bytes: int = 0
+
+
+@dataclass_json
+@dataclass
+class DuplicateReport:
+    groups: List[DuplicateGroup] = field(default_factory=list)
+    files_scanned: int = 0
+    files_hashed: int = 0
+    reclaimable_bytes: int = 0
+    reclaimed_bytes: int = 0
+    elapsed_seconds: float = 0.0
+
+
+# (location, path, stat)
+_Candidate = Tuple[str, pathlib.Path, os.stat_result]
+# Called with the number of files read, and the number of files to read known so far
+ProgressCallback = Optional[Callable[[int, int], None]]
+
+
+class _Progress:
+    __slots__ = ['processed', 'total', '_callback', '_cancelled', ]
+
+    def __init__(self, callback: ProgressCallback, cancelled: Optional[threading.Event]) -> None:
+        self.processed = 0
+        self.total = 0
+        self._callback = callback
+        self._cancelled = cancelled
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._cancelled is not None and self._cancelled.is_set()
+
+    def expect(self, count: int) -> None:
+        self.total += count
+        self._report()
+
+    def advance(self) -> None:
+        self.processed += 1
+        self._report()
+
+    def _report(self) -> None:
+        if self._callback is not None:
+            self._callback(self.processed, self.total)
+
+
+def _list_files(roots: Dict[str, pathlib.Path]) -> Iterable[_Candidate]:
+    for location, root in roots.items():
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                file = pathlib.Path(dirpath) / filename
+                if file.suffix.lower() in IGNORED_SUFFIXES:
+                    continue
+                try:
+                    stat = file.stat()
+                except OSError:
+                    # Moved in the meantime
+                    continue
+                if stat.st_size > 0:
+                    yield location, file, stat
+
+
+def _partial_hash(file: pathlib.Path) -> str:
+    with open(file, 'rb') as f:
+        return hashlib.sha256(f.read(PARTIAL_HASH_SIZE)).hexdigest()
+
+
+def _regroup(groups: List[List[_Candidate]], key: Callable[[_Candidate], str],
+             progress: _Progress) -> Tuple[Dict[str, List[_Candidate]], int]:
+    """
+    Split each group by the key of its files, keeping the groups of several files
+
+    :returns: The groups by key, and the number of files read
+    """
+    result = {}
+    count = 0
+    progress.expect(sum(len(g) for g in groups))
+    for group in groups:
+        if progress.is_cancelled:
+            break
+        by_key: Dict[str, List[_Candidate]] = {}
+        for candidate in group:
+            try:
+                k = key(candidate)
+            except OSError:
+                continue
+            finally:
+                progress.advance()
+            count += 1
+            by_key.setdefault(k, []).append(candidate)
+        result.update((k, g) for k, g in by_key.items() if len(g) > 1)
+    return result, count
+
+
+def find_duplicates(roots: Dict[str, pathlib.Path], progress: ProgressCallback = None,
+                    cancelled: Optional[threading.Event] = None) -> DuplicateReport:
+    """
+    :param progress: Called after each file read
+    :param cancelled: Stops the search, the groups found so far are returned
+    """
+    return _find_duplicates(roots, _Progress(progress, cancelled))
+
+
+def _find_duplicates(roots: Dict[str, pathlib.Path], progress: _Progress) -> DuplicateReport:
+    start_time = time.perf_counter()
+    report = DuplicateReport()
+
+    by_size: Dict[int, List[_Candidate]] = {}
+    for candidate in _list_files(roots):
+        if progress.is_cancelled:
+            break
+        report.files_scanned += 1
+        by_size.setdefault(candidate[2].st_size, []).append(candidate)
+
+    # Hard links of the same file are a single candidate
+    same_size = []
+    for group in by_size.values():
+        inodes = {}
+        for candidate in group:
+            inodes.setdefault((candidate[2].st_dev, candidate[2].st_ino), candidate)
+        if len(inodes) > 1:
+            same_size.append(group)
+
+    # The size is part of the key: files of different sizes never end up together
+    same_start, _ = _regroup(same_size, lambda c: f"{c[2].st_size}:{_partial_hash(c[1])}", progress)
+    same_content, report.files_hashed = _regroup(
+        list(same_start.values()), lambda c: manifest.hash_file(c[1]), progress)
+
+    for content_hash, group in same_content.items():
+        group.sort(key=lambda c: (c[0], str(c[1])))
+        size = group[0][2].st_size
+        inodes = {(c[2].st_dev, c[2].st_ino) for c in group}
+        if len(inodes) == 1:
+            # Only hard links
+            continue
+        duplicate = DuplicateGroup(
+            size=size,
+            content_hash=content_hash,
+            files=[DuplicateFile(location, path.relative_to(roots[location]).as_posix())
+                   for location, path, _ in group],
+            reclaimable_bytes=size * (len(inodes) - 1))
+        report.groups.append(duplicate)
+        report.reclaimable_bytes += duplicate.reclaimable_bytes
+
+    report.elapsed_seconds = time.perf_counter() - start_time
+    log.info("%s duplicate groups found in %.1fs, %s files hashed out of %s, %s bytes reclaimable",
+             len(report.groups), report.elapsed_seconds, report.files_hashed, report.files_scanned,
+             report.reclaimable_bytes)
+    return report
+
+
+def link_duplicates(roots: Dict[str, pathlib.Path], progress: ProgressCallback = None,
+                    cancelled: Optional[threading.Event] = None) -> DuplicateReport:
+    """
+    Replace the duplicates by hard links to the first file of their group, on the same file system
+
+    :param progress: Called after each file read, the copies are read again before being replaced
+    :param cancelled: Stops the search or the links, the files already replaced stay hard links
+    """
+    tracker = _Progress(progress, cancelled)
+    report = _find_duplicates(roots, tracker)
+    tracker.expect(sum(len(g.files) - 1 for g in report.groups))
+
+    for group in report.groups:
+        if tracker.is_cancelled:
+            break
+        kept = roots[group.files[0].location] / group.files[0].name
+        try:
+            kept_stat = kept.stat()
+        except OSError:
+            log.warning("File not found: %s", kept)
+            for _ in group.files[1:]:
+                tracker.advance()
+            continue
+
+        for f in group.files[1:]:
+            if tracker.is_cancelled:
+                break
+            tracker.advance()
+            file = roots[f.location] / f.name
+            try:
+                stat = file.stat()
+                if stat.st_dev != kept_stat.st_dev or stat.st_ino == kept_stat.st_ino:
+                    continue
+                # Still the same content: it may have changed since the report
+                if stat.st_size != group.size or manifest.hash_file(file) != group.content_hash:
+                    continue
+
+                # Replaced atomically: the name never disappears
+                tmp_file = file.with_name(file.name + ".tmp")
+                os.link(kept, tmp_file)
+                try:
+                    os.replace(tmp_file, file)
+                except OSError:
+                    tmp_file.unlink(missing_ok=True)
+                    raise
+            except OSError:
+                log.exception("Unable to link %s to %s", file, kept)
+                continue
+
+            group.reclaimable_bytes -= group.size
+            report.reclaimable_bytes -= group.size
+            report.reclaimed_bytes += group.size
+
+    log.info("%s bytes reclaimed with hard links", report.reclaimed_bytes)
+    return report
@@ -2,22 +2,19 @@ from datetime import datetime
 import logging
 import pathlib
 import time
-from typing import Generator, Optional, Tuple
+from typing import Generator, List, Optional, Tuple
 
 import numpy as np
 
-from scanner.object_detection import ObjectDetection
+from scanner import model_registry, resources, trace
+from scanner.object_detection import Detector, ObjectDetection
+from scanner.quality import FAILURE_CROP, QualityGate, QualityScores
 
-from .scanner_device import BacklightedScanner, PhotoInfo
+from .scanner_device import BacklightedScanner, CanSeekFrames, PhotoInfo
 from .hardware import stepper_motor, camera
 
 log = logging.getLogger(__name__)
 
-MODEL_PATH = "object_detection_model"
-MODEL_FILE = "model.tflite"
-MODEL_FILE_TPU = "model_edgetpu.tflite"
-LABELS_FILE = "dict.txt"
-
 LABEL_HOLE = "hole"
 LABEL_PARTIAL_PHOTO = "partial_photo"
 LABEL_SEPARATOR = "separator"
@@ -41,48 +38,100 @@ SLEEP_TIME = 0.001
 DIRECTION = -1
 NORMAL_STEPS = 3
 LARGE_STEPS = 90
+# Seeking stops before the frame, the detector does the final alignment
+SEEK_MARGIN = 5 * NORMAL_STEPS
+MAX_ALIGNMENT_MOVES = 10
+# Then the photo is taken anyway
+MAX_QUALITY_RETRIES = 3
+
+
+def interpret_detections(detections: List[Tuple[str, np.array, float]]) -> Tuple[bool, bool, Optional[Tuple[float, float, float, float]]]:
+    num_holes = 0
+    photo_coverage = 0.0
+    best_bounding_box = None
+    has_left_side_separator = False
+
+    for d in detections:
+        label = d[0]
+        bounding_box = d[1]
+        confidence = d[2]
+
+        y1, x1, y2, x2 = np.float_(bounding_box).tolist()
+        min_x = min(x1, x2)
+        max_x = max(x1, x2)
+        min_y = min(y1, y2)
+        max_y = max(y1, y2)
+
+        if confidence < MIN_CONFIDENCE:
+            continue
+
+        if label == LABEL_HOLE:
+            num_holes += 1
+        elif label == LABEL_PHOTO or label == LABEL_PARTIAL_PHOTO:
+            # Check if there's a margin
+            if min_x >= MIN_X_MARGIN and max_x <= 1.0 - MIN_X_MARGIN \
+               and min_y >= MIN_Y_MARGIN and max_y <= 1.0 - MIN_Y_MARGIN \
+               and min_x <= LEFT_SIDE:
+
+                current_photo_coverage = (x2 - x1) * (y2 - y1)
+                if current_photo_coverage > photo_coverage:
+                    photo_coverage = current_photo_coverage
+                    best_bounding_box = (x1, y1, x2, y2)
+                    log.debug("Found photo: %s", bounding_box)
+            else:
+                log.debug("Excluded due to margin: %s", bounding_box)
+        elif label == LABEL_SEPARATOR:
+            # Check if the separator is tall and on the left sid
+            if max_x <= LEFT_SIDE and min_y <=0.20 and  max_y >= 0.80 and min_y >= 0.01 and max_y <= 0.99:
+                log.debug("Found left-side separator: %s", bounding_box)
 
-def _get_model_path() -> pathlib.Path:
-    base_dir = pathlib.Path(__file__).parent.absolute()
-    model_path = base_dir / MODEL_PATH
-    if not model_path.exists():
-        raise FileNotFoundError(f"Model path does not exist: {model_path}")
-    return model_path
+    has_holes = num_holes >= MIN_NUMBER_OF_HOLES
 
+    # Determine if there is a well-frame photo
+    # Option 1: photo detected by the model, aligned on the left
+    has_photo = photo_coverage >= MIN_COVERAGE
+    if not has_photo:
+        # Option 2: there is a tall separator on the left, with many holes
+        has_photo = num_holes >= 16 and has_left_side_separator
 
-def _get_model_files(use_edge_tpu: bool) -> Tuple[pathlib.Path, pathlib.Path]:
-    model_path = _get_model_path()
-    model_filename = MODEL_FILE_TPU if use_edge_tpu else MODEL_FILE
+    log.debug("Detection: %s, %s, %s, %s, %s", len(detections), num_holes, photo_coverage, has_left_side_separator, has_photo)
 
-    model_file = model_path / model_filename
-    labels_file = model_path / LABELS_FILE
+    return has_holes, has_photo, best_bounding_box
 
-    if not model_file.exists():
-        raise FileNotFoundError(f"Model file does not exist: {model_file}")
-    if not labels_file.exists():
-        raise FileNotFoundError(f"Label file does not exist: {labels_file}")
 
-    return model_file, labels_file
+def quality_retry_steps(failures: List[str]) -> int:
+    # Only a move fixes the crop. Focus (probably vibrations) and exposure are checked again at the same place.
+    return NORMAL_STEPS if FAILURE_CROP in failures else 0
 
 
-class DetectorScanner(BacklightedScanner):
-    __slots__ = ['_camera', '_stepper_device', '_object_detector', '_debug_count', ]
+class DetectorScanner(BacklightedScanner, CanSeekFrames):
+    __slots__ = ['_camera', '_stepper_device', '_object_detector', '_debug_count', '_position',
+                 '_quality_gate', '_last_preview', ]
 
-    def __init__(self, camera: camera.Camera, backlight_pin: int, stepper_pin_1: int, stepper_pin_2: int, stepper_pin_3: int, stepper_pin_4: int, use_edge_tpu: bool=False) -> None:
+    def __init__(self, camera: camera.Camera, backlight_pin: int, stepper_pin_1: int, stepper_pin_2: int, stepper_pin_3: int, stepper_pin_4: int, use_edge_tpu: bool=False, model_variant: Optional[model_registry.ModelVariant]=None, object_detector: Optional[Detector]=None) -> None:
         super().__init__(backlight_pin)
         
         self._debug_count = 0
+        # Signed motor steps since the start of the roll
+        self._position = 0
+        self._quality_gate = QualityGate()
+        self._last_preview = None
 
         # Hardware devices
         self._camera = camera
         self._stepper_device = stepper_motor.StepperMotor(
             stepper_pin_1, stepper_pin_2, stepper_pin_3, stepper_pin_4)
 
-        # Inference model
-        model_file, labels_file = _get_model_files(use_edge_tpu)
-        self._object_detector = ObjectDetection(
-            str(model_file), str(labels_file),
-            use_edge_tpu=use_edge_tpu)
+        # Inference model, possibly shared with other scanners
+        if object_detector is None:
+            if model_variant is None:
+                model_variant = model_registry.get_variant(None, use_edge_tpu)
+            log.info("Using model variant: %s", model_variant.name)
+            object_detector = ObjectDetection(
+                str(model_registry.get_model_file(model_variant)),
+                str(model_registry.get_labels_file()),
+                use_edge_tpu=model_variant.edge_tpu)
+        self._object_detector = object_detector
 
     def scan_roll(self) -> int:
         # Start chronometer
@@ -92,7 +141,14 @@ class DetectorScanner(BacklightedScanner):
         count = 0
 
         with self.is_in_use:
+            # New roll: the positions start from here
+            self._position = 0
+            self._quality_gate.reset()
             for photo_info in self._scroll_through_photos():
+                # Wait for the storage and the tagging queue, between two photos
+                resources.throttle(self.must_stop)
+                if self.must_stop.is_set():
+                    break
                 count += 1
                 time.sleep(0.5)     # Wait 1/2s in order to stabilize
                 if self._on_next_photo:
@@ -109,6 +165,33 @@ class DetectorScanner(BacklightedScanner):
 
         return count
 
+    def rescan_frames(self, frames: List[PhotoInfo]) -> int:
+        start_time = datetime.now()
+        log.info("Ready to scan again %s frames", len(frames))
+        self.must_stop.clear()
+        count = 0
+
+        with self.is_in_use:
+            for photo_info in self._seek_frames(frames):
+                # Wait for the storage and the tagging queue, between two photos
+                resources.throttle(self.must_stop)
+                if self.must_stop.is_set():
+                    break
+                count += 1
+                time.sleep(0.5)     # Wait 1/2s in order to stabilize
+                if self._on_next_photo:
+                    self._on_next_photo(photo_info)
+
+        self.stop_session()
+
+        time_elapsed = datetime.now() - start_time
+        log.info("Finished scanning again, %s photos taken in: %s",
+                 count, time_elapsed)
+        if self._on_scan_finished:
+            self._on_scan_finished(count)
+
+        return count
+
     def stop_session(self) -> bool:
         stopped = super().stop_session()
         if stopped:
@@ -116,11 +199,50 @@ class DetectorScanner(BacklightedScanner):
 
         return stopped
 
+    def _seek_frames(self, frames: List[PhotoInfo]) -> Generator[PhotoInfo, None, None]:
+        for frame in frames:
+            if frame.position is None:
+                log.warning("Position of frame %s is unknown", frame.index)
+                continue
+
+            # Always end in the scan direction, so that the alignment is the same as during the scan
+            self._rotate(frame.position - DIRECTION * SEEK_MARGIN - self._position)
+
+            moves = 0
+            quality_retries = 0
+            while moves < MAX_ALIGNMENT_MOVES:
+                if self.must_stop.is_set():
+                    return
+
+                steps_to_do = NORMAL_STEPS
+                _, has_photo, bounding_box = self._interpret()
+                if has_photo:
+                    scores, take_photo = self._check_quality(frame.index, bounding_box, quality_retries)
+                    if take_photo:
+                        yield PhotoInfo(index=frame.index, crop=bounding_box, position=self._position,
+                                        quality=scores)
+                        break
+                    quality_retries += 1
+                    steps_to_do = quality_retry_steps(scores.failures)
+                else:
+                    quality_retries = 0
+
+                if steps_to_do:
+                    moves += 1
+                    self._rotate(DIRECTION * steps_to_do)
+            else:
+                log.warning("Frame %s not found around position %s", frame.index, frame.position)
+
+    def _rotate(self, steps: int) -> None:
+        self._stepper_device.rotate(SLEEP_TIME, steps)
+        self._position += steps
+
     def _scroll_through_photos(self) -> Generator[PhotoInfo, None, None]:
         current_photo = 0
         number_of_steps = 0
         has_seen_holes = False
         countdown_to_stop = COUNTDOWN_TO_STOP
+        quality_retries = 0
 
         while True:
             if self.must_stop.is_set():
@@ -130,8 +252,6 @@ class DetectorScanner(BacklightedScanner):
 
             has_holes, has_photo, bounding_box = self._interpret()
 
-            log.info("Loop 2 [%s]: %s, %s, %s", current_photo, has_holes, has_photo, bounding_box)
-
             # Holes indicate there's a film
             if has_seen_holes and not has_holes:
                 # We'll try multiple times before deciding it's finished
@@ -145,21 +265,59 @@ class DetectorScanner(BacklightedScanner):
                 has_seen_holes = has_holes
 
             if has_photo:
-                info = PhotoInfo(index=current_photo, crop=bounding_box)
-                yield info
-                current_photo += 1
-                steps_to_do = LARGE_STEPS
+                scores, take_photo = self._check_quality(current_photo, bounding_box, quality_retries)
+                if take_photo:
+                    quality_retries = 0
+
+                    info = PhotoInfo(index=current_photo, crop=bounding_box, position=self._position,
+                                     quality=scores)
+                    yield info
+                    current_photo += 1
+                    steps_to_do = LARGE_STEPS
+                else:
+                    quality_retries += 1
+                    steps_to_do = quality_retry_steps(scores.failures)
+            else:
+                # The retries of a frame which left the view don't count for the next one
+                quality_retries = 0
 
             number_of_steps += steps_to_do
-            self._stepper_device.rotate(SLEEP_TIME, DIRECTION * steps_to_do)
-
-            # Logging several data
-            log.info("%s: %s, %s", number_of_steps, has_holes, has_photo)
+            self._rotate(DIRECTION * steps_to_do)
+
+            if self._on_progress:
+                self._on_progress({
+                    "steps": number_of_steps,
+                    "has_holes": has_holes,
+                    "has_photo": has_photo,
+                })
+
+            # Per-cycle data: traced rather than logged
+            trace.record("detector_cycle", photo=current_photo, steps=number_of_steps,
+                         has_holes=has_holes, has_photo=has_photo, crop=bounding_box)
+
+    def _check_quality(self, photo_index: int, bounding_box: Optional[Tuple[float, float, float, float]],
+                       quality_retries: int) -> Tuple[QualityScores, bool]:
+        """
+        Check the preview before paying for the download of the photo
+
+        :returns: The scores of the preview, and True if the photo must be taken now
+        """
+        scores = self._quality_gate.evaluate(self._last_preview, bounding_box)
+        if scores.passed:
+            self._quality_gate.accept(scores)
+            return scores, True
+        if quality_retries >= MAX_QUALITY_RETRIES:
+            log.warning("Taking photo %s despite its quality: %s", photo_index, scores.failures)
+            return scores, True
+
+        log.info("Aligning photo %s again: %s", photo_index, scores.failures)
+        return scores, False
 
     def _interpret(self) -> Tuple[bool, bool, Optional[Tuple[float, float, float, float]]]:
         start_time = datetime.now()
         image = self._camera.capture_preview()
         capture_time = datetime.now()
+        self._last_preview = image
 
         detections = self._object_detector.infer(image)
 
@@ -172,55 +330,10 @@ class DetectorScanner(BacklightedScanner):
             image.save(dest_file, "JPEG")
             self._debug_count += 1
 
-        num_holes = 0
-        photo_coverage = 0.0
-        best_bounding_box = None
-        has_left_side_separator = False
+        has_holes, has_photo, best_bounding_box = interpret_detections(detections)
 
-        for d in detections:
-            label = d[0]
-            bounding_box = d[1]
-            confidence = d[2]
-
-            y1, x1, y2, x2 = np.float_(bounding_box).tolist()
-            min_x = min(x1, x2)
-            max_x = max(x1, x2)
-            min_y = min(y1, y2)
-            max_y = max(y1, y2)
-
-            if confidence < MIN_CONFIDENCE:
-                continue
-
-            if label == LABEL_HOLE:
-                num_holes += 1
-            elif label == LABEL_PHOTO or label == LABEL_PARTIAL_PHOTO:
-                # Check if there's a margin
-                if min_x >= MIN_X_MARGIN and max_x <= 1.0 - MIN_X_MARGIN \
-                   and min_y >= MIN_Y_MARGIN and max_y <= 1.0 - MIN_Y_MARGIN \
-                   and min_x <= LEFT_SIDE:
-
-                    current_photo_coverage = (x2 - x1) * (y2 - y1)
-                    if current_photo_coverage > photo_coverage:
-                        photo_coverage = current_photo_coverage
-                        best_bounding_box = (x1, y1, x2, y2)
-                        log.info("Found photo: %s", bounding_box)
-                else:
-                    log.info("Excluded due to margin: %s", bounding_box)
-            elif label == LABEL_SEPARATOR:
-                # Check if the separator is tall and on the left sid
-                if max_x <= LEFT_SIDE and min_y <=0.20 and  max_y >= 0.80 and min_y >= 0.01 and max_y <= 0.99:
-                    log.info("Found left-side separator: %s", bounding_box)
-
-        has_holes = num_holes >= MIN_NUMBER_OF_HOLES
-
-        # Determine if there is a well-frame photo
-        # Option 1: photo detected by the model, aligned on the left
-        has_photo = photo_coverage >= MIN_COVERAGE
-        if not has_photo:
-            # Option 2: there is a tall separator on the left, with many holes
-            has_photo = num_holes >= 16 and has_left_side_separator
-
-        log.info("Detection: %s, %s, %s, %s, %s", len(detections), num_holes, photo_coverage, has_left_side_separator, has_photo)
-        log.info('Total inference time (hh:mm:ss.ms): %s / capture time: %s', datetime.now() - start_time, capture_time - start_time)
+        trace.record("detector_inference", detections=len(detections),
+                     total_seconds=(datetime.now() - start_time).total_seconds(),
+                     capture_seconds=(capture_time - start_time).total_seconds())
 
         return has_holes, has_photo, best_bounding_box
@@ -0,0 +1,143 @@
+"""
+Registry of the scanning rigs driven by this service.
+Each rig is a camera and a scanner, with its own temporary path and tagging queue.
+The object detection interpreters are shared by all the rigs.
+"""
+
+from dataclasses import dataclass
+import logging
+import pathlib
+import threading
+from typing import Callable, Dict, List, Optional
+
+from dataclasses_json import dataclass_json
+
+from scanner import detector_scanner, exif_tagger
+from scanner.hardware import camera, camera_supervisor
+from scanner.metadata import MetaData
+from scanner.object_detection import Detector
+from scanner.scanner_device import DEFAULT_DEVICE, Scanner
+
+log = logging.getLogger(__name__)
+
+# The frames are found by the object detection model on the previews
+SCANNER_DETECTOR = "detector"
+# The holes of the film are counted with a lux meter
+SCANNER_HOLE_COUNTER = "hole_counter"
+SCANNER_TYPES = [SCANNER_DETECTOR, SCANNER_HOLE_COUNTER]
+
+
+@dataclass_json
+@dataclass(frozen=True)
+class DeviceConfiguration:
+    id: str
+    backlight: int
+    pin1: int
+    pin2: int
+    pin3: int
+    pin4: int
+    # By default, the first camera found
+    camera_port: Optional[str] = None
+    scanner: str = SCANNER_DETECTOR
+    # Hole counter only
+    led: Optional[int] = None
+    led_use_infrared: bool = False
+    # Automatic by default
+    lux_gain: Optional[int] = None
+    lux_integration_time: Optional[int] = None
+
+
+class DeviceDoesNotExist(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class Device:
+    __slots__ = ['id', 'camera', 'scanner', 'temporary_path', 'exif_tagger', ]
+
+    def __init__(self, device_id: str, the_camera: camera_supervisor.SupervisedCamera, the_scanner: Scanner,
+                 temporary_path: pathlib.Path,
+                 tagger: Callable[[pathlib.Path, MetaData, Callable[[pathlib.Path], None]], None]) -> None:
+        self.id = device_id
+        self.camera = the_camera
+        self.scanner = the_scanner
+        self.temporary_path = temporary_path
+        self.exif_tagger = tagger
+
+
+class DeviceRegistry:
+    __slots__ = ['_devices', '_lock', ]
+
+    def __init__(self) -> None:
+        self._devices: Dict[str, Device] = {}
+        self._lock = threading.Lock()
+
+    def add(self, device: Device) -> None:
+        with self._lock:
+            if device.id in self._devices:
+                raise ValueError(f"Device already exists: {device.id}")
+            self._devices[device.id] = device
+        log.info("Device added: %s", device.id)
+
+    def get(self, device_id: Optional[str] = None) -> Device:
+        """
+        :raises DeviceDoesNotExist: Device not found
+        """
+        with self._lock:
+            device = self._devices.get(device_id or DEFAULT_DEVICE)
+        if device is None:
+            raise DeviceDoesNotExist(f"Device not found: {device_id}")
+        return device
+
+    def list_devices(self) -> List[Device]:
+        with self._lock:
+            return list(self._devices.values())
+
+
+def create_device(configuration: DeviceConfiguration, temporary_root: pathlib.Path,
+                  object_detector: Detector, dry_run: bool = False) -> Device:
+    # The camera files of the rigs must not mix
+    temporary_path = temporary_root if configuration.id == DEFAULT_DEVICE else temporary_root / configuration.id
+    temporary_path.mkdir(parents=True, exist_ok=True)
+
+    the_camera = camera_supervisor.SupervisedCamera(
+        camera.get_camera_type(dry_run)(temporary_path, configuration.camera_port))
+    the_scanner = _create_scanner(configuration, the_camera, object_detector)
+
+    return Device(configuration.id, the_camera, the_scanner, temporary_path, exif_tagger.async_tagger())
+
+
+def _create_scanner(configuration: DeviceConfiguration, the_camera: camera.Camera,
+                    object_detector: Detector) -> Scanner:
+    if configuration.scanner == SCANNER_DETECTOR:
+        return detector_scanner.DetectorScanner(
+            the_camera, configuration.backlight,
+            configuration.pin1, configuration.pin2, configuration.pin3, configuration.pin4,
+            object_detector=object_detector)
+
+    if configuration.scanner == SCANNER_HOLE_COUNTER:
+        if configuration.led is None:
+            raise ValueError(f"No LED pin for the hole counter scanner: {configuration.id}")
+        # Only the rigs with a lux meter need the I2C libraries
+        from scanner import hole_counter_scanner
+        return hole_counter_scanner.HoleCounterScanner(
+            configuration.led, configuration.led_use_infrared, configuration.backlight,
+            configuration.pin1, configuration.pin2, configuration.pin3, configuration.pin4,
+            configuration.lux_gain, configuration.lux_integration_time)
+
+    raise ValueError(f"Unknown scanner type: {configuration.scanner}")
+
+
+def load_configurations(devices_filename: str) -> List[DeviceConfiguration]:
+    """
+    JSON list of the additional devices
+    """
+    with open(devices_filename, 'r') as f:
+        return DeviceConfiguration.schema().loads(f.read(), many=True)
+
+
+_registry = DeviceRegistry()
+
+
+def get_devices() -> DeviceRegistry:
+    return _registry
@@ -0,0 +1,128 @@
+"""
+Event bus between the scanner threads and the Socket.IO clients.
+Events are kept in a bounded ring buffer, so that publishing never blocks
+and reconnecting clients can replay what they missed.
+"""
+
+import collections
+import logging
+import threading
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+RING_BUFFER_SIZE = 1000
+MAX_BATCH_SIZE = 50
+
+# High-rate events: an event not yet sent replaces the previous one of the same kind
+COALESCED_SUBJECTS = {"progress", "detections", "archive"}
+
+
+class EventBus:
+    __slots__ = ['_events', '_next_sequence', '_lock', '_available',
+                 '_clients', '_coalesced', '_dropped', ]
+
+    def __init__(self, capacity: int = RING_BUFFER_SIZE) -> None:
+        # Events are [sequence, subject, payload], mutable to be coalesced
+        self._events: Deque[List[Any]] = collections.deque(maxlen=capacity)
+        self._next_sequence = 1
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        # Client ID => last sequence sent to that client
+        self._clients: Dict[str, int] = {}
+        self._coalesced: Dict[Tuple[str, Any], List[Any]] = {}
+        self._dropped: Dict[str, int] = {}
+
+    def publish(self, subject: str, payload: Any) -> None:
+        with self._lock:
+            if subject in COALESCED_SUBJECTS:
+                key = (subject, _coalescing_id(payload))
+                previous = self._coalesced.get(key)
+                if previous is not None and self._is_unsent(previous[0]):
+                    previous[2] = payload
+                    return
+            else:
+                key = None
+
+            event = [self._next_sequence, subject, payload]
+            self._next_sequence += 1
+            self._events.append(event)
+            if key is not None:
+                self._coalesced[key] = event
+
+            self._available.notify_all()
+
+    def register(self, client_id: str, last_sequence: Optional[int] = None) -> None:
+        """
+        Register a new client. If last_sequence is given, the events following it are replayed.
+        """
+        with self._lock:
+            if last_sequence is None:
+                last_sequence = self._next_sequence - 1
+            self._clients[client_id] = max(0, min(last_sequence, self._next_sequence - 1))
+            self._dropped[client_id] = 0
+            self._available.notify_all()
+
+    def unregister(self, client_id: str) -> None:
+        with self._lock:
+            self._clients.pop(client_id, None)
+            dropped = self._dropped.pop(client_id, 0)
+        if dropped:
+            log.info("Client %s missed %s events", client_id, dropped)
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Wait until there are events to send to any client
+        """
+        with self._lock:
+            return self._available.wait_for(self._has_unsent_events, timeout=timeout)
+
+    def take(self, client_id: str, max_count: int = MAX_BATCH_SIZE) -> List[Tuple[int, str, Any]]:
+        """
+        Next events to send to the client, marked as sent
+        """
+        with self._lock:
+            last_sent = self._clients.get(client_id)
+            if last_sent is None or not self._events:
+                return []
+
+            oldest = self._events[0][0]
+            if last_sent + 1 < oldest:
+                # Too slow: the oldest events were overwritten
+                self._dropped[client_id] += oldest - last_sent - 1
+                last_sent = oldest - 1
+
+            start = last_sent + 1 - oldest
+            batch = [tuple(self._events[i]) for i in range(start, min(start + max_count, len(self._events)))]
+            if batch:
+                self._clients[client_id] = batch[-1][0]
+
+            self._prune_coalesced()
+            return batch
+
+    @property
+    def client_ids(self) -> Iterable[str]:
+        with self._lock:
+            return list(self._clients.keys())
+
+    def _is_unsent(self, sequence: int) -> bool:
+        return all(last_sent < sequence for last_sent in self._clients.values())
+
+    def _has_unsent_events(self) -> bool:
+        last_sequence = self._next_sequence - 1
+        return any(last_sent < last_sequence for last_sent in self._clients.values())
+
+    def _prune_coalesced(self) -> None:
+        if not self._events:
+            self._coalesced.clear()
+            return
+        oldest = self._events[0][0]
+        for key in [k for k, e in self._coalesced.items() if e[0] < oldest]:
+            del self._coalesced[key]
+
+
+def _coalescing_id(payload: Any) -> Any:
+    # Events of different sessions aren't merged
+    if isinstance(payload, dict):
+        return payload.get("id")
+    return None
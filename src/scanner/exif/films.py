@@ -2,18 +2,78 @@
 Database of films
 Data from wikipedia:
 https://en.wikipedia.org/wiki/List_of_photographic_films
+User-added films are stored in a separate file with the same format.
 """
 
 import csv
 import pathlib
-from typing import Iterator, Tuple
+import threading
+from typing import List, Optional, Tuple
 
-def get_all_films() -> Iterator[Tuple[str, str]]:
-    # Get the film database
-    base_dir = pathlib.Path(__file__).parent.absolute()
-    filename = base_dir / "films.csv"
+FIELD_NAMES = ['make', 'name']
 
-    with open(filename, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            yield row['make'], row['name']
+_lock = threading.Lock()
+_user_films_file: Optional[pathlib.Path] = None
+_films: Optional[List[Tuple[str, str]]] = None
+
+
+def init_user_films(user_films_filename: Optional[str] = None) -> None:
+    global _user_films_file, _films
+
+    with _lock:
+        if user_films_filename:
+            _user_films_file = pathlib.Path(user_films_filename)
+        else:
+            _user_films_file = _get_base_dir() / "films_user.csv"
+        _films = None
+
+
+def get_all_films() -> List[Tuple[str, str]]:
+    global _films
+
+    # Loaded only once
+    with _lock:
+        if _films is None:
+            _films = _read_films(_get_base_dir() / "films.csv")
+            if _user_films_file is not None:
+                _films.extend(f for f in _read_films(_user_films_file) if f not in _films)
+        return _films
+
+
+def add_film(make: str, name: str) -> bool:
+    """
+    Add a film to the user films
+
+    :returns: False if the film already exists
+    """
+    films = get_all_films()
+    film = (make, name)
+
+    with _lock:
+        if film in films:
+            return False
+        if _user_films_file is None:
+            raise RuntimeError("User films are not initialized")
+
+        is_new_file = not _user_films_file.exists()
+        with open(_user_films_file, 'a', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=FIELD_NAMES)
+            if is_new_file:
+                writer.writeheader()
+            writer.writerow({'make': make, 'name': name})
+
+        films.append(film)
+        return True
+
+
+def _get_base_dir() -> pathlib.Path:
+    return pathlib.Path(__file__).parent.absolute()
+
+
+def _read_films(filename: pathlib.Path) -> List[Tuple[str, str]]:
+    try:
+        with open(filename, newline='') as csvfile:
+            reader = csv.DictReader(csvfile)
+            return [(row['make'], row['name']) for row in reader]
+    except FileNotFoundError:
+        return []
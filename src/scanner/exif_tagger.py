@@ -34,12 +34,29 @@ TAG_MAPPING = {
 }
 
 
+# Files waiting for ExifTool or being tagged and moved, by all the taggers
+_pending_count = 0
+_pending_lock = threading.Lock()
+
+
+def pending_files() -> int:
+    with _pending_lock:
+        return _pending_count
+
+
+def _add_pending(count: int) -> None:
+    global _pending_count
+    with _pending_lock:
+        _pending_count += count
+
+
 def async_tagger() -> Callable[[Path, metadata.MetaData, Callable[[Path], None]], None]:
     sync_queue: queue.SimpleQueue = queue.SimpleQueue()
 
     threading.Thread(target=_tagger_thread, args=(sync_queue, ), daemon=True).start()
 
     def tag_file(filename: Path, mdata: metadata.MetaData, post_action: Callable[[Path], None]):
+        _add_pending(1)
         sync_queue.put((filename, mdata, post_action))
 
     return tag_file
@@ -51,15 +68,18 @@ def _tagger_thread(sync_queue: queue.SimpleQueue):
     with exiftool.ExifTool(config_file=str(exif.get_analogexif_config())) as et:
         while True:
             filename, metadata, post_action = sync_queue.get()
-            params = _build_command_line(filename, metadata)
-
-            # Do the tagging! It seems that execute_json fails in that case.
-            encoded_params = map(os.fsencode, params)
-            result = et.execute(*encoded_params)
-            log.info("ExifTool result: %s", result.decode("utf-8"))
-
-            if post_action is not None:
-                post_action(filename)
+            try:
+                params = _build_command_line(filename, metadata)
+
+                # Do the tagging! It seems that execute_json fails in that case.
+                encoded_params = map(os.fsencode, params)
+                result = et.execute(*encoded_params)
+                log.info("ExifTool result: %s", result.decode("utf-8"))
+
+                if post_action is not None:
+                    post_action(filename)
+            finally:
+                _add_pending(-1)
 
 
 def _build_command_line(filename: Path, mdata: metadata.MetaData) -> List[str]:
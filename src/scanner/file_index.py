@@ -0,0 +1,234 @@
+"""
+Index of the files in the share and in the archive, kept in SQLite.
+It's updated as files are captured, tagged and archived, so that listing
+never needs to scan the directories.
+"""
+
+from dataclasses import dataclass
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from dataclasses_json import dataclass_json
+
+from scanner import manifest
+
+log = logging.getLogger(__name__)
+
+LOCATION_SHARE = "share"
+LOCATION_ARCHIVE = "archive"
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    location TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    session INTEGER,
+    frame INTEGER,
+    roll_id TEXT,
+    captured_at REAL,
+    tagged INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (location, name)
+);
+CREATE INDEX IF NOT EXISTS files_roll ON files (location, roll_id, name);
+CREATE INDEX IF NOT EXISTS files_session ON files (location, session, name);
+"""
+
+# SHA-256 of the file downloaded from the camera, before tagging
+_CONTENT_HASH_SCHEMA = """
+CREATE INDEX IF NOT EXISTS files_content ON files (content_hash);
+"""
+
+_COLUMNS = "name, size, session, frame, roll_id, captured_at, tagged"
+
+
+@dataclass_json
+@dataclass(frozen=True)
+class IndexedFile:
+    name: str   # Relative to the share or the archive
+    size: int
+    session: Optional[int] = None
+    frame: Optional[int] = None
+    roll_id: Optional[str] = None
+    captured_at: Optional[float] = None
+    tagged: bool = False
+
+
+class FileIndex:
+    __slots__ = ['_roots', '_connection', '_lock', ]
+
+    def __init__(self, db_file: pathlib.Path, roots: Dict[str, pathlib.Path]) -> None:
+        self._roots = roots
+        self._lock = threading.Lock()
+
+        is_new = not db_file.exists()
+        self._connection = sqlite3.connect(str(db_file), check_same_thread=False)
+        # Fewer writes on the SD card, still safe in case of crash
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+        columns = {r[1] for r in self._connection.execute("PRAGMA table_info(files)")}
+        if "content_hash" not in columns:
+            # Index created before the content hashes
+            self._connection.execute("ALTER TABLE files ADD COLUMN content_hash TEXT")
+        self._connection.executescript(_CONTENT_HASH_SCHEMA)
+
+        if is_new:
+            for location in roots:
+                self.rebuild(location)
+
+    def add(self, location: str, file: pathlib.Path, session: Optional[int] = None,
+            frame: Optional[int] = None, roll_id: Optional[str] = None, tagged: bool = False,
+            content_hash: Optional[str] = None) -> None:
+        stat = file.stat()
+        name = file.relative_to(self._roots[location]).as_posix()
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO files (location, {_COLUMNS}, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (location, name, stat.st_size, session, frame, roll_id, stat.st_mtime, tagged, content_hash))
+
+    def find_content(self, content_hash: str, roll_id: Optional[str] = None) -> List[Tuple[str, str]]:
+        """
+        Share and archive files downloaded with this content, from the same roll
+
+        :returns: The location and name of each file
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT location, name FROM files WHERE content_hash = ? AND roll_id IS ?",
+                (content_hash, roll_id)).fetchall()
+        return [(r[0], r[1]) for r in rows]
+
+    def move(self, source: str, destination: str, names: List[str]) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "DELETE FROM files WHERE location = ? AND name = ?",
+                ((destination, n) for n in names))
+            self._connection.executemany(
+                "UPDATE files SET location = ? WHERE location = ? AND name = ?",
+                ((destination, source, n) for n in names))
+
+    def remove(self, location: str, names: List[str]) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "DELETE FROM files WHERE location = ? AND name = ?",
+                ((location, n) for n in names))
+
+    def list_files(self, location: str, after: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE,
+                   session: Optional[int] = None, roll_id: Optional[str] = None,
+                   tagged: Optional[bool] = None, with_total: bool = False) -> Tuple[List[IndexedFile], Optional[int]]:
+        """
+        Page of files sorted by name, starting after the given name, and the total number of files
+
+        :param with_total: Count the files, a full scan of the matching rows. Otherwise, the total is None.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        conditions = ["location = ?"]
+        params: List[object] = [location]
+        if session is not None:
+            conditions.append("session = ?")
+            params.append(session)
+        if roll_id is not None:
+            conditions.append("roll_id = ?")
+            params.append(roll_id)
+        if tagged is not None:
+            conditions.append("tagged = ?")
+            params.append(tagged)
+        where = " AND ".join(conditions)
+
+        with self._lock:
+            total = None
+            if with_total:
+                total = self._connection.execute(f"SELECT COUNT(*) FROM files WHERE {where}", params).fetchone()[0]
+
+            # Keyset pagination: the cost doesn't depend on the page number
+            if after is not None:
+                where += " AND name > ?"
+                params.append(after)
+            rows = self._connection.execute(
+                f"SELECT {_COLUMNS} FROM files WHERE {where} ORDER BY name LIMIT ?",
+                params + [limit]).fetchall()
+
+        files = [IndexedFile(name=r[0], size=r[1], session=r[2], frame=r[3], roll_id=r[4],
+                             captured_at=r[5], tagged=bool(r[6])) for r in rows]
+        return files, total
+
+    def rebuild(self, location: str) -> None:
+        """
+        Index the existing files of the location, once
+        """
+        root = self._roots[location]
+        log.info("Indexing the files of %s", root)
+
+        the_manifest = manifest.get_manifest()
+        known = {e.name: e for e in the_manifest.find()} if the_manifest is not None else {}
+
+        rows = []
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                file = pathlib.Path(dirpath) / filename
+                name = file.relative_to(root).as_posix()
+                stat = file.stat()
+                # Files of the scanner are tagged before reaching the share
+                entry = known.get(name)
+                rows.append((location, name, stat.st_size,
+                             entry.session if entry else None,
+                             entry.frame if entry else None,
+                             entry.roll_id if entry else None,
+                             stat.st_mtime,
+                             entry is not None))
+
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM files WHERE location = ?", (location, ))
+            self._connection.executemany(
+                f"INSERT INTO files (location, {_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        log.info("%s files indexed", len(rows))
+
+
+_file_index: Optional[FileIndex] = None
+
+
+def init_file_index(db_filename: str, share_root: pathlib.Path, archive_root: pathlib.Path) -> FileIndex:
+    global _file_index
+    _file_index = FileIndex(pathlib.Path(db_filename),
+                            {LOCATION_SHARE: share_root, LOCATION_ARCHIVE: archive_root})
+    return _file_index
+
+
+def get_file_index() -> Optional[FileIndex]:
+    return _file_index
+
+
+def record_file(file: pathlib.Path, session: Optional[int] = None, frame: Optional[int] = None,
+                roll_id: Optional[str] = None, tagged: bool = False, content_hash: Optional[str] = None) -> None:
+    """
+    Index a file which reached the share
+    """
+    if _file_index is None:
+        return
+
+    try:
+        _file_index.add(LOCATION_SHARE, file, session, frame, roll_id, tagged, content_hash)
+    except Exception:
+        log.exception("Unable to index file: %s", file)
+
+
+def is_duplicate(content_hash: Optional[str], roll_id: Optional[str]) -> bool:
+    """
+    True if the same camera file of the same roll is already in the share or the archive
+    """
+    if _file_index is None or content_hash is None:
+        return False
+
+    try:
+        return bool(_file_index.find_content(content_hash, roll_id))
+    except Exception:
+        log.exception("Unable to look up the content hash: %s", content_hash)
+        return False
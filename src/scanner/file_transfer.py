@@ -0,0 +1,344 @@
+"""
+Moves of the scanned files between the temporary, destination and archive paths.
+A rename when both paths are on the same file system. Otherwise, the file is copied
+by the kernel (copy_file_range, or sendfile) in large chunks, verified, and synced
+before the source is removed. Copies run in parallel, up to a limit.
+
+Benchmark, such as tmpfs versus SD card:
+    python -m scanner.file_transfer /tmp /storage/tmp --size 30 --count 10
+"""
+
+import argparse
+import errno
+import logging
+import os
+import pathlib
+import shutil
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from scanner import manifest
+
+log = logging.getLogger(__name__)
+
+METHOD_RENAME = "rename"
+METHOD_COPY_FILE_RANGE = "copy_file_range"
+METHOD_SENDFILE = "sendfile"
+METHOD_READ_WRITE = "read_write"
+
+VERIFY_NONE = "none"
+VERIFY_SIZE = "size"
+VERIFY_HASH = "hash"
+
+# Copied in the kernel: large chunks, the data doesn't go through Python
+CHUNK_SIZE = 16 * 1024 * 1024
+READ_WRITE_CHUNK_SIZE = 1024 * 1024
+# Shared by the session and archive copies
+MAX_PARALLEL_COPIES = 4
+SYNC_BATCH_SIZE = 16
+
+# Not supported between these file systems, or by this kernel: next method
+_UNSUPPORTED_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP}
+
+_copy_slots = threading.BoundedSemaphore(MAX_PARALLEL_COPIES)
+
+
+def _copy_file_range(source_fd: int, destination_fd: int, size: int) -> None:
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(source_fd, destination_fd, min(CHUNK_SIZE, size - offset), offset, offset)
+        if copied == 0:
+            break
+        offset += copied
+
+
+def _sendfile(source_fd: int, destination_fd: int, size: int) -> None:
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(destination_fd, source_fd, offset, min(CHUNK_SIZE, size - offset))
+        if sent == 0:
+            break
+        offset += sent
+
+
+def _read_write(source_fd: int, destination_fd: int, size: int) -> None:
+    while True:
+        data = os.read(source_fd, READ_WRITE_CHUNK_SIZE)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            view = view[os.write(destination_fd, view):]
+
+
+_COPIERS: Dict[str, Callable[[int, int, int], None]] = {}
+if hasattr(os, "copy_file_range"):
+    _COPIERS[METHOD_COPY_FILE_RANGE] = _copy_file_range
+if hasattr(os, "sendfile"):
+    _COPIERS[METHOD_SENDFILE] = _sendfile
+_COPIERS[METHOD_READ_WRITE] = _read_write
+
+
+def available_methods() -> List[str]:
+    return list(_COPIERS)
+
+
+class SyncBatch:
+    """
+    Copies synced together: the sources are only removed once their copies are on the disk.
+    A failed sync fails all the files of the batch: their sources are kept.
+    """
+    __slots__ = ['_size', '_pending', '_moved', '_failed', '_lock', ]
+
+    def __init__(self, size: int = SYNC_BATCH_SIZE) -> None:
+        self._size = size
+        self._pending: List[Tuple[pathlib.Path, pathlib.Path]] = []
+        # Sources, until taken by take_results()
+        self._moved: List[pathlib.Path] = []
+        self._failed: List[pathlib.Path] = []
+        self._lock = threading.Lock()
+
+    def add(self, source: pathlib.Path, destination: pathlib.Path) -> None:
+        with self._lock:
+            self._pending.append((source, destination))
+            if len(self._pending) < self._size:
+                return
+            pending, self._pending = self._pending, []
+        self._commit(pending)
+
+    def add_renamed(self, source: pathlib.Path) -> None:
+        """
+        Moved without copy: nothing to sync
+        """
+        with self._lock:
+            self._moved.append(source)
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, []
+        self._commit(pending)
+
+    def take_results(self) -> Tuple[List[pathlib.Path], List[pathlib.Path]]:
+        """
+        Sources moved and failed since the previous call. Pending files are in neither.
+        """
+        with self._lock:
+            moved, self._moved = self._moved, []
+            failed, self._failed = self._failed, []
+        return moved, failed
+
+    def _commit(self, pending: List[Tuple[pathlib.Path, pathlib.Path]]) -> None:
+        if not pending:
+            return
+
+        moved, failed = [], []
+        try:
+            _sync(destination for _, destination in pending)
+        except OSError:
+            log.exception("Unable to sync %s files", len(pending))
+            failed = [source for source, _ in pending]
+        else:
+            for source, _ in pending:
+                try:
+                    source.unlink(missing_ok=True)
+                    moved.append(source)
+                except OSError:
+                    log.exception("Unable to remove %s", source)
+                    failed.append(source)
+
+        with self._lock:
+            self._moved.extend(moved)
+            self._failed.extend(failed)
+
+    def __enter__(self) -> "SyncBatch":
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self.flush()
+
+
+def move_file(source: pathlib.Path, destination: pathlib.Path,
+              verify: str = VERIFY_SIZE, batch: Optional[SyncBatch] = None) -> str:
+    """
+    Move the file, with a rename if possible, like shutil.move.
+
+    :param batch: Syncs the copy with other ones, and reports the result. By default, the copy is synced
+        before returning.
+    :returns: The method used
+    """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.replace(source, destination)
+        if batch is not None:
+            batch.add_renamed(source)
+        return METHOD_RENAME
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    method = copy_file(source, destination, verify)
+    if batch is None:
+        _commit([(source, destination)])
+    else:
+        batch.add(source, destination)
+    return method
+
+
+def copy_file(source: pathlib.Path, destination: pathlib.Path,
+              verify: str = VERIFY_SIZE, method: Optional[str] = None) -> str:
+    """
+    Copy the file and its metadata. The destination only appears once the copy is verified.
+
+    :param method: By default, the fastest one supported
+    :returns: The method used
+    """
+    tmp_file = destination.with_name(destination.name + ".tmp")
+    try:
+        with _copy_slots:
+            method = _copy_data(source, tmp_file, method)
+        shutil.copystat(source, tmp_file)
+        _verify(source, tmp_file, verify)
+        os.replace(tmp_file, destination)
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
+    return method
+
+
+def _copy_data(source: pathlib.Path, destination: pathlib.Path, method: Optional[str]) -> str:
+    methods = [method] if method is not None else available_methods()
+
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        destination_fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            size = os.fstat(source_fd).st_size
+            for m in methods:
+                try:
+                    _COPIERS[m](source_fd, destination_fd, size)
+                    return m
+                except OSError as e:
+                    if e.errno not in _UNSUPPORTED_ERRORS or m == methods[-1]:
+                        raise
+                    # Start over with the next method
+                    os.lseek(source_fd, 0, os.SEEK_SET)
+                    os.lseek(destination_fd, 0, os.SEEK_SET)
+                    os.ftruncate(destination_fd, 0)
+        finally:
+            os.close(destination_fd)
+    finally:
+        os.close(source_fd)
+
+    raise ValueError(f"No copy method: {method}")
+
+
+def _verify(source: pathlib.Path, copy: pathlib.Path, verify: str) -> None:
+    if verify == VERIFY_NONE:
+        return
+
+    if copy.stat().st_size != source.stat().st_size \
+            or (verify == VERIFY_HASH and manifest.hash_file(copy) != manifest.hash_file(source)):
+        raise IOError(f"Copy verification failed: {source}")
+
+
+def _sync(files: Iterable[pathlib.Path]) -> None:
+    folders = set()
+    for f in files:
+        fd = os.open(f, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        folders.add(f.parent)
+
+    # The new names too
+    for folder in folders:
+        try:
+            fd = os.open(folder, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.fsync(fd)
+        except OSError:
+            # Not supported by every file system
+            pass
+        finally:
+            os.close(fd)
+
+
+def _commit(pending: List[Tuple[pathlib.Path, pathlib.Path]]) -> None:
+    if not pending:
+        return
+
+    _sync(destination for _, destination in pending)
+    for source, _ in pending:
+        source.unlink(missing_ok=True)
+
+
+BENCHMARK_FOLDER = "file_transfer_benchmark"
+
+
+def benchmark(source_path: pathlib.Path, destination_path: pathlib.Path, size: int, count: int) -> Dict[str, float]:
+    work_source = source_path / BENCHMARK_FOLDER
+    work_destination = destination_path / BENCHMARK_FOLDER
+    work_source.mkdir(parents=True, exist_ok=True)
+    work_destination.mkdir(parents=True, exist_ok=True)
+    results = {}
+
+    def measure(name: str, copy: Callable[[pathlib.Path, pathlib.Path], None]) -> None:
+        copies = [work_destination / f.name for f in files]
+        start_time = time.perf_counter()
+        try:
+            for f, c in zip(files, copies):
+                copy(f, c)
+        except OSError as e:
+            # Such as copy_file_range between file systems
+            print(f"{name:>22}: not supported ({e.strerror})")
+            return
+        # Written to the disk, as in the scanner
+        _sync(copies)
+        elapsed = time.perf_counter() - start_time
+
+        results[name] = size * count / elapsed / (1024 * 1024)
+        print(f"{name:>22}: {results[name]:10.1f} MB/s")
+        for c in copies:
+            c.unlink()
+
+    try:
+        files = []
+        for i in range(count):
+            f = work_source / f"{i}.bin"
+            f.write_bytes(os.urandom(size))
+            files.append(f)
+        _sync(files)
+
+        # Previous implementation: shutil.move between file systems
+        measure("shutil.copy2", lambda s, d: shutil.copy2(s, d))
+        for m in available_methods():
+            measure(m, lambda s, d, m=m: copy_file(s, d, VERIFY_SIZE, m))
+        measure("default + hash", lambda s, d: copy_file(s, d, VERIFY_HASH))
+    finally:
+        shutil.rmtree(work_source, ignore_errors=True)
+        shutil.rmtree(work_destination, ignore_errors=True)
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="File transfer benchmark")
+    parser.add_argument('source', type=str, help='Source path, such as the temporary path')
+    parser.add_argument('destination', type=str, help='Destination path, such as the share or the archive')
+    parser.add_argument('--size', default=30, type=int, help='Size of each file, in MB')
+    parser.add_argument('--count', default=10, type=int, help='Number of files')
+    args = parser.parse_args()
+
+    source = pathlib.Path(args.source)
+    destination = pathlib.Path(args.destination)
+    destination.mkdir(parents=True, exist_ok=True)
+    print(f"Same file system: {source.stat().st_dev == destination.stat().st_dev}")
+    benchmark(source, destination, args.size * 1024 * 1024, args.count)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,71 @@
 from abc import ABC, abstractmethod
+import collections
+import contextlib
+from concurrent import futures
+from concurrent.futures import Future
+import hashlib
 import io
 import logging
 import threading
+import time
 from datetime import datetime
 from pathlib import Path
-from typing import Callable, List, Optional, Tuple, Type
+from typing import Callable, Deque, Iterator, List, Optional, Tuple, Type
 
 import gphoto2 as gp
 from PIL import Image
 
 log = logging.getLogger(__name__)
 
+# Called with the downloaded file and its SHA-256
+DownloadCallback = Callable[[Path, Optional[str]], None]
+
+WRITE_CHUNK_SIZE = 1024 * 1024
+
 
 class CameraException(Exception):
     def __init__(self, message):
         self.message = message
 
 
+class CameraDownloadException(CameraException):
+    """
+    The photo was taken, but not downloaded: only the download has to be retried
+    """
+
+    def __init__(self, message, folder: str, name: str):
+        super().__init__(message)
+        self.folder = folder
+        self.name = name
+
+
+class LostDownload:
+    """
+    File of a capture which the event pump failed to download
+    """
+    __slots__ = ['folder', 'name', 'delete_after_download', 'callback', ]
+
+    def __init__(self, folder: str, name: str, delete_after_download: bool, callback: DownloadCallback) -> None:
+        self.folder = folder
+        self.name = name
+        self.delete_after_download = delete_after_download
+        self.callback = callback
+
+
+def _save_hashed(data, target_file: Path) -> str:
+    """
+    Write the file and compute its hash at the same time: it isn't read again
+    """
+    view = memoryview(data)
+    h = hashlib.sha256()
+    with open(target_file, 'wb') as f:
+        for offset in range(0, len(view), WRITE_CHUNK_SIZE):
+            chunk = view[offset:offset + WRITE_CHUNK_SIZE]
+            h.update(chunk)
+            f.write(chunk)
+    return h.hexdigest()
+
+
 class Camera(ABC):
     def __init__(self, target_path: Path) -> None:
         pass
@@ -28,7 +77,16 @@ class Camera(ABC):
     @abstractmethod
     def take_photo(self, max_files_count: int = 1,
                    delete_after_download: bool = False,
-                   callback: Callable[[Path], None] = None):
+                   callback: DownloadCallback = None,
+                   defer_file: Callable[[str, str], bool] = None):
+        """
+        :param defer_file: Called with the folder and name of each new file. When it returns True,
+            the file is left on the camera, to be downloaded later with download_file()
+        """
+        raise NotImplementedError
+
+    def download_file(self, folder: str, name: str, delete_after_download: bool = False,
+                      callback: DownloadCallback = None):
         raise NotImplementedError
 
     @abstractmethod
@@ -39,6 +97,40 @@ class Camera(ABC):
     def close(self):
         raise NotImplementedError
 
+    @property
+    @abstractmethod
+    def model(self) -> Optional[str]:
+        raise NotImplementedError
+
+    @property
+    def pending_files(self) -> int:
+        """
+        Number of files expected from the camera, not downloaded yet
+        """
+        return 0
+
+    def take_lost_downloads(self, timeout: float = 0) -> List[LostDownload]:
+        """
+        Files taken but not downloaded in the background, to download again with download_file()
+
+        :param timeout: Seconds to wait for the files still expected
+        """
+        return []
+
+    def apply_settings(self, iso: Optional[str] = None, shutter_speed: Optional[str] = None,
+                       aperture: Optional[str] = None, exposure_compensation: Optional[str] = None) -> None:
+        """
+        Change several settings at once. Missing values are left unchanged.
+        """
+        if iso:
+            self.iso = iso
+        if shutter_speed:
+            self.shutter_speed = shutter_speed
+        if aperture:
+            self.aperture = aperture
+        if exposure_compensation:
+            self.exposure_compensation = exposure_compensation
+
     @property
     @abstractmethod
     def accepted_iso(self) -> List[str]:
@@ -100,29 +192,100 @@ class Camera(ABC):
         raise NotImplementedError
 
 
+class _PriorityLock:
+    """
+    Lock which is given to the high priority threads first
+    """
+    __slots__ = ['_condition', '_locked', '_waiting', ]
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._locked = False
+        # Number of high priority threads waiting for the lock
+        self._waiting = 0
+
+    def __enter__(self) -> None:
+        with self._condition:
+            self._waiting += 1
+            try:
+                self._condition.wait_for(lambda: not self._locked)
+            finally:
+                self._waiting -= 1
+            self._locked = True
+
+    def __exit__(self, type, value, traceback) -> None:
+        with self._condition:
+            self._locked = False
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def low_priority(self) -> Iterator[None]:
+        with self._condition:
+            self._condition.wait_for(lambda: not self._locked and self._waiting == 0)
+            self._locked = True
+        try:
+            yield
+        finally:
+            self.__exit__(None, None, None)
+
+
+class _FileRequest:
+    """
+    Files still expected from the camera after a capture
+    """
+    __slots__ = ['remaining', 'delete_after_download', 'callback', 'defer_file', 'deadline', 'future', ]
+
+    def __init__(self, count: int, delete_after_download: bool,
+                 callback: DownloadCallback, defer_file: Optional[Callable[[str, str], bool]],
+                 timeout: float) -> None:
+        self.remaining = count
+        self.delete_after_download = delete_after_download
+        self.callback = callback
+        self.defer_file = defer_file
+        self.deadline = time.monotonic() + timeout
+        self.future: Future = Future()
+
+
 class GPhoto2Camera(Camera):
-    __slots__ = ['_target_path', '_camera', '_new_file_detected',
-                 '_must_stop', '_monitor_thread', '_camera_lock',
+    __slots__ = ['_target_path', '_port', '_camera', '_must_stop', '_camera_lock',
+                 '_event_thread', '_file_requests', '_requests_lock', '_requests_changed', '_lost_downloads',
                  '_initial_iso', '_initial_shutter_speed',
                  '_initial_aperture', '_initial_exposure_compensation',
                  '_choices_iso', '_choices_shutter_speed',
-                 '_choices_aperture', '_choices_exposure_compensation', ]
+                 '_choices_aperture', '_choices_exposure_compensation',
+                 '_model', ]
 
     TIMEOUT = 10.0
+    # Blocking wait for camera events, while files are expected. Short: the lock is held
+    # meanwhile, and the previews and settings wait for it.
+    EVENT_WAIT = 50         # milliseconds
+    # Events are only drained from time to time, when no file is expected
+    IDLE_INTERVAL = 1.0     # seconds
+    ERROR_DELAY = 1.0       # seconds
 
     CONFIG_ISO = "iso"
     CONFIG_APERTURE = "aperture"
     CONFIG_SHUTTER_SPEED = "shutterspeed"
     CONFIG_EXPOSURE_COMPENSATION = "exposurecompensation"
+    CONFIG_CAMERA_MODEL = "cameramodel"
 
-    def __init__(self, target_path: Path) -> None:
+    def __init__(self, target_path: Path, port: Optional[str] = None) -> None:
+        """
+        :param port: Port of the camera, such as "usb:001,005". By default, the first camera found.
+        """
         self._target_path = target_path
+        self._port = port
         self._camera: gp.Camera = None
 
-        self._new_file_detected = threading.Event()
         self._must_stop = threading.Event()
-        self._camera_lock = threading.Lock()
-        self._monitor_thread: Optional[threading.Thread] = None
+        # Previews and settings have priority over the event pump
+        self._camera_lock = _PriorityLock()
+        self._event_thread: Optional[threading.Thread] = None
+        self._file_requests: Deque[_FileRequest] = collections.deque()
+        self._requests_lock = threading.Lock()
+        self._requests_changed = threading.Event()
+        self._lost_downloads: List[LostDownload] = []
+        self._model: Optional[str] = None
 
         gp.use_python_logging()
 
@@ -136,46 +299,74 @@ class GPhoto2Camera(Camera):
             with self._camera_lock:
                 log.info("Init camera")
                 self._camera = gp.Camera()
+                if self._port:
+                    # Several cameras may be connected
+                    port_info_list = gp.PortInfoList()
+                    port_info_list.load()
+                    self._camera.set_port_info(port_info_list[port_info_list.lookup_path(self._port)])
                 self._camera.init()
 
             self._retrieve_config()
+
+            self._event_thread = threading.Thread(target=self._pump_events, daemon=True)
+            self._event_thread.start()
         except Exception:
             log.exception("Unable to connect to camera")
             raise CameraException("Unable to connect to camera")
 
     def take_photo(self, max_files_count: int = 1,
                    delete_after_download: bool = False,
-                   callback: Callable[[Path], None] = None):
+                   callback: DownloadCallback = None,
+                   defer_file: Callable[[str, str], bool] = None):
         if self._camera is None:
             raise Exception("Camera not connected")
 
         start_time = datetime.now()
-        self._new_file_detected.clear()
 
         with self._camera_lock:
             log.info('Capturing image')
             try:
                 file_path = self._camera.capture(gp.GP_CAPTURE_IMAGE)
-                if max_files_count >= 1:
+            except gp.GPhoto2Error as e:
+                log.exception("Unable to capture photo")
+                raise CameraException(f"Unable to capture photo: {e}") from e
+
+            # More files are expected, such as the JPEG of a RAW+JPEG pair.
+            # Registered before releasing the lock, so that the event pump can't miss them.
+            if max_files_count > 1:
+                # The first file is downloaded below
+                with self._requests_lock:
+                    self._file_requests.append(_FileRequest(
+                        max_files_count - 1, delete_after_download, callback, defer_file, self.TIMEOUT))
+                self._requests_changed.set()
+
+            if max_files_count >= 1 and _is_deferred(defer_file, file_path.folder, file_path.name):
+                log.info('Leaving file on the camera: %s/%s', file_path.folder, file_path.name)
+            elif max_files_count >= 1:
+                try:
                     self._download_file(
                         file_path.folder, file_path.name,
                         delete_after_download=delete_after_download,
                         callback=callback)
-            except:
-                log.exception("Unable to capture photo")
-                return
-
-        # Wait for more files
-        if max_files_count > 1:
-            # One file has already been downloaded
-            monitor_args = (max_files_count-1, delete_after_download, callback)
-            self._monitor_thread = threading.Thread(target=self._monitor_files,
-                                                    args=monitor_args)
-            self._monitor_thread.start()
+                except gp.GPhoto2Error as e:
+                    log.exception("Unable to download photo")
+                    raise CameraDownloadException(f"Unable to download photo: {e}",
+                                                  file_path.folder, file_path.name) from e
 
         time_elapsed = datetime.now() - start_time
         log.info('Elapsed capture time (hh:mm:ss.ms): %s', time_elapsed)
 
+    def download_file(self, folder: str, name: str, delete_after_download: bool = False,
+                      callback: DownloadCallback = None):
+        if self._camera is None:
+            raise Exception("Camera not connected")
+
+        with self._camera_lock:
+            try:
+                self._download_file(folder, name, delete_after_download, callback)
+            except gp.GPhoto2Error as e:
+                raise CameraDownloadException(f"Unable to download photo: {e}", folder, name) from e
+
     def capture_preview(self) -> Image:
         with self._camera_lock:
             capture = self._camera.capture_preview()
@@ -183,10 +374,15 @@ class GPhoto2Camera(Camera):
         return Image.open(io.BytesIO(file_data))
 
     def close(self) -> None:
+        # Let the pending files arrive
+        self._wait_file_requests(self.TIMEOUT)
+
         self._must_stop.set()
-        if self._monitor_thread is not None:
-            self._monitor_thread.join(self.TIMEOUT)
-            self._monitor_thread = None
+        self._requests_changed.set()
+        if self._event_thread is not None:
+            self._event_thread.join(self.TIMEOUT)
+            self._event_thread = None
+        self._fail_requests(CameraException("Camera closed"))
 
         if self._camera is not None:
             # Restore back the configuration of the camera
@@ -196,8 +392,49 @@ class GPhoto2Camera(Camera):
                 log.exception("Unable to restore the configuration")
 
             with self._camera_lock:
-                self._camera.exit()
-                self._camera = None
+                try:
+                    self._camera.exit()
+                except gp.GPhoto2Error:
+                    # Such as a dead USB link: the handle is dropped anyway
+                    log.exception("Unable to close the camera")
+                finally:
+                    self._camera = None
+
+    @property
+    def model(self) -> Optional[str]:
+        return self._model
+
+    @property
+    def pending_files(self) -> int:
+        with self._requests_lock:
+            return sum(r.remaining for r in self._file_requests)
+
+    def take_lost_downloads(self, timeout: float = 0) -> List[LostDownload]:
+        if timeout > 0:
+            self._wait_file_requests(timeout)
+        with self._requests_lock:
+            lost, self._lost_downloads = self._lost_downloads, []
+        return lost
+
+    def apply_settings(self, iso: Optional[str] = None, shutter_speed: Optional[str] = None,
+                       aperture: Optional[str] = None, exposure_compensation: Optional[str] = None) -> None:
+        values = {
+            self.CONFIG_ISO: iso,
+            self.CONFIG_SHUTTER_SPEED: shutter_speed,
+            self.CONFIG_APERTURE: aperture,
+            self.CONFIG_EXPOSURE_COMPENSATION: exposure_compensation,
+        }
+
+        # Single round-trip with the camera
+        try:
+            with self._camera_lock:
+                config = self._camera.get_config()
+                for name, value in values.items():
+                    if value:
+                        config.get_child_by_name(name).set_value(value)
+                self._camera.set_config(config)
+        except gp.GPhoto2Error as e:
+            raise CameraException(f"Unable to apply the camera settings: {e}")
 
     @property
     def accepted_iso(self) -> List[str]:
@@ -259,53 +496,127 @@ class GPhoto2Camera(Camera):
         self.close()
 
     def _download_file(self, folder: str, name: str, delete_after_download: bool = False,
-                       callback: Callable[[Path], None] = None):
+                       callback: DownloadCallback = None):
         log.info('Camera file path: %s/%s', folder, name)
         target_file = self._target_path / name
 
         log.info('Copying image to: %s', target_file)
         camera_file = self._camera.file_get(
             folder, name, gp.GP_FILE_TYPE_NORMAL)
-        camera_file.save(str(target_file))
+        content_hash = _save_hashed(camera_file.get_data_and_size(), target_file)
 
         if delete_after_download:
             log.info('Deleting file on camera: %s/%s', folder, name)
             self._camera.file_delete(folder, name)
 
         if callback is not None:
-            callback(target_file)
+            callback(target_file, content_hash)
+
+    def _pump_events(self) -> None:
+        """
+        Single reader of the camera events: the files added are given to the captures expecting them
+        """
+        log.info("Starting camera event pump")
+
+        while not self._must_stop.is_set():
+            with self._requests_lock:
+                is_expecting_files = bool(self._file_requests)
+            if not is_expecting_files:
+                self._requests_changed.wait(self.IDLE_INTERVAL)
+                self._requests_changed.clear()
+                if self._must_stop.is_set():
+                    break
+
+            try:
+                self._process_events(self.EVENT_WAIT if is_expecting_files else 0)
+            except Exception as e:
+                # The pump must keep running: it's the only reader of the events
+                log.exception("Unable to read camera events")
+                self._fail_requests(CameraException(f"Unable to read camera events: {e}"))
+                self._must_stop.wait(self.ERROR_DELAY)
 
-    def _monitor_files(self, files_to_download: int,
-                       delete_after_download: bool = False,
-                       callback: Callable[[Path], None] = None):
-        log.info("Starting camera monitoring")
+            self._expire_requests()
 
-        self._new_file_detected.clear()
-        timeout = 0  # miliseconds
-        should_continue = files_to_download > 0
+        log.info("Camera event pump stopped")
 
-        while should_continue and not self._must_stop.is_set():
-            try:
-                with self._camera_lock:
-                    should_continue = False
-                    log.info("Waiting for camera event")
-
-                    event_type, event_data = self._camera.wait_for_event(
-                        timeout)
-                    if event_type == gp.GP_EVENT_FILE_ADDED:
-                        self._download_file(
-                            event_data.folder, event_data.name,
-                            delete_after_download=delete_after_download,
-                            callback=callback)
-                        files_to_download -= 1
-                        should_continue = files_to_download > 0
-                    elif event_type == gp.GP_EVENT_FOLDER_ADDED:
-                        should_continue = True
-
-            except KeyboardInterrupt:
+    def _process_events(self, timeout: int) -> None:
+        with self._camera_lock.low_priority():
+            if self._camera is None:
                 return
 
+            # Drain all the queued events, the last wait is the blocking one
+            event_type = None
+            while event_type != gp.GP_EVENT_TIMEOUT and not self._must_stop.is_set():
+                event_type, event_data = self._camera.wait_for_event(timeout)
+                if event_type == gp.GP_EVENT_FILE_ADDED:
+                    self._dispatch_file(event_data.folder, event_data.name)
+                    # Give a chance to previews between files
+                    return
+
+    def _dispatch_file(self, folder: str, name: str) -> None:
+        with self._requests_lock:
+            request = self._file_requests[0] if self._file_requests else None
+        if request is None:
+            log.warning("Ignoring unexpected camera file: %s/%s", folder, name)
+            return
+
+        try:
+            if _is_deferred(request.defer_file, folder, name):
+                log.info('Leaving file on the camera: %s/%s', folder, name)
+            else:
+                self._download_file(folder, name, request.delete_after_download, request.callback)
+            request.remaining -= 1
+            is_done = request.remaining <= 0
+            if is_done:
+                request.future.set_result(None)
+        except Exception as e:
+            # Such as a full storage, or an error of the callback
+            log.exception("Unable to download photo: %s/%s", folder, name)
+            with self._requests_lock:
+                self._lost_downloads.append(LostDownload(folder, name, request.delete_after_download,
+                                                         request.callback))
+            error = CameraDownloadException(f"Unable to download photo: {e}", folder, name)
+            error.__cause__ = e
+            request.future.set_exception(error)
+            is_done = True
+
+        if is_done:
+            with self._requests_lock:
+                self._file_requests.remove(request)
+
+    def _expire_requests(self) -> None:
+        now = time.monotonic()
+        with self._requests_lock:
+            expired = [r for r in self._file_requests if r.deadline < now]
+            for r in expired:
+                self._file_requests.remove(r)
+
+        for r in expired:
+            log.warning("Camera files not received: %s", r.remaining)
+            r.future.set_exception(CameraException(f"{r.remaining} files not received"))
+
+    def _fail_requests(self, error: CameraException) -> None:
+        with self._requests_lock:
+            failed = list(self._file_requests)
+            self._file_requests.clear()
+
+        for r in failed:
+            log.warning("Camera files lost: %s", r.remaining)
+            r.future.set_exception(error)
+
+    def _wait_file_requests(self, timeout: float) -> None:
+        with self._requests_lock:
+            pending = [r.future for r in self._file_requests]
+        futures.wait(pending, timeout=timeout)
+
     def _retrieve_config(self) -> None:
+        try:
+            with self._camera_lock:
+                self._model = self._camera.get_single_config(self.CONFIG_CAMERA_MODEL).get_value()
+        except gp.GPhoto2Error:
+            log.warning("Unable to retrieve the camera model")
+            self._model = None
+
         self._initial_iso, self._choices_iso = self._retrieve_radio_config(self.CONFIG_ISO)
         self._initial_aperture, self._choices_aperture = self._retrieve_radio_config(self.CONFIG_APERTURE)
         self._initial_shutter_speed, self._choices_shutter_speed = self._retrieve_radio_config(self.CONFIG_SHUTTER_SPEED)
@@ -348,7 +659,7 @@ class GPhoto2Camera(Camera):
 
 
 class FakeCamera(Camera):
-    def __init__(self, target_path: Path) -> None:
+    def __init__(self, target_path: Path, port: Optional[str] = None) -> None:
         pass
 
     def connect(self):
@@ -363,6 +674,10 @@ class FakeCamera(Camera):
     def close(self):
         pass
 
+    @property
+    def model(self) -> Optional[str]:
+        return 'Dry-run'
+
     @property
     def accepted_iso(self) -> List[str]:
         return ['100']
@@ -412,6 +727,10 @@ class FakeCamera(Camera):
         pass
 
 
+def _is_deferred(defer_file: Optional[Callable[[str, str], bool]], folder: str, name: str) -> bool:
+    return defer_file is not None and defer_file(folder, name)
+
+
 def get_camera_type(dry_run: bool) -> Type[Camera]:
     if dry_run:
         return FakeCamera
@@ -0,0 +1,261 @@
+"""
+Supervision of the camera connection.
+Errors of the USB link are retried: the camera is reconnected with a bounded
+backoff, its settings are applied again, then the interrupted operation is
+retried. A photo already taken is only downloaded again, never taken twice.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import gphoto2 as gp
+from PIL import Image
+
+from scanner.hardware.camera import Camera, CameraDownloadException, CameraException, DownloadCallback
+
+log = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+# Wait for the files still expected before closing
+CLOSE_WAIT = 10.0       # seconds
+BACKOFF_INITIAL = 1.0   # seconds
+BACKOFF_MAX = 16.0      # seconds
+
+ERROR_RETRY = "retry"
+ERROR_RECONNECT = "reconnect"
+ERROR_FATAL = "fatal"
+
+# The camera is busy: wait and try again
+_BUSY_ERRORS = {
+    gp.GP_ERROR_CAMERA_BUSY,
+}
+# The USB link is broken: reconnect
+_CONNECTION_ERRORS = {
+    gp.GP_ERROR_IO,
+    gp.GP_ERROR_IO_INIT,
+    gp.GP_ERROR_IO_READ,
+    gp.GP_ERROR_IO_WRITE,
+    gp.GP_ERROR_IO_UPDATE,
+    gp.GP_ERROR_IO_USB_CLEAR_HALT,
+    gp.GP_ERROR_IO_USB_CLAIM,
+    gp.GP_ERROR_IO_USB_FIND,
+    gp.GP_ERROR_IO_LOCK,
+    gp.GP_ERROR_TIMEOUT,
+    gp.GP_ERROR_CORRUPTED_DATA,
+    gp.GP_ERROR_MODEL_NOT_FOUND,
+    gp.GP_ERROR_CAMERA_ERROR,
+    gp.GP_ERROR_UNKNOWN_PORT,
+}
+
+
+def classify_error(error: BaseException) -> str:
+    """
+    What to do after the error, based on the underlying gphoto2 error
+    """
+    e: Optional[BaseException] = error
+    while e is not None:
+        if isinstance(e, gp.GPhoto2Error):
+            if e.code in _BUSY_ERRORS:
+                return ERROR_RETRY
+            if e.code in _CONNECTION_ERRORS:
+                return ERROR_RECONNECT
+            return ERROR_FATAL
+        e = e.__cause__ or e.__context__
+    return ERROR_FATAL
+
+
+class SupervisedCamera(Camera):
+    __slots__ = ['_camera', '_settings', '_lock', '_counters', '_last_error', ]
+
+    def __init__(self, the_camera: Camera) -> None:
+        self._camera = the_camera
+        # Settings to apply again after reconnecting
+        self._settings: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._counters = {
+            "errors": 0,
+            "retries": 0,
+            "reconnections": 0,
+            "failures": 0,
+        }
+        self._last_error: Optional[str] = None
+
+    def statistics(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._counters, last_error=self._last_error)
+
+    def connect(self):
+        self._supervise("connect", self._camera.connect, reconnect=False)
+        # The camera is back to its initial settings
+        with self._lock:
+            self._settings.clear()
+
+    def take_photo(self, max_files_count: int = 1,
+                   delete_after_download: bool = False,
+                   callback: DownloadCallback = None,
+                   defer_file: Callable[[str, str], bool] = None):
+        self._retry_lost_downloads()
+        taken_file: Optional[CameraDownloadException] = None
+
+        def take_photo():
+            nonlocal taken_file
+            try:
+                if taken_file is None:
+                    self._camera.take_photo(max_files_count, delete_after_download, callback, defer_file)
+                else:
+                    log.info("Downloading again: %s/%s", taken_file.folder, taken_file.name)
+                    self._camera.download_file(taken_file.folder, taken_file.name,
+                                               delete_after_download, callback)
+            except CameraDownloadException as e:
+                taken_file = e
+                raise
+
+        self._supervise("take_photo", take_photo)
+
+    def download_file(self, folder: str, name: str, delete_after_download: bool = False,
+                      callback: DownloadCallback = None):
+        self._supervise("download_file", lambda: self._camera.download_file(
+            folder, name, delete_after_download, callback))
+
+    def capture_preview(self) -> Image:
+        return self._supervise("capture_preview", self._camera.capture_preview)
+
+    def close(self):
+        self._retry_lost_downloads(CLOSE_WAIT)
+        self._camera.close()
+
+    def apply_settings(self, iso: Optional[str] = None, shutter_speed: Optional[str] = None,
+                       aperture: Optional[str] = None, exposure_compensation: Optional[str] = None) -> None:
+        values = {
+            "iso": iso,
+            "shutter_speed": shutter_speed,
+            "aperture": aperture,
+            "exposure_compensation": exposure_compensation,
+        }
+        values = {k: v for k, v in values.items() if v}
+        self._supervise("apply_settings", lambda: self._camera.apply_settings(**values))
+        with self._lock:
+            self._settings.update(values)
+
+    @property
+    def model(self) -> Optional[str]:
+        return self._camera.model
+
+    @property
+    def pending_files(self) -> int:
+        return self._camera.pending_files
+
+    @property
+    def accepted_iso(self) -> List[str]:
+        return self._camera.accepted_iso
+
+    @property
+    def accepted_shutter_speed(self) -> List[str]:
+        return self._camera.accepted_shutter_speed
+
+    @property
+    def accepted_aperture(self) -> List[str]:
+        return self._camera.accepted_aperture
+
+    @property
+    def accepted_exposure_compensation(self) -> List[str]:
+        return self._camera.accepted_exposure_compensation
+
+    @property
+    def iso(self) -> str:
+        return self._get("iso")
+
+    @iso.setter
+    def iso(self, val) -> None:
+        self._set("iso", val)
+
+    @property
+    def shutter_speed(self) -> str:
+        return self._get("shutter_speed")
+
+    @shutter_speed.setter
+    def shutter_speed(self, val) -> None:
+        self._set("shutter_speed", val)
+
+    @property
+    def aperture(self) -> str:
+        return self._get("aperture")
+
+    @aperture.setter
+    def aperture(self, val) -> None:
+        self._set("aperture", val)
+
+    @property
+    def exposure_compensation(self) -> str:
+        return self._get("exposure_compensation")
+
+    @exposure_compensation.setter
+    def exposure_compensation(self, val) -> None:
+        self._set("exposure_compensation", val)
+
+    def _get(self, name: str) -> str:
+        return self._supervise(name, lambda: getattr(self._camera, name))
+
+    def _set(self, name: str, val) -> None:
+        self._supervise(name, lambda: setattr(self._camera, name, val))
+        with self._lock:
+            if val:
+                self._settings[name] = val
+            else:
+                # Back to the initial value of the camera
+                self._settings.pop(name, None)
+
+    def _supervise(self, operation: str, func: Callable[[], Any], reconnect: bool = True) -> Any:
+        delay = BACKOFF_INITIAL
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                return func()
+            except Exception as e:
+                kind = classify_error(e)
+                message = e.message if isinstance(e, CameraException) else str(e)
+                with self._lock:
+                    self._counters["errors"] += 1
+                    self._last_error = f"{operation}: {message}"
+
+                if kind == ERROR_FATAL or attempt == MAX_ATTEMPTS:
+                    with self._lock:
+                        self._counters["failures"] += 1
+                    log.error("Camera %s failed after %s attempts: %s", operation, attempt, message)
+                    raise
+
+                log.warning("Camera %s failed (%s), retrying in %ss: %s", operation, kind, delay, message)
+                time.sleep(delay)
+                delay = min(delay * 2, BACKOFF_MAX)
+
+                with self._lock:
+                    self._counters["retries"] += 1
+                if kind == ERROR_RECONNECT and reconnect:
+                    self._reconnect()
+
+    def _retry_lost_downloads(self, timeout: float = 0) -> None:
+        """
+        Files of the previous photos which the camera failed to download in the background
+        """
+        for lost in self._camera.take_lost_downloads(timeout):
+            log.info("Downloading again: %s/%s", lost.folder, lost.name)
+            try:
+                self.download_file(lost.folder, lost.name, lost.delete_after_download, lost.callback)
+            except Exception:
+                # Already counted as a failure: the next photos go on
+                log.exception("Camera file lost: %s/%s", lost.folder, lost.name)
+
+    def _reconnect(self) -> None:
+        try:
+            self._camera.connect()
+            with self._lock:
+                settings = dict(self._settings)
+            if settings:
+                self._camera.apply_settings(**settings)
+            with self._lock:
+                self._counters["reconnections"] += 1
+            log.info("Camera reconnected")
+        except CameraException as e:
+            # Next attempt will tell
+            log.warning("Unable to reconnect to the camera: %s", e.message)
@@ -1,14 +1,148 @@
-from typing import Tuple
+import collections
+import logging
+import threading
+import time
+from typing import Deque, NamedTuple, Optional, Tuple
 
 import adafruit_tsl2561
 import busio
 
+log = logging.getLogger(__name__)
+
+# TSL2561 integration time setting => duration in seconds
+INTEGRATION_TIMES = {
+    0: 0.0137,
+    1: 0.101,
+    2: 0.402,
+}
+# Maximum value of the channels, for each integration time
+SATURATION = {
+    0: 5047,
+    1: 37177,
+    2: 65535,
+}
+GAINS = (0, 1)  # 1x, 16x
+
+# Below this, the holes can't be told apart from the film
+MIN_USABLE_COUNT = 50
+RING_BUFFER_SIZE = 256
+
 
 class LuxMeter:
     def __init__(self, i2c: busio.I2C, gain: int=0, integration_time: int=1):
         self._sensor = adafruit_tsl2561.TSL2561(i2c)
+        self.configure(gain, integration_time)
+
+    def configure(self, gain: int, integration_time: int) -> None:
         self._sensor.gain = gain
         self._sensor.integration_time = integration_time
 
+    @property
+    def gain(self) -> int:
+        return self._sensor.gain
+
+    @property
+    def integration_time(self) -> int:
+        return self._sensor.integration_time
+
     def measure(self) -> Tuple[int, int]:
         return self._sensor.luminosity
+
+
+class LuxSample(NamedTuple):
+    time: float     # time.monotonic()
+    visible: int
+    infrared: int
+
+
+class LuxSampler:
+    """
+    Reads the lux meter continuously on its own thread.
+    Readers never wait for the I2C bus: they get the latest sample of a ring buffer.
+    """
+    __slots__ = ['_lux_meter', '_gain', '_integration_time', '_samples',
+                 '_is_sampling', '_must_stop', '_thread', '_is_configured', '_period', ]
+
+    def __init__(self, lux_meter: LuxMeter, gain: Optional[int] = None,
+                 integration_time: Optional[int] = None) -> None:
+        """
+        :param gain: None to select it automatically
+        :param integration_time: None to select the fastest one giving a usable signal
+        """
+        self._lux_meter = lux_meter
+        self._gain = gain
+        self._integration_time = integration_time
+        self._is_configured = False
+        self._period = INTEGRATION_TIMES[2]
+        # Appending and reading the last item of a deque is atomic: no lock needed
+        self._samples: Deque[LuxSample] = collections.deque(maxlen=RING_BUFFER_SIZE)
+        self._is_sampling = threading.Event()
+        self._must_stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def start(self) -> None:
+        """
+        Start sampling. The light must be on, in case the configuration is automatic.
+        """
+        if not self._is_configured:
+            self._configure()
+            self._is_configured = True
+        self._samples.clear()
+        self._is_sampling.set()
+
+    def pause(self) -> None:
+        self._is_sampling.clear()
+
+    def close(self) -> None:
+        self._must_stop.set()
+        self._is_sampling.set()
+        self._thread.join()
+
+    def latest(self) -> Optional[LuxSample]:
+        try:
+            return self._samples[-1]
+        except IndexError:
+            return None
+
+    def _sample(self) -> None:
+        while not self._must_stop.is_set():
+            self._is_sampling.wait()
+
+            # The sensor integrates continuously: reading faster returns the same values
+            time.sleep(self._period)
+            if self._must_stop.is_set() or not self._is_sampling.is_set():
+                continue
+
+            try:
+                visible, infrared = self._lux_meter.measure()
+                self._samples.append(LuxSample(time.monotonic(), visible, infrared))
+            except Exception:
+                log.exception("Unable to read the lux meter")
+
+    def _configure(self) -> None:
+        gains = GAINS if self._gain is None else (self._gain, )
+        integration_times = sorted(INTEGRATION_TIMES.keys()) if self._integration_time is None \
+            else (self._integration_time, )
+
+        if len(gains) == 1 and len(integration_times) == 1:
+            self._lux_meter.configure(gains[0], integration_times[0])
+            self._period = INTEGRATION_TIMES[integration_times[0]]
+            return
+
+        # Fastest first, then the lowest gain
+        for integration_time in integration_times:
+            for gain in gains:
+                self._lux_meter.configure(gain, integration_time)
+                self._period = INTEGRATION_TIMES[integration_time]
+                # First reading after a change may belong to the previous setting
+                time.sleep(2 * INTEGRATION_TIMES[integration_time])
+                visible, _ = self._lux_meter.measure()
+
+                if MIN_USABLE_COUNT <= visible < 0.9 * SATURATION[integration_time]:
+                    log.info("Lux meter: gain %s, integration time %s (%s counts)",
+                             gain, integration_time, visible)
+                    return
+
+        log.warning("No lux meter setting gives a usable signal, using: gain %s, integration time %s",
+                    gain, integration_time)
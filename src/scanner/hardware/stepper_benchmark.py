@@ -0,0 +1,77 @@
+"""
+Benchmark of the coil writes of the stepper motor backends, without delay between the steps.
+Without lgpio (or outside of a Raspberry Pi), it runs on the gpiozero mock pins.
+
+Usage: python -m scanner.hardware.stepper_benchmark --steps 2000
+"""
+
+import argparse
+import logging
+import time
+from typing import Callable, Dict
+
+from gpiozero import Device, OutputDevice
+from gpiozero.pins.mock import MockFactory
+
+from scanner.hardware import stepper_motor
+
+log = logging.getLogger(__name__)
+
+DEFAULT_STEPS = 2000
+PINS = (5, 6, 13, 19)
+
+
+def measure(name: str, rotate: Callable[[int], None], steps: int) -> float:
+    start_time = time.perf_counter()
+    rotate(steps)
+    elapsed = time.perf_counter() - start_time
+
+    # Each step is a full sequence of half-steps
+    steps_per_second = steps * len(stepper_motor.StepperMotor._seq) / elapsed
+    print(f"{name:>22}: {steps_per_second:12.0f} half-steps/s")
+    return steps_per_second
+
+
+def benchmark(steps: int, use_mock: bool) -> Dict[str, float]:
+    if use_mock:
+        Device.pin_factory = MockFactory()
+
+    results = {}
+
+    # Previous implementation: the 4 coils written at each half-step
+    devices = [OutputDevice(p) for p in PINS]
+
+    def rotate_unbatched(count: int) -> None:
+        for _ in range(count):
+            for pattern in stepper_motor.StepperMotor._seq:
+                for d, value in zip(devices, pattern):
+                    d.value = value
+
+    results["unbatched"] = measure("unbatched (4 writes)", rotate_unbatched, steps)
+    for d in devices:
+        d.close()
+
+    backends = [stepper_motor.BACKEND_GPIOZERO]
+    if stepper_motor.lgpio is not None and not use_mock:
+        backends.append(stepper_motor.BACKEND_LGPIO)
+
+    for backend in backends:
+        with stepper_motor.StepperMotor(*PINS, backend=backend) as motor:
+            # No delay: only the coil writes are measured
+            results[backend] = measure(backend, lambda count: motor.forward(0, count), steps)
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Stepper motor backend benchmark")
+    parser.add_argument('--steps', default=DEFAULT_STEPS, type=int, help='Number of steps per backend')
+    parser.add_argument('--hardware', action='store_true', help='Use the real GPIO pins instead of mock pins')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    benchmark(args.steps, use_mock=not args.hardware)
+
+
+if __name__ == "__main__":
+    main()
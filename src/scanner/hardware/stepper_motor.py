@@ -1,12 +1,71 @@
+import logging
 import time
+from typing import List, Optional, Sequence
 
 from gpiozero import OutputDevice
+try:
+    import lgpio    # Writes all the coils at once
+except ImportError:
+    lgpio = None
+
+log = logging.getLogger(__name__)
+
+BACKEND_AUTO = "auto"
+BACKEND_LGPIO = "lgpio"
+BACKEND_GPIOZERO = "gpiozero"
+
+GPIO_CHIP = 0
+
+
+class _GpiozeroCoils:
+    """
+    One gpiozero device per coil. Only the coils which change are written.
+    """
+    __slots__ = ['_devices', '_state', ]
+
+    def __init__(self, pins: Sequence[int]) -> None:
+        self._devices = [OutputDevice(p) for p in pins]
+        self._state: List[Optional[int]] = [None] * len(pins)
+
+    def write(self, pattern: Sequence[int]) -> None:
+        for i, value in enumerate(pattern):
+            if self._state[i] != value:
+                self._devices[i].value = value
+                self._state[i] = value
+
+    def close(self) -> None:
+        for d in self._devices:
+            d.close()
+
+
+class _LgpioCoils:
+    """
+    All the coils are written in a single group write
+    """
+    __slots__ = ['_handle', '_pins', '_mask', ]
+
+    def __init__(self, pins: Sequence[int]) -> None:
+        self._pins = list(pins)
+        self._mask = (1 << len(self._pins)) - 1
+        self._handle = lgpio.gpiochip_open(GPIO_CHIP)
+        try:
+            lgpio.group_claim_output(self._handle, self._pins)
+        except lgpio.error:
+            lgpio.gpiochip_close(self._handle)
+            raise
+
+    def write(self, bits: int) -> None:
+        lgpio.group_write(self._handle, self._pins[0], bits, self._mask)
+
+    def close(self) -> None:
+        lgpio.group_free(self._handle, self._pins[0])
+        lgpio.gpiochip_close(self._handle)
 
 
 class StepperMotor:
-    __slots__ = ['_coil_A_1_pin', '_coil_A_2_pin', '_coil_B_1_pin', '_coil_B_2_pin', ]
+    __slots__ = ['_coils', '_sequence', '_off', '_backend', ]
 
-    # This is comming from: http://www.raspberrypi-spy.co.uk/2012/07/stepper-motor-control-in-python/    
+    # This is comming from: http://www.raspberrypi-spy.co.uk/2012/07/stepper-motor-control-in-python/
     _seq = [[1,0,0,1],
             [1,0,0,0],
             [1,1,0,0],
@@ -16,11 +75,36 @@ class StepperMotor:
             [0,0,1,1],
             [0,0,0,1]]
 
-    def __init__(self, coil_A_1_pin: int, coil_A_2_pin: int, coil_B_1_pin: int, coil_B_2_pin: int) -> None:
-        self._coil_A_1_pin = OutputDevice(coil_A_1_pin)
-        self._coil_A_2_pin = OutputDevice(coil_A_2_pin)
-        self._coil_B_1_pin = OutputDevice(coil_B_1_pin)
-        self._coil_B_2_pin = OutputDevice(coil_B_2_pin)
+    def __init__(self, coil_A_1_pin: int, coil_A_2_pin: int, coil_B_1_pin: int, coil_B_2_pin: int,
+                 backend: str = BACKEND_AUTO) -> None:
+        pins = [coil_A_1_pin, coil_A_2_pin, coil_B_1_pin, coil_B_2_pin]
+
+        self._coils = None
+        if backend in (BACKEND_AUTO, BACKEND_LGPIO) and lgpio is not None:
+            try:
+                self._coils = _LgpioCoils(pins)
+                self._backend = BACKEND_LGPIO
+                # Precomputed group values: bit N is the coil N
+                self._sequence = [_to_bits(p) for p in self._seq]
+                self._off = 0
+            except lgpio.error:
+                if backend == BACKEND_LGPIO:
+                    raise
+                log.warning("Unable to use lgpio, falling back to gpiozero", exc_info=True)
+        elif backend == BACKEND_LGPIO:
+            raise RuntimeError("lgpio is not available")
+
+        if self._coils is None:
+            self._coils = _GpiozeroCoils(pins)
+            self._backend = BACKEND_GPIOZERO
+            self._sequence = self._seq
+            self._off = [0, 0, 0, 0]
+
+        log.info("Stepper motor backend: %s", self._backend)
+
+    @property
+    def backend(self) -> str:
+        return self._backend
 
     def rotate(self, delay: float, steps: int) -> None:
         if steps >= 0:
@@ -29,35 +113,33 @@ class StepperMotor:
             self.backwards(delay, abs(steps))
 
     def forward(self, delay: float, steps: int) -> None:
-        for i in range(steps):
-            for pattern in self._seq:
-                self._set_step(*pattern)
-                time.sleep(delay)
- 
-    def backwards(self, delay: float, steps: int) -> None:  
-        for i in range(steps):
-            for pattern in reversed(self._seq):
-                self._set_step(*pattern)
-                time.sleep(delay)
-    
+        self._run(self._sequence, delay, steps)
+
+    def backwards(self, delay: float, steps: int) -> None:
+        self._run(self._sequence[::-1], delay, steps)
+
     def stop(self) -> None:
-        self._set_step(0, 0, 0, 0)
+        self._coils.write(self._off)
 
     def release(self) -> None:
         self.stop()
-        self._coil_A_1_pin.close()
-        self._coil_A_2_pin.close()
-        self._coil_B_1_pin.close()
-        self._coil_B_2_pin.close()
+        self._coils.close()
 
-    def _set_step(self, w1: int, w2: int, w3: int, w4: int) -> None:
-        self._coil_A_1_pin.value = w1
-        self._coil_A_2_pin.value = w2
-        self._coil_B_1_pin.value = w3
-        self._coil_B_2_pin.value = w4
+    def _run(self, sequence: list, delay: float, steps: int) -> None:
+        write = self._coils.write
+        for i in range(steps):
+            for pattern in sequence:
+                write(pattern)
+                # No system call without delay
+                if delay > 0:
+                    time.sleep(delay)
 
     def __enter__(self) -> "StepperMotor":
         return self
 
     def __exit__(self, type, value, traceback):
         self.release()
+
+
+def _to_bits(pattern: Sequence[int]) -> int:
+    return sum(value << i for i, value in enumerate(pattern))
@@ -2,11 +2,12 @@ import collections
 import logging
 import time
 from datetime import datetime
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import board
 import busio
 
+from . import resources, trace
 from .scanner_device import BacklightedScanner, CanSkipHoles, PhotoInfo
 from .hardware import stepper_motor, lux_meter, led
 
@@ -20,7 +21,7 @@ DIRECTION = -1
 
 
 class HoleCounterScanner(BacklightedScanner, CanSkipHoles):
-    def __init__(self, led_pin: int, led_use_infrared: bool, backlight_pin: int, stepper_pin_1: int, stepper_pin_2: int, stepper_pin_3: int, stepper_pin_4: int) -> None:
+    def __init__(self, led_pin: int, led_use_infrared: bool, backlight_pin: int, stepper_pin_1: int, stepper_pin_2: int, stepper_pin_3: int, stepper_pin_4: int, lux_gain: Optional[int] = None, lux_integration_time: Optional[int] = None) -> None:
         super().__init__(backlight_pin)
 
         # Hardware devices
@@ -30,43 +31,65 @@ class HoleCounterScanner(BacklightedScanner, CanSkipHoles):
 
         i2c = busio.I2C(board.SCL, board.SDA)
         self.lux_meter_device = lux_meter.LuxMeter(i2c)
+        self.lux_gain = lux_gain
+        self.lux_integration_time = lux_integration_time
+        # The motor loop never waits for the I2C bus. Sampling thread only during the sessions.
+        self.lux_sampler: Optional[lux_meter.LuxSampler] = None
         self.recent_lux: collections.deque = collections.deque(
             maxlen=BUFFER_LEN)
         self.led_use_infrared = led_use_infrared
 
     def _scroll_through_holes(self):
-        number_of_steps = 0
-        current_hole = 0
-        had_a_minimum = False
+        # Closed by stop_session(), maybe while scrolling
+        sampler = self.lux_sampler
+        if sampler is None:
+            raise RuntimeError("Session not started")
 
         with self.led_device:
-            while True:
-                if self.must_stop.is_set():
-                    return
-
-                number_of_steps += 1
-                self.stepper_device.rotate(SLEEP_TIME, DIRECTION * 1)
-                visible_lux, ir_lux = self.lux_meter_device.measure()
-                measured = ir_lux if self.led_use_infrared else visible_lux
-                self.recent_lux.appendleft(measured)
-                is_finished, is_new_hole, is_minimum = self._interpret_lux(
-                    list(self.recent_lux), had_a_minimum)
-
-                if is_finished:
-                    log.info("No more holes")
-                    self.recent_lux.clear()
-                    return
+            sampler.start()
+            try:
+                yield from self._scroll_with_sampler(sampler)
+            finally:
+                sampler.pause()
 
-                if is_minimum:
-                    had_a_minimum = True
-
-                # Logging several data
-                log.info("%s: %s, %s", number_of_steps, visible_lux, ir_lux)
-
-                if is_new_hole:
-                    had_a_minimum = False
-                    current_hole += 1
-                    yield current_hole
+    def _scroll_with_sampler(self, sampler: lux_meter.LuxSampler):
+        number_of_steps = 0
+        current_hole = 0
+        had_a_minimum = False
+        last_sample_time = 0.0
+
+        while True:
+            if self.must_stop.is_set():
+                return
+
+            number_of_steps += 1
+            self.stepper_device.rotate(SLEEP_TIME, DIRECTION * 1)
+            sample = sampler.latest()
+            if sample is None or sample.time <= last_sample_time:
+                # No new measure since the previous step
+                continue
+            last_sample_time = sample.time
+            visible_lux, ir_lux = sample.visible, sample.infrared
+            measured = ir_lux if self.led_use_infrared else visible_lux
+            self.recent_lux.appendleft(measured)
+            is_finished, is_new_hole, is_minimum = self._interpret_lux(
+                list(self.recent_lux), had_a_minimum)
+
+            if is_finished:
+                log.info("No more holes")
+                self.recent_lux.clear()
+                return
+
+            if is_minimum:
+                had_a_minimum = True
+
+            # Per-step data: traced rather than logged
+            trace.record("lux", steps=number_of_steps, visible=visible_lux, infrared=ir_lux)
+
+            if is_new_hole:
+                had_a_minimum = False
+                current_hole += 1
+                yield current_hole
 
     def _interpret_lux(self, measures: List[int], had_a_minimum: bool) -> Tuple[bool, bool, bool]:
 
@@ -98,6 +121,8 @@ class HoleCounterScanner(BacklightedScanner, CanSkipHoles):
         started = super().start_session()
         if started:
             self.recent_lux.clear()
+            self.lux_sampler = lux_meter.LuxSampler(
+                self.lux_meter_device, self.lux_gain, self.lux_integration_time)
 
         return started
 
@@ -106,6 +131,9 @@ class HoleCounterScanner(BacklightedScanner, CanSkipHoles):
         if stopped:
             self.stepper_device.stop()
             self.led_device.off()
+            if self.lux_sampler is not None:
+                self.lux_sampler.close()
+                self.lux_sampler = None
 
         return stopped
 
@@ -129,6 +157,10 @@ class HoleCounterScanner(BacklightedScanner, CanSkipHoles):
 
         def capture(photo_index):
             nonlocal count
+            # Wait for the storage and the tagging queue, between two photos
+            resources.throttle(self.must_stop)
+            if self.must_stop.is_set():
+                return
             count += 1
             self.led_device.off()
             time.sleep(0.5)     # Wait 1/2s in order to stabilize
@@ -159,7 +191,7 @@ class HoleCounterScanner(BacklightedScanner, CanSkipHoles):
     def _scroll_through_photos(self):
         current_photo = 0
         for i in self._scroll_through_holes():
-            log.info("Holes remaing: %s", i % HOLES_PER_PHOTO)
+            trace.record("hole", hole=i, remaining=i % HOLES_PER_PHOTO)
             if i % HOLES_PER_PHOTO == 0:
                 yield current_photo
                 current_photo += 1
@@ -0,0 +1,233 @@
+"""
+Append-only journal of the scanning sessions, used to recover after a crash.
+Each line is a JSON record of an event.
+"""
+
+from dataclasses import dataclass, field
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from scanner.frame_counter import FrameCounter
+from scanner.metadata import MetaData
+
+log = logging.getLogger(__name__)
+
+EVENT_SESSION_START = "session_start"
+EVENT_CAPTURED = "captured"
+EVENT_DOWNLOADED = "downloaded"
+EVENT_TAGGED = "tagged"
+EVENT_MOVED = "moved"
+# Left on the camera card during the scan, then downloaded
+EVENT_DEFERRED = "deferred"
+EVENT_TRANSFERRED = "transferred"
+EVENT_SESSION_END = "session_end"
+
+# Records are synced to the disk by batches
+FSYNC_BATCH_SIZE = 32
+FSYNC_INTERVAL = 1.0    # seconds
+
+
+@dataclass
+class PendingFile:
+    file: pathlib.Path
+    destination: pathlib.Path
+    metadata: Optional[MetaData]
+    session: Optional[int] = None
+    tagged: bool = False
+    content_hash: Optional[str] = None
+
+
+@dataclass
+class PendingDeferredFile:
+    device: str
+    folder: str
+    name: str
+    destination: pathlib.Path
+    metadata: Optional[MetaData]
+    session: Optional[int] = None
+
+
+@dataclass
+class RecoveryState:
+    pending_files: List[PendingFile] = field(default_factory=list)
+    # Still on the camera cards
+    deferred_files: List[PendingDeferredFile] = field(default_factory=list)
+    # Session interrupted by the crash, if any
+    session_id: Optional[int] = None
+    session_settings: Optional[Dict[str, Any]] = None
+    next_frame: Optional[FrameCounter] = None
+
+
+class Journal:
+    __slots__ = ['_file', '_lock', '_unsynced', '_must_stop', '_flush_thread', ]
+
+    def __init__(self, journal_file: pathlib.Path) -> None:
+        self._file = open(journal_file, 'a')
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._must_stop = threading.Event()
+        self._flush_thread = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flush_thread.start()
+
+    def record(self, event: str, **data) -> None:
+        line = json.dumps({"event": event, "time": time.time(), **data})
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= FSYNC_BATCH_SIZE:
+                self._sync()
+
+    def close(self) -> None:
+        self._must_stop.set()
+        self._flush_thread.join()
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    def _flush_periodically(self) -> None:
+        while not self._must_stop.wait(FSYNC_INTERVAL):
+            with self._lock:
+                if self._unsynced:
+                    self._sync()
+
+    def _sync(self) -> None:
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+
+_journal: Optional[Journal] = None
+
+
+def init_journal(journal_filename: str) -> RecoveryState:
+    """
+    Open the journal and return what was left unfinished by the previous run
+    """
+    global _journal
+
+    journal_file = pathlib.Path(journal_filename)
+    records = _read_records(journal_file)
+    state = _replay(records)
+
+    # Compact: only keep what is still unfinished
+    tmp_file = journal_file.with_name(journal_file.name + ".tmp")
+    with open(tmp_file, 'w') as f:
+        for r in _unfinished_records(records):
+            f.write(json.dumps(r) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, journal_file)
+
+    _journal = Journal(journal_file)
+    log.info("Journal recovery: %s pending files, %s files on the camera, next frame: %s",
+             len(state.pending_files), len(state.deferred_files), state.next_frame)
+    return state
+
+
+def record(event: str, **data) -> None:
+    if _journal is not None:
+        _journal.record(event, **data)
+
+
+def close_journal() -> None:
+    global _journal
+    if _journal is not None:
+        _journal.close()
+        _journal = None
+
+
+def _read_records(journal_file: pathlib.Path) -> List[Dict[str, Any]]:
+    records = []
+    try:
+        with open(journal_file, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # The last line might be truncated by the crash
+                    log.warning("Ignoring corrupted journal record: %s", line)
+    except FileNotFoundError:
+        log.info("Journal file not found")
+    return records
+
+
+def _replay(records: List[Dict[str, Any]]) -> RecoveryState:
+    state = RecoveryState()
+    sessions: Dict[int, Dict[str, Any]] = {}
+    last_frames: Dict[int, Optional[int]] = {}
+    files: Dict[str, PendingFile] = {}
+    deferred_files: Dict[str, PendingDeferredFile] = {}
+
+    for r in records:
+        event = r.get("event")
+        if event == EVENT_SESSION_START:
+            sessions[r["session"]] = r["settings"]
+        elif event == EVENT_SESSION_END:
+            sessions.pop(r["session"], None)
+            last_frames.pop(r["session"], None)
+        elif event == EVENT_CAPTURED:
+            last_frames[r["session"]] = r.get("frame")
+        elif event == EVENT_DOWNLOADED:
+            mdata = r.get("metadata")
+            files[r["file"]] = PendingFile(
+                file=pathlib.Path(r["file"]),
+                destination=pathlib.Path(r["destination"]),
+                metadata=MetaData.from_dict(mdata) if mdata is not None else None,
+                session=r.get("session"),
+                content_hash=r.get("content_hash"))
+        elif event == EVENT_TAGGED:
+            if r["file"] in files:
+                files[r["file"]].tagged = True
+        elif event == EVENT_MOVED:
+            files.pop(r["file"], None)
+        elif event == EVENT_DEFERRED:
+            mdata = r.get("metadata")
+            deferred_files[_camera_file(r)] = PendingDeferredFile(
+                device=r["device"],
+                folder=r["folder"],
+                name=r["name"],
+                destination=pathlib.Path(r["destination"]),
+                metadata=MetaData.from_dict(mdata) if mdata is not None else None,
+                session=r.get("session"))
+        elif event == EVENT_TRANSFERRED:
+            deferred_files.pop(_camera_file(r), None)
+
+    state.pending_files = list(files.values())
+    state.deferred_files = list(deferred_files.values())
+
+    # Only one session at a time: the last one started is the one to resume
+    if sessions:
+        session_id = next(reversed(sessions))
+        state.session_id = session_id
+        state.session_settings = sessions[session_id]
+        last_frame = last_frames.get(session_id)
+        if last_frame is not None:
+            state.next_frame = FrameCounter(last_frame).next()
+
+    return state
+
+
+def _unfinished_records(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    ended_sessions = {r["session"] for r in records if r.get("event") == EVENT_SESSION_END}
+    moved_files = {r["file"] for r in records if r.get("event") == EVENT_MOVED}
+    transferred_files = {_camera_file(r) for r in records if r.get("event") == EVENT_TRANSFERRED}
+
+    unfinished = []
+    for r in records:
+        event = r.get("event")
+        if event in (EVENT_SESSION_START, EVENT_CAPTURED) and r["session"] not in ended_sessions:
+            unfinished.append(r)
+        elif event in (EVENT_DOWNLOADED, EVENT_TAGGED) and r["file"] not in moved_files:
+            unfinished.append(r)
+        elif event == EVENT_DEFERRED and _camera_file(r) not in transferred_files:
+            unfinished.append(r)
+    return unfinished
+
+
+def _camera_file(r: Dict[str, Any]) -> str:
+    return f'{r["device"]}:{r["folder"]}/{r["name"]}'
@@ -0,0 +1,118 @@
+"""
+Logging of the service, out of the way of the scan loops.
+Records are queued and written to the console by a background thread: a slow
+console never delays the motor. Below warnings, each line of code may only log
+a limited number of messages per second.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from typing import Dict, List, Optional, TextIO, Tuple
+
+LOG_FORMAT = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+
+# Messages per second and per line of code
+DEFAULT_RATE = 10.0
+DEFAULT_BURST = 20
+# Beyond it, records are dropped rather than blocking the caller
+QUEUE_SIZE = 10000
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket for each line of code. Warnings and errors always pass.
+    The number of dropped messages is added to the next message of the same line.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST) -> None:
+        super().__init__()
+        self._rate = rate
+        self._burst = burst
+        # Line of code => [tokens, time of the last message, dropped messages]
+        self._buckets: Dict[Tuple[str, int], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self._burst), record.created, 0]
+
+            tokens = min(float(self._burst), bucket[0] + (record.created - bucket[1]) * self._rate)
+            bucket[1] = record.created
+            if tokens < 1.0:
+                bucket[0] = tokens
+                bucket[2] += 1
+                return False
+
+            bucket[0] = tokens - 1.0
+            dropped = int(bucket[2])
+            bucket[2] = 0
+
+        if dropped:
+            record.msg = f"{record.msg} [{dropped} similar messages dropped]"
+        return True
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self.dropped:
+            # Already formatted by prepare()
+            record.msg = f"{record.msg} [{self.dropped} messages dropped, the console is too slow]"
+        try:
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def init_logging(level: int, stream: TextIO = sys.stdout,
+                 rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST) -> None:
+    """
+    Replace the handlers of the root logger by the queue
+    """
+    global _listener
+
+    console_handler = logging.StreamHandler(stream)
+    console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue: queue.Queue = queue.Queue(QUEUE_SIZE)
+    queue_handler = _NonBlockingQueueHandler(log_queue)
+    # Filtered in the caller thread: dropped messages never reach the queue
+    if rate > 0:
+        queue_handler.addFilter(RateLimitFilter(rate, burst))
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, console_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """
+    Write the queued records
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,159 @@
+"""
+Incremental manifest of the files which reached the destination storage.
+It's a change feed: each file gets a sequence number, which clients use as a cursor.
+"""
+
+from dataclasses import dataclass
+import hashlib
+import logging
+import pathlib
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from dataclasses_json import dataclass_json
+
+log = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+MAX_PAGE_SIZE = 1000
+
+
+@dataclass_json
+@dataclass(frozen=True)
+class ManifestEntry:
+    sequence: int
+    name: str   # Relative to the destination storage
+    size: int
+    sha256: str
+    time: float
+    session: Optional[int] = None
+    frame: Optional[int] = None
+    roll_id: Optional[str] = None
+
+
+class Manifest:
+    __slots__ = ['_manifest_file', '_root', '_entries', '_lock', '_changed', '_on_file_ready', ]
+
+    def __init__(self, manifest_file: pathlib.Path, root: pathlib.Path,
+                 on_file_ready: Optional[Callable[[ManifestEntry], None]] = None) -> None:
+        self._manifest_file = manifest_file
+        self._root = root
+        self._on_file_ready = on_file_ready
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._entries = self._load()
+
+    def add(self, file: pathlib.Path, session: Optional[int] = None,
+            frame: Optional[int] = None, roll_id: Optional[str] = None) -> ManifestEntry:
+        size = file.stat().st_size
+        sha256 = hash_file(file)
+
+        with self._lock:
+            entry = ManifestEntry(
+                sequence=len(self._entries) + 1,
+                name=file.relative_to(self._root).as_posix(),
+                size=size,
+                sha256=sha256,
+                time=time.time(),
+                session=session,
+                frame=frame,
+                roll_id=roll_id,
+            )
+            with open(self._manifest_file, 'a') as f:
+                f.write(entry.to_json() + "\n")
+            self._entries.append(entry)
+            self._changed.notify_all()
+
+        if self._on_file_ready is not None:
+            self._on_file_ready(entry)
+        return entry
+
+    def changes(self, since: int = 0, limit: int = MAX_PAGE_SIZE,
+                wait: float = 0.0) -> Tuple[List[ManifestEntry], int]:
+        """
+        Files added after the given cursor, and the cursor to use for the next call.
+        If there is no new file, wait up to the given time for one (long polling).
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        since = max(0, since)
+
+        with self._lock:
+            if since > len(self._entries):
+                # The manifest was reset: start over
+                since = 0
+            if wait > 0:
+                self._changed.wait_for(lambda: len(self._entries) > since, timeout=wait)
+
+            # Sequence numbers are contiguous, starting at 1
+            page = self._entries[since:since + limit]
+
+        cursor = page[-1].sequence if page else since
+        return page, cursor
+
+    def find(self, session: Optional[int] = None, roll_id: Optional[str] = None) -> List[ManifestEntry]:
+        """
+        Files of the given session and/or roll
+        """
+        with self._lock:
+            return [e for e in self._entries
+                    if (session is None or e.session == session)
+                    and (roll_id is None or e.roll_id == roll_id)]
+
+    @property
+    def cursor(self) -> int:
+        return len(self._entries)
+
+    def _load(self) -> List[ManifestEntry]:
+        entries = []
+        is_corrupted = False
+        try:
+            with open(self._manifest_file, 'r') as f:
+                for line in f:
+                    try:
+                        entries.append(ManifestEntry.from_json(line))
+                    except ValueError:
+                        # The last line might be truncated by a crash
+                        log.warning("Ignoring corrupted manifest entry: %s", line)
+                        is_corrupted = True
+        except FileNotFoundError:
+            log.info("Manifest file not found")
+
+        if is_corrupted:
+            with open(self._manifest_file, 'w') as f:
+                for e in entries:
+                    f.write(e.to_json() + "\n")
+        return entries
+
+
+def hash_file(file: pathlib.Path) -> str:
+    h = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+_manifest: Optional[Manifest] = None
+
+
+def init_manifest(manifest_filename: str, root: pathlib.Path,
+                  on_file_ready: Optional[Callable[[ManifestEntry], None]] = None) -> Manifest:
+    global _manifest
+    _manifest = Manifest(pathlib.Path(manifest_filename), root, on_file_ready)
+    return _manifest
+
+
+def get_manifest() -> Optional[Manifest]:
+    return _manifest
+
+
+def record_file(file: pathlib.Path, session: Optional[int] = None,
+                frame: Optional[int] = None, roll_id: Optional[str] = None) -> None:
+    if _manifest is None:
+        return
+
+    try:
+        _manifest.add(file, session, frame, roll_id)
+    except Exception:
+        log.exception("Unable to add file to the manifest: %s", file)
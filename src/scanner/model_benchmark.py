@@ -0,0 +1,210 @@
+"""
+Benchmark of the object detection model variants on recorded previews.
+The previews can be recorded by running the scanner in verbose mode.
+
+Usage: python -m scanner.model_benchmark /storage/share
+"""
+
+import argparse
+import gc
+import io
+import json
+import logging
+import os
+import pathlib
+import resource
+import statistics
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+from dataclasses_json import dataclass_json
+from PIL import Image
+
+from scanner import model_registry
+from scanner.detector_scanner import interpret_detections
+from scanner.model_registry import ModelVariant
+from scanner.object_detection import ObjectDetection
+
+log = logging.getLogger(__name__)
+
+PREVIEW_EXTENSIONS = {'.jpg', '.jpeg'}
+ANNOTATED_SUFFIX = '-detections'
+MAX_PREVIEWS_AUTO_SELECT = 20
+DEFAULT_MIN_ACCURACY = 0.95
+
+# Lower is more precise: the most precise variant is the reference for decisions
+PRECISION_RANK = {
+    "float32": 0,
+    "float16": 1,
+    "int8": 2,
+    "uint8": 2,
+}
+
+
+@dataclass_json
+@dataclass
+class BenchmarkResult:
+    variant: str
+    previews: int
+    load_time_ms: float
+    median_latency_ms: float
+    p95_latency_ms: float
+    memory_kb: int
+    accuracy: float
+
+
+def list_previews(path: pathlib.Path, max_count: Optional[int] = None) -> List[pathlib.Path]:
+    previews = sorted(f for f in path.glob('*.*')
+                      if f.suffix.lower() in PREVIEW_EXTENSIONS and not f.stem.endswith(ANNOTATED_SUFFIX))
+    if max_count is not None:
+        previews = previews[:max_count]
+    return previews
+
+
+def benchmark_variants(variants: Sequence[ModelVariant], previews: Sequence[pathlib.Path]) -> List[BenchmarkResult]:
+    # Load the previews in memory, so that disk access isn't measured
+    raw_previews = [p.read_bytes() for p in previews]
+    labels_file = str(model_registry.get_labels_file())
+
+    ordered = sorted(variants, key=lambda v: PRECISION_RANK.get(v.quantization, len(PRECISION_RANK)))
+    reference_decisions: Optional[List[Tuple[bool, bool]]] = None
+    results = []
+
+    for variant in ordered:
+        try:
+            result, decisions = _benchmark_variant(variant, labels_file, raw_previews, reference_decisions)
+        except Exception:
+            log.exception("Unable to benchmark model variant %s", variant.name)
+            continue
+
+        if reference_decisions is None:
+            reference_decisions = decisions
+        results.append(result)
+        log.info("Benchmark result: %s", result)
+
+    return results
+
+
+def select_fastest(results: Sequence[BenchmarkResult], min_accuracy: float) -> Optional[str]:
+    eligible = [r for r in results if r.accuracy >= min_accuracy]
+    if not eligible:
+        return None
+    return min(eligible, key=lambda r: r.median_latency_ms).variant
+
+
+def resolve_variant(name: Optional[str], use_edge_tpu: bool,
+                    previews_path: Optional[str], min_accuracy: float = DEFAULT_MIN_ACCURACY) -> ModelVariant:
+    if name != model_registry.AUTO_VARIANT:
+        return model_registry.get_variant(name, use_edge_tpu)
+
+    default_variant = model_registry.get_variant(None, use_edge_tpu)
+    previews = list_previews(pathlib.Path(previews_path), MAX_PREVIEWS_AUTO_SELECT) if previews_path else []
+    if not previews:
+        log.warning("No recorded previews to select a model variant, using %s", default_variant.name)
+        return default_variant
+
+    # Edge TPU variants are only considered when a TPU is there
+    candidates = [v for v in model_registry.list_variants() if use_edge_tpu or not v.edge_tpu]
+    results = benchmark_variants(candidates, previews)
+    selected = select_fastest(results, min_accuracy)
+    if selected is None:
+        log.warning("No model variant reaches an accuracy of %s, using %s", min_accuracy, default_variant.name)
+        return default_variant
+
+    log.info("Selected model variant: %s", selected)
+    return model_registry.get_variant(selected)
+
+
+def _benchmark_variant(variant: ModelVariant, labels_file: str, raw_previews: Sequence[bytes],
+                       reference_decisions: Optional[List[Tuple[bool, bool]]]) -> Tuple[BenchmarkResult, List[Tuple[bool, bool]]]:
+    gc.collect()
+    memory_before = _resident_memory_kb()
+
+    start_time = time.perf_counter()
+    detector = ObjectDetection(str(model_registry.get_model_file(variant)), labels_file,
+                               use_edge_tpu=variant.edge_tpu)
+    load_time = time.perf_counter() - start_time
+
+    latencies = []
+    decisions = []
+    for raw in raw_previews:
+        image = Image.open(io.BytesIO(raw))
+        start_time = time.perf_counter()
+        detections = detector.infer(image)
+        latencies.append(time.perf_counter() - start_time)
+
+        has_holes, has_photo, _ = interpret_detections(detections)
+        decisions.append((has_holes, has_photo))
+
+    memory = _resident_memory_kb() - memory_before
+    del detector
+
+    if reference_decisions is None:
+        accuracy = 1.0
+    else:
+        matches = sum(1 for d, r in zip(decisions, reference_decisions) if d == r)
+        accuracy = matches / len(decisions) if decisions else 0.0
+
+    latencies.sort()
+    result = BenchmarkResult(
+        variant=variant.name,
+        previews=len(raw_previews),
+        load_time_ms=load_time * 1000.0,
+        median_latency_ms=statistics.median(latencies) * 1000.0 if latencies else 0.0,
+        p95_latency_ms=latencies[int(0.95 * (len(latencies) - 1))] * 1000.0 if latencies else 0.0,
+        memory_kb=memory,
+        accuracy=accuracy,
+    )
+    return result, decisions
+
+
+def _resident_memory_kb() -> int:
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except OSError:
+        # Not on Linux: high-water mark only
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the object detection model variants')
+    parser.add_argument('previews', type=str, help='Directory of recorded previews')
+    parser.add_argument('--variant', action='append', help='Variant to benchmark (default: all)')
+    parser.add_argument('--max_previews', type=int, help='Maximum number of previews to use')
+    parser.add_argument('--min_accuracy', default=DEFAULT_MIN_ACCURACY, type=float,
+                        help='Accuracy threshold to select the fastest variant')
+    parser.add_argument('--output', type=str, help='Write the results to this JSON file')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Verbose mode')
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = _parse_arguments()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    variants = model_registry.list_variants()
+    if args.variant:
+        variants = [v for v in variants if v.name in args.variant]
+
+    previews = list_previews(pathlib.Path(args.previews), args.max_previews)
+    if not previews:
+        raise SystemExit(f"No preview found in: {args.previews}")
+
+    results = benchmark_variants(variants, previews)
+
+    print(f"{'Variant':<24} {'Load (ms)':>10} {'Median (ms)':>12} {'P95 (ms)':>10} {'Memory (kB)':>12} {'Accuracy':>9}")
+    for r in results:
+        print(f"{r.variant:<24} {r.load_time_ms:>10.1f} {r.median_latency_ms:>12.1f} {r.p95_latency_ms:>10.1f} {r.memory_kb:>12} {r.accuracy:>9.1%}")
+    print(f"Fastest variant with an accuracy of at least {args.min_accuracy:.0%}: {select_fastest(results, args.min_accuracy)}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump([r.to_dict() for r in results], f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Registry of the object detection model variants.
+Variants are described in the "variants" section of object_detection_model/metadata.json
+"""
+
+from dataclasses import dataclass
+import json
+import logging
+import pathlib
+from typing import List, Optional
+
+from dataclasses_json import LetterCase, dataclass_json
+
+log = logging.getLogger(__name__)
+
+MODEL_PATH = "object_detection_model"
+METADATA_FILE = "metadata.json"
+LABELS_FILE = "dict.txt"
+
+AUTO_VARIANT = "auto"
+
+
+@dataclass_json(letter_case=LetterCase.CAMEL)
+@dataclass(frozen=True)
+class ModelVariant:
+    name: str
+    file: str
+    quantization: str = "uint8"
+    input_size: int = 192
+    edge_tpu: bool = False
+
+
+def get_model_path() -> pathlib.Path:
+    base_dir = pathlib.Path(__file__).parent.absolute()
+    model_path = base_dir / MODEL_PATH
+    if not model_path.exists():
+        raise FileNotFoundError(f"Model path does not exist: {model_path}")
+    return model_path
+
+
+def list_variants() -> List[ModelVariant]:
+    metadata_file = get_model_path() / METADATA_FILE
+    with open(metadata_file, 'r') as f:
+        metadata = json.load(f)
+
+    return [ModelVariant.from_dict(v) for v in metadata.get("variants", [])]
+
+
+def get_variant(name: Optional[str], use_edge_tpu: bool = False) -> ModelVariant:
+    variants = list_variants()
+
+    if name:
+        for v in variants:
+            if v.name == name:
+                return v
+        raise ValueError(f"Unknown model variant: {name}")
+
+    # Default: the first variant matching the hardware
+    for v in variants:
+        if v.edge_tpu == use_edge_tpu:
+            return v
+    raise ValueError(f"No model variant available (Edge TPU: {use_edge_tpu})")
+
+
+def get_model_file(variant: ModelVariant) -> pathlib.Path:
+    model_file = get_model_path() / variant.file
+    if not model_file.exists():
+        raise FileNotFoundError(f"Model file does not exist: {model_file}")
+    return model_file
+
+
+def get_labels_file() -> pathlib.Path:
+    labels_file = get_model_path() / LABELS_FILE
+    if not labels_file.exists():
+        raise FileNotFoundError(f"Label file does not exist: {labels_file}")
+    return labels_file
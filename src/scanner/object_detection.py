@@ -1,6 +1,8 @@
+from abc import ABC, abstractmethod
 from datetime import datetime
 import logging
 import pathlib
+import queue
 from typing import List, Tuple, Union
 
 import numpy as np
@@ -21,7 +23,17 @@ def _load_labels(filename):
         return [line.strip() for line in f.readlines()][1:]
 
 
-class ObjectDetection:
+class Detector(ABC):
+    @abstractmethod
+    def infer(self, image: Image) -> List[Tuple[str, np.array, float]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def draw_detections(self, image: Image, detections: List[Tuple[str, np.array, float]], threshold: float=0.5) -> Image:
+        raise NotImplementedError
+
+
+class ObjectDetection(Detector):
     __slots__ = ['_labels', '_interpreter', 
                  '_input_size', '_input_index', 
                  '_output_boxes_index', '_output_labels_index', 
@@ -59,6 +71,10 @@ class ObjectDetection:
         self._color_mapping = {v[0]: v[1] for v in cm}
         log.info("Color mapping: %s", self._color_mapping)
 
+    @property
+    def input_size(self) -> Tuple[int, int]:
+        return self._input_size
+
     def infer_from_file(self, image_file: Union[pathlib.Path, str]) -> List[Tuple[str, np.array, float]]:
         image = Image.open(image_file)
         return self.infer(image)
@@ -67,8 +83,8 @@ class ObjectDetection:
         start_time = datetime.now()
         #img = ImageOps.grayscale(image)
         #img = img.resize(self._input_size).convert('RGB')
-        image.draft('L', self._input_size)
-        img = image.resize(self._input_size).convert('RGB')
+        # A copy: the caller keeps the full size preview, such as for the quality gate
+        img = image.resize(self._input_size, reducing_gap=2.0).convert('L').convert('RGB')
 
         # add N dim
         input_data = np.expand_dims(img, axis=0)
@@ -78,7 +94,7 @@ class ObjectDetection:
         mid_time = datetime.now()
         self._interpreter.invoke()
         end_time = datetime.now()
-        log.info('Elapsed inference time (hh:mm:ss.ms): %s / image processing time: %s', end_time - mid_time, mid_time - start_time)
+        log.debug('Elapsed inference time (hh:mm:ss.ms): %s / image processing time: %s', end_time - mid_time, mid_time - start_time)
 
         # Bounding boxes
         output_boxes = self._interpreter.get_tensor(self._output_boxes_index)
@@ -120,3 +136,32 @@ class ObjectDetection:
             draw.rectangle(rect, outline=color, width=thickness)
 
         return img
+
+
+class SharedDetector(Detector):
+    """
+    Pool of interpreters shared by several scanners.
+    Each inference borrows an interpreter: with a single Edge TPU, the scanners take turns.
+    """
+    __slots__ = ['_detectors', '_available', ]
+
+    def __init__(self, model_file: str, label_file: str, use_edge_tpu: bool = False, size: int = 1) -> None:
+        self._detectors = [ObjectDetection(model_file, label_file, use_edge_tpu) for _ in range(max(1, size))]
+        self._available: queue.SimpleQueue = queue.SimpleQueue()
+        for d in self._detectors:
+            self._available.put(d)
+
+    @property
+    def input_size(self) -> Tuple[int, int]:
+        return self._detectors[0].input_size
+
+    def infer(self, image: Image) -> List[Tuple[str, np.array, float]]:
+        detector = self._available.get()
+        try:
+            return detector.infer(image)
+        finally:
+            self._available.put(detector)
+
+    def draw_detections(self, image: Image, detections: List[Tuple[str, np.array, float]], threshold: float=0.5) -> Image:
+        # Doesn't use the interpreter
+        return self._detectors[0].draw_detections(image, detections, threshold)
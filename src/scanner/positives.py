@@ -0,0 +1,240 @@
+"""
+Positive JPEG files of the colour negatives, generated after tagging.
+The film base is sampled on the unexposed film next to the detected photo, then
+each channel is inverted and levelled. Conversions run in a pool of low priority
+processes, with a bounded queue: when it's full, photos are skipped rather than
+slowing down the scan.
+"""
+
+from concurrent import futures
+import logging
+import multiprocessing
+import os
+import pathlib
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from scanner import file_index, manifest, thumbnails
+from scanner.metadata import MetaData
+
+log = logging.getLogger(__name__)
+
+POSITIVES_FOLDER = "positives"
+# A single positive per frame: from the JPEG file, rather than the RAW file, of a RAW+JPEG pair
+JPEG_SUFFIXES = (".jpg", ".jpeg", ".JPG", ".JPEG")
+JPEG_QUALITY = 92
+# Only these processes give colour negatives
+COLOR_NEGATIVE_PROCESSES = {"C-41", "C-22", "Ap-41", "Eastman Color Negative"}
+
+DEFAULT_WORKERS = 1
+DEFAULT_QUEUE_SIZE = 8
+WORKER_NICENESS = 10
+
+# Width of the film base sampled on each side of the photo, relative to the image
+BORDER_WIDTH = 0.02
+# Percentiles of each channel mapped to black and white
+LEVELS_PERCENTILES = (0.1, 99.9)
+
+
+def sample_film_base(pixels: np.ndarray, crop: Optional[Tuple[float, float, float, float]]) -> np.ndarray:
+    """
+    Colour of the unexposed film, between the photo and its neighbours
+    """
+    height, width = pixels.shape[:2]
+    samples = []
+    if crop is not None:
+        x1, y1, x2, y2 = crop
+        left, right = sorted((x1, x2))
+        top, bottom = sorted((int(y1 * height), int(y2 * height)))
+        border = max(1, int(BORDER_WIDTH * width))
+        # Above and below the photo are the sprocket holes: only the sides
+        for start in (int(left * width) - border, int(right * width)):
+            start = max(0, start)
+            band = pixels[top:bottom, start:min(width, start + border)]
+            if band.size:
+                samples.append(band.reshape(-1, 3))
+
+    if samples:
+        return np.median(np.concatenate(samples), axis=0)
+
+    # No border found: the film base is among the brightest pixels
+    return np.percentile(pixels.reshape(-1, 3), 99, axis=0)
+
+
+def to_positive(pixels: np.ndarray, film_base: np.ndarray) -> np.ndarray:
+    # Density of each channel above the film base: the orange mask is removed
+    transmission = np.clip(pixels.astype(np.float32) / np.maximum(film_base, 1.0), 1e-3, 1.0)
+    density = -np.log10(transmission)
+
+    # Levels of each channel
+    low, high = np.percentile(density.reshape(-1, 3), LEVELS_PERCENTILES, axis=0)
+    positive = (density - low) / np.maximum(high - low, 1e-6)
+    return (np.clip(positive, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+
+
+def convert(source: str, destination: str, crop: Optional[Tuple[float, float, float, float]]) -> float:
+    """
+    Write the positive of the source file. Runs in a worker process.
+
+    :returns: The conversion time, in seconds
+    """
+    start_time = time.perf_counter()
+    pixels = np.asarray(thumbnails.open_image(pathlib.Path(source)).convert('RGB'))
+    film_base = sample_film_base(pixels, crop)
+
+    if crop is not None:
+        height, width = pixels.shape[:2]
+        x1, y1, x2, y2 = crop
+        left, right = sorted((int(x1 * width), int(x2 * width)))
+        top, bottom = sorted((int(y1 * height), int(y2 * height)))
+        if right > left and bottom > top:
+            pixels = pixels[top:bottom, left:right]
+
+    positive = Image.fromarray(to_positive(pixels, film_base))
+    destination_file = pathlib.Path(destination)
+    destination_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = destination_file.with_name(destination_file.name + ".tmp")
+    positive.save(tmp_file, "JPEG", quality=JPEG_QUALITY)
+    os.replace(tmp_file, destination_file)
+
+    return time.perf_counter() - start_time
+
+
+def _lower_priority() -> None:
+    # Scanning comes first
+    os.nice(WORKER_NICENESS)
+
+
+class PositiveConverter:
+    __slots__ = ['_executor', '_slots', '_lock', '_pending', '_counters', '_total_seconds', '_last_seconds', ]
+
+    def __init__(self, workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE) -> None:
+        # Spawned: the workers don't inherit the threads of the application
+        self._executor = futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_lower_priority)
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._lock = threading.Lock()
+        # Destination => conversion queued or running, and whether it's from a JPEG file
+        self._pending: Dict[pathlib.Path, Tuple[futures.Future, bool]] = {}
+        self._counters = {
+            "queued": 0,
+            "converted": 0,
+            "failed": 0,
+            "skipped": 0,
+        }
+        self._total_seconds = 0.0
+        self._last_seconds: Optional[float] = None
+
+    def submit(self, file: pathlib.Path, metadata: Optional[MetaData], session: Optional[int] = None) -> bool:
+        """
+        Convert the file in the background, if it's a colour negative.
+
+        :returns: False if the file isn't converted
+        """
+        if metadata is None or metadata.develop_process not in COLOR_NEGATIVE_PROCESSES:
+            return False
+
+        is_jpeg = file.suffix in JPEG_SUFFIXES
+        if not is_jpeg and any(file.with_suffix(s).exists() for s in JPEG_SUFFIXES):
+            # Converted from the JPEG file
+            return False
+
+        destination = file.parent / POSITIVES_FOLDER / (file.stem + ".jpg")
+        with self._lock:
+            pending = self._pending.get(destination)
+        if pending is not None:
+            future, is_pending_jpeg = pending
+            # Only a RAW file not started yet is replaced by its JPEG file
+            if is_pending_jpeg or not is_jpeg or not future.cancel():
+                return False
+
+        # Never wait: the caller is on the way of the next photos
+        if not self._slots.acquire(blocking=False):
+            log.warning("Positive conversion queue is full, skipping: %s", file)
+            with self._lock:
+                self._counters["skipped"] += 1
+            return False
+
+        with self._lock:
+            self._counters["queued"] += 1
+        try:
+            future = self._executor.submit(convert, str(file), str(destination),
+                                           tuple(metadata.crop) if metadata.crop else None)
+        except Exception:
+            self._slots.release()
+            with self._lock:
+                self._counters["queued"] -= 1
+            raise
+        with self._lock:
+            self._pending[destination] = (future, is_jpeg)
+        future.add_done_callback(lambda f: self._done(f, destination, metadata, session))
+        return True
+
+    def statistics(self) -> Dict[str, Any]:
+        with self._lock:
+            converted = self._counters["converted"]
+            return dict(
+                self._counters,
+                average_seconds=self._total_seconds / converted if converted else None,
+                last_seconds=self._last_seconds)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def _done(self, future: futures.Future, destination: pathlib.Path,
+              metadata: MetaData, session: Optional[int]) -> None:
+        self._slots.release()
+        with self._lock:
+            if self._pending.get(destination, (None, False))[0] is future:
+                del self._pending[destination]
+            if future.cancelled():
+                # Replaced by the JPEG file of the frame
+                self._counters["queued"] -= 1
+                return
+        try:
+            seconds = future.result()
+        except Exception:
+            log.exception("Unable to convert to positive: %s", destination)
+            with self._lock:
+                self._counters["queued"] -= 1
+                self._counters["failed"] += 1
+            return
+
+        with self._lock:
+            self._counters["queued"] -= 1
+            self._counters["converted"] += 1
+            self._total_seconds += seconds
+            self._last_seconds = seconds
+        log.info("Positive converted in %.2fs: %s", seconds, destination)
+
+        manifest.record_file(destination, session, metadata.exposure_number, metadata.roll_id)
+        file_index.record_file(destination, session, metadata.exposure_number, metadata.roll_id, True)
+        thumbnails.submit(destination)
+
+
+_converter: Optional[PositiveConverter] = None
+
+
+def init_positives(workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE) -> PositiveConverter:
+    global _converter
+    _converter = PositiveConverter(workers, queue_size)
+    return _converter
+
+
+def get_positives() -> Optional[PositiveConverter]:
+    return _converter
+
+
+def submit(file: pathlib.Path, metadata: Optional[MetaData], session: Optional[int] = None) -> None:
+    if _converter is None:
+        return
+
+    try:
+        _converter.submit(file, metadata, session)
+    except Exception:
+        log.exception("Unable to queue the positive conversion of: %s", file)
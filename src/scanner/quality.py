@@ -0,0 +1,115 @@
+"""
+Quality gate of the previews, before taking the photo.
+A blurry, clipped or incomplete frame is aligned again instead of being downloaded.
+"""
+
+from dataclasses import dataclass, field
+import logging
+from typing import List, Optional, Tuple
+
+from dataclasses_json import dataclass_json
+import numpy as np
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+FAILURE_FOCUS = "focus"
+FAILURE_EXPOSURE = "exposure"
+FAILURE_CROP = "crop"
+
+# Focus is relative to the median of the previous frames of the roll
+MIN_RELATIVE_FOCUS = 0.5
+MIN_FOCUS_HISTORY = 3
+# Ratio of the pixels of the photo at 0 or 255
+MAX_CLIPPED_RATIO = 0.02
+# Aspect ratio of the crop box, compared to a full 36x24 frame
+FRAME_ASPECT_RATIO = 1.5
+MIN_CROP_COMPLETENESS = 0.9
+
+
+@dataclass_json
+@dataclass
+class QualityScores:
+    focus: float            # Variance of the Laplacian
+    clipped_ratio: float
+    crop_completeness: Optional[float]
+    failures: List[str] = field(default_factory=list)
+
+    @property
+    def passed(self) -> bool:
+        return not self.failures
+
+
+def focus_score(gray: np.ndarray) -> float:
+    """
+    Variance of the Laplacian: the sharper the image, the higher
+    """
+    laplacian = (gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]
+                 - 4 * gray[1:-1, 1:-1])
+    return float(laplacian.var())
+
+
+def clipped_ratio(pixels: np.ndarray) -> float:
+    clipped = np.any((pixels == 0) | (pixels == 255), axis=-1)
+    return float(np.count_nonzero(clipped)) / max(1, clipped.size)
+
+
+def crop_completeness(crop: Tuple[float, float, float, float], width: int, height: int) -> float:
+    x1, y1, x2, y2 = crop
+    crop_width = abs(x2 - x1) * width
+    crop_height = abs(y2 - y1) * height
+    if crop_width <= 0 or crop_height <= 0:
+        return 0.0
+
+    # Landscape or portrait, a partial frame is narrower than a full one
+    aspect_ratio = max(crop_width, crop_height) / min(crop_width, crop_height)
+    return min(aspect_ratio, FRAME_ASPECT_RATIO) / max(aspect_ratio, FRAME_ASPECT_RATIO)
+
+
+class QualityGate:
+    __slots__ = ['_focus_history', ]
+
+    def __init__(self) -> None:
+        self._focus_history: List[float] = []
+
+    def reset(self) -> None:
+        """
+        New roll: the focus of the previous one isn't relevant
+        """
+        self._focus_history = []
+
+    def evaluate(self, image: Image.Image, crop: Optional[Tuple[float, float, float, float]]) -> QualityScores:
+        pixels = np.asarray(image.convert('RGB'))
+        height, width = pixels.shape[:2]
+
+        # Only the photo, not the film around
+        if crop is not None:
+            x1, y1, x2, y2 = crop
+            left, right = sorted((int(x1 * width), int(x2 * width)))
+            top, bottom = sorted((int(y1 * height), int(y2 * height)))
+            if right - left > 2 and bottom - top > 2:
+                pixels = pixels[top:bottom, left:right]
+
+        gray = pixels.astype(np.float32).mean(axis=-1)
+        scores = QualityScores(
+            focus=focus_score(gray),
+            clipped_ratio=clipped_ratio(pixels),
+            crop_completeness=crop_completeness(crop, width, height) if crop is not None else None,
+        )
+
+        if len(self._focus_history) >= MIN_FOCUS_HISTORY \
+           and scores.focus < MIN_RELATIVE_FOCUS * float(np.median(self._focus_history)):
+            scores.failures.append(FAILURE_FOCUS)
+        if scores.clipped_ratio > MAX_CLIPPED_RATIO:
+            scores.failures.append(FAILURE_EXPOSURE)
+        if scores.crop_completeness is not None and scores.crop_completeness < MIN_CROP_COMPLETENESS:
+            scores.failures.append(FAILURE_CROP)
+
+        log.debug("Quality: %s", scores)
+        return scores
+
+    def accept(self, scores: QualityScores) -> None:
+        """
+        The frame is taken: it's a reference for the next ones
+        """
+        self._focus_history.append(scores.focus)
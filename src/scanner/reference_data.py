@@ -0,0 +1,110 @@
+"""
+In-memory index of the reference data, with precomputed serialized responses.
+"""
+
+from dataclasses import dataclass
+import difflib
+import functools
+import hashlib
+import json
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from scanner import frame_counter
+from scanner.exif import develop_process, film_type, films
+
+SEARCH_CACHE_SIZE = 256
+FUZZY_CUTOFF = 0.6
+
+
+class FilmAlreadyExists(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+@dataclass(frozen=True)
+class SerializedResponse:
+    body: bytes
+    etag: str
+    total_count: int
+
+
+class ReferenceIndex:
+    __slots__ = ['_loader', '_search_fields', '_lock', '_items', '_keys', '_search', ]
+
+    def __init__(self, loader: Callable[[], List[Dict[str, Any]]], search_fields: Sequence[str]) -> None:
+        self._loader = loader
+        self._search_fields = search_fields
+        self._lock = threading.Lock()
+        self._items: Optional[List[Dict[str, Any]]] = None
+        self._keys: List[str] = []
+        self._search = functools.lru_cache(maxsize=SEARCH_CACHE_SIZE)(self._serialize_search)
+
+    def response(self, query: Optional[str] = None, offset: int = 0, limit: Optional[int] = None) -> SerializedResponse:
+        query = (query or "").strip().lower()
+        with self._lock:
+            # Loaded only once
+            if self._items is None:
+                self._items = self._loader()
+                self._keys = [" ".join(str(item[f]) for f in self._search_fields).lower()
+                              for item in self._items]
+            return self._search(query, max(0, offset), limit)
+
+    def reload(self) -> None:
+        with self._lock:
+            self._items = None
+            self._search.cache_clear()
+
+    def _serialize_search(self, query: str, offset: int, limit: Optional[int]) -> SerializedResponse:
+        items = self._find(query) if query else self._items
+        page = items[offset:offset + limit] if limit is not None else items[offset:]
+
+        body = json.dumps(page, ensure_ascii=False).encode("utf-8")
+        etag = hashlib.sha1(body).hexdigest()
+        return SerializedResponse(body=body, etag=etag, total_count=len(items))
+
+    def _find(self, query: str) -> List[Dict[str, Any]]:
+        # Best matches first: start of the text, start of a word, anywhere
+        prefix, word_prefix, contained = [], [], []
+        for item, key in zip(self._items, self._keys):
+            if key.startswith(query):
+                prefix.append(item)
+            elif (" " + query) in key:
+                word_prefix.append(item)
+            elif query in key:
+                contained.append(item)
+
+        matches = prefix + word_prefix + contained
+        if matches:
+            return matches
+
+        # No direct match: maybe a typo
+        words = {}
+        for item, key in zip(self._items, self._keys):
+            for word in key.split():
+                words.setdefault(word, []).append(item)
+
+        fuzzy = []
+        for word in difflib.get_close_matches(query, list(words.keys()), n=10, cutoff=FUZZY_CUTOFF):
+            fuzzy.extend(item for item in words[word] if item not in fuzzy)
+        return fuzzy
+
+
+FILMS = ReferenceIndex(
+    lambda: [{'make': m, 'name': n} for m, n in films.get_all_films()],
+    ['make', 'name'])
+FILM_TYPES = ReferenceIndex(
+    lambda: [{'type': t} for t in film_type.get_film_types()],
+    ['type'])
+DEVELOP_PROCESSES = ReferenceIndex(
+    lambda: [{'process': p} for p in develop_process.get_develop_processes()],
+    ['process'])
+FRAME_COUNTS = ReferenceIndex(
+    lambda: [{'frame': f} for f in frame_counter.list_typical_frames()],
+    ['frame'])
+
+
+def add_film(make: str, name: str) -> None:
+    if not films.add_film(make, name):
+        raise FilmAlreadyExists(f"Film already exists: {make} {name}")
+    FILMS.reload()
@@ -0,0 +1,276 @@
+"""
+Object detection on another computer of the LAN, for the Raspberry Pi without Edge TPU.
+The downscaled previews are sent over a persistent TCP connection. When the worker
+doesn't answer in time, the detection falls back to the local interpreter.
+
+Each frame is prefixed by its length (4 bytes, big endian):
+- Worker to client, once connected: JSON {"input_size": [width, height], "variant": name}
+- Client to worker: width and height (2 bytes each), then the RGB pixels of the preview
+- Worker to client: JSON {"detections": [[label, [y1, x1, y2, x2], confidence], ...]} or {"error": message}
+
+Usage:
+    Worker:    python -m scanner.remote_inference serve --port 5001
+    Benchmark: python -m scanner.remote_inference benchmark 192.168.1.10:5001 /storage/share
+"""
+
+import argparse
+import io
+import json
+import logging
+import pathlib
+import socket
+import socketserver
+import statistics
+import struct
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from scanner import model_registry
+from scanner.object_detection import Detector, ObjectDetection, SharedDetector
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 5001
+# Above it, the local inference is used
+DEFAULT_TIMEOUT = 1.0           # seconds
+RECONNECT_INTERVAL = 30.0       # seconds
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+_LENGTH = struct.Struct('>I')
+_SIZE = struct.Struct('>HH')
+
+
+class RemoteInferenceError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def send_frame(sock: socket.socket, payload: bytes) -> None:
+    sock.sendall(_LENGTH.pack(len(payload)) + payload)
+
+
+def receive_frame(sock: socket.socket) -> bytes:
+    (length, ) = _LENGTH.unpack(_receive_exactly(sock, _LENGTH.size))
+    if length > MAX_FRAME_SIZE:
+        raise RemoteInferenceError(f"Frame too large: {length} bytes")
+    return _receive_exactly(sock, length)
+
+
+def _receive_exactly(sock: socket.socket, size: int) -> bytes:
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        buffer += chunk
+    return bytes(buffer)
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    if not host:
+        return port, DEFAULT_PORT
+    return host, int(port)
+
+
+class RemoteDetector(Detector):
+    __slots__ = ['_address', '_fallback', '_timeout', '_socket', '_input_size',
+                 '_lock', '_retry_time', '_counters', ]
+
+    def __init__(self, address: Tuple[str, int], fallback: Detector, timeout: float = DEFAULT_TIMEOUT) -> None:
+        self._address = address
+        self._fallback = fallback
+        self._timeout = timeout
+        self._socket: Optional[socket.socket] = None
+        self._input_size: Optional[Tuple[int, int]] = None
+        # A single connection: the requests of the scanners take turns
+        self._lock = threading.Lock()
+        self._retry_time = 0.0
+        self._counters = {
+            "remote": 0,
+            "local": 0,
+            "errors": 0,
+        }
+
+    def infer(self, image: Image) -> List[Tuple[str, np.array, float]]:
+        with self._lock:
+            if self._socket is None and time.monotonic() >= self._retry_time:
+                self._connect()
+
+            if self._socket is not None:
+                try:
+                    detections = self._infer_remotely(image)
+                    self._counters["remote"] += 1
+                    return detections
+                except (OSError, ValueError, RemoteInferenceError) as e:
+                    # The next answer could be the one of this request: start over
+                    log.warning("Remote inference failed, using local inference: %s", e)
+                    self._counters["errors"] += 1
+                    self._disconnect()
+
+            self._counters["local"] += 1
+
+        return self._fallback.infer(image)
+
+    def draw_detections(self, image: Image, detections: List[Tuple[str, np.array, float]], threshold: float=0.5) -> Image:
+        return self._fallback.draw_detections(image, detections, threshold)
+
+    def statistics(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._counters, is_connected=self._socket is not None)
+
+    def close(self) -> None:
+        with self._lock:
+            self._disconnect()
+
+    def _connect(self) -> None:
+        try:
+            sock = socket.create_connection(self._address, timeout=self._timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                hello = json.loads(receive_frame(sock))
+                self._input_size = tuple(hello["input_size"])
+            except:
+                sock.close()
+                raise
+            self._socket = sock
+            log.info("Connected to the inference worker %s:%s, model variant %s",
+                     self._address[0], self._address[1], hello.get("variant"))
+        except (OSError, ValueError, KeyError, RemoteInferenceError) as e:
+            log.warning("Unable to connect to the inference worker %s:%s: %s", self._address[0], self._address[1], e)
+            self._retry_time = time.monotonic() + RECONNECT_INTERVAL
+
+    def _disconnect(self) -> None:
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        self._retry_time = time.monotonic() + RECONNECT_INTERVAL
+
+    def _infer_remotely(self, image: Image) -> List[Tuple[str, np.array, float]]:
+        # Only the pixels seen by the model are sent, in grey levels as for a local inference.
+        # A copy: the caller keeps the full size preview.
+        img = image.resize(self._input_size, reducing_gap=2.0).convert('L').convert('RGB')
+        send_frame(self._socket, _SIZE.pack(*img.size) + img.tobytes())
+
+        response = json.loads(receive_frame(self._socket))
+        if "error" in response:
+            raise RemoteInferenceError(response["error"])
+        return [(label, np.array(box, dtype=np.float32), confidence)
+                for label, box, confidence in response["detections"]]
+
+
+class _InferenceHandler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        detector: SharedDetector = self.server.detector
+        log.info("Client connected: %s", self.client_address)
+
+        send_frame(sock, json.dumps({
+            "input_size": list(detector.input_size),
+            "variant": self.server.variant,
+        }).encode('utf-8'))
+
+        while True:
+            try:
+                payload = receive_frame(sock)
+            except (OSError, RemoteInferenceError):
+                log.info("Client disconnected: %s", self.client_address)
+                return
+
+            try:
+                width, height = _SIZE.unpack_from(payload)
+                image = Image.frombytes('RGB', (width, height), payload[_SIZE.size:])
+                detections = detector.infer(image)
+                response = {"detections": [[label, np.asarray(box, dtype=float).tolist(), float(confidence)]
+                                           for label, box, confidence in detections]}
+            except Exception as e:
+                log.exception("Unable to infer")
+                response = {"error": str(e)}
+            send_frame(sock, json.dumps(response).encode('utf-8'))
+
+
+class InferenceServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], detector: SharedDetector, variant: str) -> None:
+        super().__init__(address, _InferenceHandler)
+        self.detector = detector
+        self.variant = variant
+
+
+def serve(args: argparse.Namespace) -> None:
+    variant = model_registry.get_variant(args.variant, args.use_edge_tpu)
+    detector = SharedDetector(str(model_registry.get_model_file(variant)), str(model_registry.get_labels_file()),
+                              use_edge_tpu=variant.edge_tpu, size=args.workers)
+
+    with InferenceServer((args.host, args.port), detector, variant.name) as server:
+        log.info("Inference worker listening on %s:%s, model variant %s", args.host, args.port, variant.name)
+        server.serve_forever()
+
+
+def benchmark(args: argparse.Namespace) -> None:
+    # Imported here: it's only needed by the benchmark
+    from scanner.model_benchmark import list_previews
+
+    previews = [p.read_bytes() for p in list_previews(pathlib.Path(args.previews), args.max_previews)]
+    if not previews:
+        raise SystemExit(f"No preview found in: {args.previews}")
+
+    variant = model_registry.get_variant(args.variant, args.use_edge_tpu)
+    local = ObjectDetection(str(model_registry.get_model_file(variant)), str(model_registry.get_labels_file()),
+                            use_edge_tpu=variant.edge_tpu)
+    remote = RemoteDetector(parse_address(args.address), local, args.timeout)
+
+    for name, detector in (("local", local), ("remote", remote)):
+        latencies = []
+        for raw in previews:
+            image = Image.open(io.BytesIO(raw))
+            start_time = time.perf_counter()
+            detector.infer(image)
+            latencies.append(time.perf_counter() - start_time)
+
+        latencies.sort()
+        print(f"{name:>8}: median {statistics.median(latencies) * 1000.0:8.1f} ms, "
+              f"p95 {latencies[int(0.95 * (len(latencies) - 1))] * 1000.0:8.1f} ms")
+
+    print(f"Remote statistics: {remote.statistics()}")
+    remote.close()
+
+
+def _parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Remote object detection')
+    parser.add_argument('--variant', type=str, help='Model variant (default: the default variant)')
+    parser.add_argument('--use_edge_tpu', '-tpu', action='store_true', help='Use Coral Edge TPU')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Verbose mode')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help='Run the inference worker')
+    serve_parser.add_argument('--host', default='0.0.0.0', type=str, help='Address to listen to')
+    serve_parser.add_argument('--port', default=DEFAULT_PORT, type=int, help='Port to listen to')
+    serve_parser.add_argument('--workers', default=1, type=int, help='Number of interpreters')
+    serve_parser.set_defaults(func=serve)
+
+    benchmark_parser = commands.add_parser('benchmark', help='Compare the latency of the local and remote inferences')
+    benchmark_parser.add_argument('address', type=str, help='Address of the worker: host:port')
+    benchmark_parser.add_argument('previews', type=str, help='Directory of recorded previews')
+    benchmark_parser.add_argument('--max_previews', default=50, type=int, help='Maximum number of previews to use')
+    benchmark_parser.add_argument('--timeout', default=DEFAULT_TIMEOUT, type=float, help='Timeout of the remote inference, in seconds')
+    benchmark_parser.set_defaults(func=benchmark)
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = _parse_arguments()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
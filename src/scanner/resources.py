@@ -0,0 +1,192 @@
+"""
+Resource governor of the capture pipeline.
+It watches the free space of the storage paths and the backlog of the files not yet
+downloaded, tagged and moved. Before a limit is reached, the scans slow down, then
+pause between two photos. They resume by themselves once space is freed or the
+backlog is drained.
+"""
+
+from dataclasses import dataclass, field
+import logging
+import pathlib
+import shutil
+import threading
+from typing import Callable, Dict, List, Optional
+
+from dataclasses_json import dataclass_json
+
+log = logging.getLogger(__name__)
+
+STATE_OK = "ok"
+# A delay is added before each photo
+STATE_SLOW = "slow"
+# No photo is taken until the state is back to ok
+STATE_PAUSED = "paused"
+
+DEFAULT_MIN_FREE_SPACE = 1024 * 1024 * 1024     # bytes
+DEFAULT_MAX_BACKLOG = 40                        # files
+# Scans slow down from these fractions of the limits
+SLOW_FREE_SPACE_FACTOR = 2.0
+SLOW_BACKLOG_FACTOR = 0.5
+SLOW_DELAY = 2.0            # seconds
+CHECK_INTERVAL = 5.0        # seconds
+
+
+@dataclass_json
+@dataclass(frozen=True)
+class StorageStatus:
+    name: str
+    path: str
+    # None if the path isn't available
+    free_bytes: Optional[int]
+
+
+@dataclass_json
+@dataclass(frozen=True)
+class ResourceStatus:
+    state: str
+    storages: List[StorageStatus] = field(default_factory=list)
+    backlog: Dict[str, int] = field(default_factory=dict)
+    reasons: List[str] = field(default_factory=list)
+
+
+class ResourceGovernor:
+    __slots__ = ['_storages', '_backlog_sources', '_min_free_space', '_max_backlog',
+                 '_on_change', '_status', '_lock', '_must_stop', ]
+
+    def __init__(self, storages: Dict[str, pathlib.Path],
+                 min_free_space: int = DEFAULT_MIN_FREE_SPACE, max_backlog: int = DEFAULT_MAX_BACKLOG,
+                 on_change: Optional[Callable[[ResourceStatus], None]] = None) -> None:
+        self._storages = storages
+        self._backlog_sources: Dict[str, Callable[[], int]] = {}
+        self._min_free_space = min_free_space
+        self._max_backlog = max_backlog
+        self._on_change = on_change
+        self._status = ResourceStatus(STATE_OK)
+        self._lock = threading.Lock()
+        self._must_stop = threading.Event()
+
+    def add_backlog_source(self, name: str, count: Callable[[], int]) -> None:
+        self._backlog_sources[name] = count
+
+    @property
+    def status(self) -> ResourceStatus:
+        return self._status
+
+    def start(self) -> None:
+        # Keeps the clients informed, even when nothing is scanned
+        threading.Thread(target=self._monitor, daemon=True).start()
+
+    def stop(self) -> None:
+        self._must_stop.set()
+
+    def refresh(self) -> ResourceStatus:
+        with self._lock:
+            previous = self._status
+            status = self._evaluate(previous.state)
+            self._status = status
+
+        if status.state != previous.state or status.reasons != previous.reasons:
+            if status.state == STATE_OK:
+                log.info("Resources available, scans at full speed")
+            else:
+                log.warning("Resource limits reached, scans %s: %s", status.state, ", ".join(status.reasons))
+            if self._on_change is not None:
+                try:
+                    self._on_change(status)
+                except Exception:
+                    log.exception("Unable to notify the resource status")
+
+        return status
+
+    def throttle(self, must_stop: threading.Event) -> None:
+        """
+        Called by the scanners before each photo. Slows down or waits until the resources are available.
+        """
+        status = self.refresh()
+        if status.state == STATE_SLOW:
+            must_stop.wait(SLOW_DELAY)
+
+        while status.state == STATE_PAUSED and not must_stop.is_set():
+            must_stop.wait(CHECK_INTERVAL)
+            status = self.refresh()
+
+    def _evaluate(self, previous_state: str) -> ResourceStatus:
+        # Hysteresis: once paused, the scans resume below the slow down limits only
+        is_paused = previous_state == STATE_PAUSED
+        pause_free_space = self._min_free_space * (SLOW_FREE_SPACE_FACTOR if is_paused else 1.0)
+        pause_backlog = self._max_backlog * (SLOW_BACKLOG_FACTOR if is_paused else 1.0)
+
+        state = STATE_OK
+        reasons: List[str] = []
+
+        def escalate(new_state: str, reason: str):
+            nonlocal state
+            if state != STATE_PAUSED:
+                state = new_state
+            reasons.append(reason)
+
+        storages = []
+        for name, path in self._storages.items():
+            try:
+                free_bytes = shutil.disk_usage(path).free
+            except OSError as e:
+                # Such as an unmounted archive disk
+                log.debug("Unable to read the free space of %s: %s", path, e)
+                free_bytes = None
+            storages.append(StorageStatus(name, str(path), free_bytes))
+
+            if free_bytes is None:
+                continue
+            if free_bytes < pause_free_space:
+                escalate(STATE_PAUSED, f"low space on {name}")
+            elif free_bytes < self._min_free_space * SLOW_FREE_SPACE_FACTOR:
+                escalate(STATE_SLOW, f"space running out on {name}")
+
+        backlog = {}
+        for name, count in self._backlog_sources.items():
+            try:
+                backlog[name] = count()
+            except Exception:
+                log.exception("Unable to read the backlog of %s", name)
+        total_backlog = sum(backlog.values())
+        if total_backlog >= pause_backlog:
+            escalate(STATE_PAUSED, f"{total_backlog} files waiting")
+        elif total_backlog >= self._max_backlog * SLOW_BACKLOG_FACTOR:
+            escalate(STATE_SLOW, f"{total_backlog} files waiting")
+
+        return ResourceStatus(state, storages, backlog, reasons)
+
+    def _monitor(self) -> None:
+        while not self._must_stop.wait(CHECK_INTERVAL):
+            try:
+                self.refresh()
+            except Exception:
+                log.exception("Unable to check the resources")
+
+
+_governor: Optional[ResourceGovernor] = None
+
+
+def init_resources(storages: Dict[str, pathlib.Path],
+                   min_free_space: int = DEFAULT_MIN_FREE_SPACE, max_backlog: int = DEFAULT_MAX_BACKLOG,
+                   on_change: Optional[Callable[[ResourceStatus], None]] = None) -> ResourceGovernor:
+    global _governor
+    _governor = ResourceGovernor(storages, min_free_space, max_backlog, on_change)
+    _governor.start()
+    return _governor
+
+
+def get_resources() -> Optional[ResourceGovernor]:
+    return _governor
+
+
+def throttle(must_stop: threading.Event) -> None:
+    if _governor is None:
+        return
+
+    try:
+        _governor.throttle(must_stop)
+    except Exception:
+        # Never stop a scan because of the governor itself
+        log.exception("Unable to check the resources")
@@ -0,0 +1,228 @@
+"""
+Persistent queue of rolls to scan one after the other
+"""
+
+from dataclasses import dataclass
+import logging
+import os
+import pathlib
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from dataclasses_json import dataclass_json
+
+from scanner.session import SessionSettings
+
+log = logging.getLogger(__name__)
+
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+_FOLDER_INVALID_CHARS = re.compile(r'[^A-Za-z0-9_-]+')
+
+
+@dataclass_json
+@dataclass
+class RollJob:
+    id: int
+    settings: SessionSettings
+    folder: str
+    status: str = STATUS_PENDING
+    enqueued_at: Optional[float] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    photo_count: int = 0
+    error: Optional[str] = None
+
+    @property
+    def roll_id(self) -> Optional[str]:
+        metadata = self.settings.metadata
+        return metadata.roll_id if metadata is not None else None
+
+
+@dataclass_json
+@dataclass
+class _QueueState:
+    jobs: List[RollJob]
+    next_id: int = 1
+
+
+class JobDoesNotExist(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class JobIsRunning(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class RollQueue:
+    __slots__ = ['_queue_file', '_state', '_lock', '_changed',
+                 '_runner', '_callback', '_must_stop', '_thread', ]
+
+    def __init__(self, queue_file: pathlib.Path, callback: Callable[[str, Any], None]) -> None:
+        self._queue_file = queue_file
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._must_stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._runner: Optional[Callable[[RollJob], int]] = None
+        self._state = self._load()
+
+    def enqueue(self, settings: SessionSettings, folder: Optional[str] = None) -> RollJob:
+        with self._lock:
+            job_id = self._state.next_id
+            self._state.next_id += 1
+
+            if not folder:
+                metadata = settings.metadata
+                folder = metadata.roll_id if metadata is not None and metadata.roll_id else f"roll-{job_id}"
+            folder = _FOLDER_INVALID_CHARS.sub('_', folder)
+
+            job = RollJob(id=job_id, settings=settings, folder=folder, enqueued_at=time.time())
+            self._state.jobs.append(job)
+            self._save()
+            self._changed.notify_all()
+
+        self._callback("queue", {"event": "enqueued", "id": job.id})
+        return job
+
+    def remove(self, job_id: int) -> None:
+        with self._lock:
+            job = self._find(job_id)
+            if job.status == STATUS_RUNNING:
+                raise JobIsRunning(f"Job is running: {job_id}")
+            self._state.jobs.remove(job)
+            self._save()
+
+    def move(self, job_id: int, position: int) -> None:
+        with self._lock:
+            job = self._find(job_id)
+            self._state.jobs.remove(job)
+            position = max(0, min(position, len(self._state.jobs)))
+            self._state.jobs.insert(position, job)
+            self._save()
+
+    def get_job(self, job_id: int) -> RollJob:
+        with self._lock:
+            return self._find(job_id)
+
+    def list_jobs(self) -> List[RollJob]:
+        with self._lock:
+            return list(self._state.jobs)
+
+    def statistics(self) -> Dict[str, Any]:
+        with self._lock:
+            jobs = self._state.jobs
+            finished = [j for j in jobs if j.status == STATUS_DONE]
+            stats = {
+                "is_running": self.is_running,
+                "pending": sum(1 for j in jobs if j.status == STATUS_PENDING),
+                "done": len(finished),
+                "failed": sum(1 for j in jobs if j.status == STATUS_FAILED),
+                "rolls_per_hour": 0.0,
+            }
+
+            if finished:
+                first_start = min(j.started_at for j in finished)
+                last_end = max(j.finished_at for j in finished)
+                if last_end > first_start:
+                    stats["rolls_per_hour"] = len(finished) * 3600.0 / (last_end - first_start)
+
+        return stats
+
+    def start(self, runner: Callable[[RollJob], int]) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            self._runner = runner
+            self._must_stop.clear()
+            self._thread = threading.Thread(target=self._process, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stop processing the queue, once the current roll is finished"""
+        with self._lock:
+            self._must_stop.set()
+            self._changed.notify_all()
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._must_stop.is_set()
+
+    def _process(self) -> None:
+        log.info("Starting roll queue processing")
+
+        while True:
+            with self._lock:
+                job = self._next_pending()
+                while job is None and not self._must_stop.is_set():
+                    self._changed.wait()
+                    job = self._next_pending()
+
+                if self._must_stop.is_set():
+                    break
+
+                job.status = STATUS_RUNNING
+                job.started_at = time.time()
+                self._save()
+
+            log.info("Scanning roll %s in folder %s", job.id, job.folder)
+            self._callback("queue", {"event": "job_started", "id": job.id})
+
+            try:
+                count = self._runner(job)
+                status, error = STATUS_DONE, None
+            except Exception as e:
+                log.exception("Unable to scan roll %s", job.id)
+                count, status, error = 0, STATUS_FAILED, str(e)
+
+            with self._lock:
+                job.status = status
+                job.error = error
+                job.photo_count = count
+                job.finished_at = time.time()
+                self._save()
+
+            self._callback("queue", {"event": "job_finished", "id": job.id, "data": status})
+
+        log.info("Roll queue processing stopped")
+
+    def _next_pending(self) -> Optional[RollJob]:
+        return next((j for j in self._state.jobs if j.status == STATUS_PENDING), None)
+
+    def _find(self, job_id: int) -> RollJob:
+        job = next((j for j in self._state.jobs if j.id == job_id), None)
+        if job is None:
+            raise JobDoesNotExist(f"Job not found: {job_id}")
+        return job
+
+    def _load(self) -> _QueueState:
+        try:
+            with open(self._queue_file, 'r') as f:
+                state = _QueueState.from_json(f.read())
+        except FileNotFoundError:
+            log.info("Queue file not found")
+            return _QueueState(jobs=[])
+        except:
+            log.exception("Unable to read queue file")
+            return _QueueState(jobs=[])
+
+        # A roll interrupted by a restart has to be scanned again
+        for job in state.jobs:
+            if job.status == STATUS_RUNNING:
+                job.status = STATUS_PENDING
+        return state
+
+    def _save(self) -> None:
+        tmp_file = self._queue_file.with_name(self._queue_file.name + ".tmp")
+        with open(tmp_file, 'w') as f:
+            f.write(self._state.to_json(indent=4))
+        os.replace(tmp_file, self._queue_file)
@@ -1,15 +1,21 @@
 import abc
 from dataclasses import dataclass
 import threading
-from typing import Callable, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from .hardware import led
+from .quality import QualityScores
+
+# Device used when none is given
+DEFAULT_DEVICE = "default"
 
 
 @dataclass
 class PhotoInfo:
     index: int
     crop: Optional[Tuple[float, float, float, float]] = None # (x1, y1, x2, y2)
+    position: Optional[int] = None  # Motor steps since the start of the roll
+    quality: Optional[QualityScores] = None
 
 
 class Scanner(abc.ABC):
@@ -24,6 +30,7 @@ class Scanner(abc.ABC):
         self._on_session_stop: Optional[Callable] = None
         self._on_next_photo: Optional[Callable] = None
         self._on_scan_finished: Optional[Callable] = None
+        self._on_progress: Optional[Callable] = None
 
     def start_session(self) -> bool:
         if self.session_started.is_set():
@@ -82,6 +89,14 @@ class Scanner(abc.ABC):
     def on_scan_finished(self, callback: Optional[Callable[[int], None]]) -> None:
         self._on_scan_finished = callback
 
+    @property
+    def on_progress(self) -> Optional[Callable[[Dict[str, Any]], None]]:
+        return self._on_progress
+
+    @on_progress.setter
+    def on_progress(self, callback: Optional[Callable[[Dict[str, Any]], None]]) -> None:
+        self._on_progress = callback
+
     @property
     def is_session_started(self) -> bool:
         return self.session_started.is_set()
@@ -112,3 +127,14 @@ class CanSkipHoles(abc.ABC):
     @abc.abstractmethod
     def skip_holes(self, number_of_holes: int) -> None:
         raise NotImplementedError
+
+
+class CanSeekFrames(abc.ABC):
+    @abc.abstractmethod
+    def rescan_frames(self, frames: List[PhotoInfo]) -> int:
+        """
+        Go back to the positions of the given frames of the last roll, and take them again
+
+        :returns: The number of photos taken
+        """
+        raise NotImplementedError
@@ -5,19 +5,31 @@ from pathlib import Path
 import pathlib
 import random
 import threading
-import shutil
 from typing import Any, Callable, Dict, List, Optional
 
 from dataclasses_json import dataclass_json
 
+from scanner import file_index, file_transfer, frame_counter, journal, manifest, positives, strip_map, thumbnails
 from scanner.frame_counter import FrameCounter
 from scanner.metadata import MetaData
-from scanner.scanner_device import CanSkipHoles, PhotoInfo
+from scanner.scanner_device import DEFAULT_DEVICE, CanSeekFrames, CanSkipHoles, PhotoInfo
+from scanner.strip_map import StripFrame, StripMap, StripMapDoesNotExist
 from . import scanner_device
 from .hardware import camera
 
 log = logging.getLogger(__name__)
 
+# Files are downloaded as soon as the photo is taken
+TRANSFER_IMMEDIATE = "immediate"
+# Only the JPEG files are downloaded during the scan, the others once the roll is scanned
+TRANSFER_DEFERRED = "deferred"
+# No file is downloaded during the scan
+TRANSFER_DEFERRED_ALL = "deferred_all"
+TRANSFER_MODES = [TRANSFER_IMMEDIATE, TRANSFER_DEFERRED, TRANSFER_DEFERRED_ALL]
+
+# Small enough to be downloaded during the scan
+_IMMEDIATE_EXTENSIONS = {".jpg", ".jpeg"}
+
 
 @dataclass_json
 @dataclass(frozen=True)
@@ -26,6 +38,18 @@ class SessionSettings:
     initial_frame: Optional[FrameCounter]
     max_number_of_files: int = 1
     delete_photo_after_download: bool = False
+    transfer_mode: str = TRANSFER_IMMEDIATE
+
+
+@dataclass
+class DeferredFile:
+    """
+    File left on the camera card, until the end of the scan
+    """
+    folder: str
+    name: str
+    destination: Path
+    metadata: Optional[MetaData]
 
 
 class SessionDoesNotExist(Exception):
@@ -33,10 +57,21 @@ class SessionDoesNotExist(Exception):
         self.message = message
 
 
+class SessionIsBusy(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class FrameSeekingNotSupported(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
 class Session:
-    __slots__ = ['id', '_camera', '_scanner', '_callback', '_settings',
-                 '_is_scanning', '_files_per_photo', '_current_frame',
-                 '_exif_tagger', '_destination_storage', ]
+    __slots__ = ['id', 'device_id', '_camera', '_scanner', '_callback', '_settings',
+                 '_is_scanning', '_is_transferring', '_files_per_photo', '_current_frame',
+                 '_exif_tagger', '_destination_storage', '_deferred_files',
+                 '_strip_map', '_rescanned_strip_map', ]
 
     def __init__(self,
                  the_camera: camera.Camera,
@@ -44,9 +79,13 @@ class Session:
                  destination_storage: pathlib.Path,
                  settings: SessionSettings,
                  callback: Callable[[str, Any], None],
-                 exif_tagger: Callable[[Path, MetaData, Callable[[Path], None]], None]) -> None:
+                 exif_tagger: Callable[[Path, MetaData, Callable[[Path], None]], None],
+                 device_id: str = DEFAULT_DEVICE) -> None:
 
         self.id = random.randint(1, 99999)
+        while self.id in SESSIONS:
+            self.id = random.randint(1, 99999)
+        self.device_id = device_id
         self._callback = callback
         self._camera = the_camera
         self._scanner = the_scanner
@@ -55,8 +94,15 @@ class Session:
         self._settings = settings
         self._current_frame = settings.initial_frame
         self._is_scanning = False
+        self._is_transferring = False
+        self._deferred_files: List[DeferredFile] = []
+        self._strip_map = StripMap(session=self.id, destination=str(destination_storage),
+                                   metadata=settings.metadata)
+        # Strip map of the roll scanned again, if any
+        self._rescanned_strip_map: Optional[StripMap] = None
 
         self._init_handlers()
+        journal.record(journal.EVENT_SESSION_START, session=self.id, settings=settings.to_dict())
 
         log.info("Initializing camera")
         self._camera.connect()
@@ -67,6 +113,9 @@ class Session:
 
     def _init_handlers(self):
         def on_stop():
+            # Never idle between the end of the scan and the transfer: the camera must stay open
+            if self._deferred_files:
+                self._is_transferring = True
             self._is_scanning = False
             self._callback("session", {
                 "event": "stop",
@@ -76,31 +125,51 @@ class Session:
 
         def on_photo(info: PhotoInfo):
             # Closure: capture the values for later use
-            frame_count = self._current_frame
-            destination_path = self._destination_storage
-
-            def move_to_destination_callback(file: Path):
-                if file:
-                    shutil.move(str(file), str(destination_path / file.name))
-
-            def download_callback(file: Path):
-                metadata = self._settings.metadata
-                if metadata is None:
-                    return
-                frame_metadata = metadata.with_frame_count(frame_count)
+            if self._rescanned_strip_map is None:
+                the_strip_map = self._strip_map
+                frame_count = self._current_frame
+            else:
+                # Same frame name, metadata and folder as the first time
+                the_strip_map = self._rescanned_strip_map
+                previous_frame = next((f for f in the_strip_map.frames if f.index == info.index), None)
+                frame_count = frame_counter.from_string(previous_frame.frame) if previous_frame is not None else None
+            destination_path = pathlib.Path(the_strip_map.destination)
+
+            frame_metadata = the_strip_map.metadata
+            if frame_metadata is not None:
+                frame_metadata = frame_metadata.with_frame_count(frame_count)
                 if info.crop:
                     frame_metadata = frame_metadata.with_crop(info.crop)
 
-                # Notify the exif tagger to write that info into the file
-                self._exif_tagger(file, frame_metadata, move_to_destination_callback)
+            def defer_file(folder: str, name: str) -> bool:
+                if not self._is_deferred(name):
+                    return False
+                # The frame => camera file map, for the transfer at the end of the roll
+                self._deferred_files.append(DeferredFile(folder, name, destination_path, frame_metadata))
+                journal.record(journal.EVENT_DEFERRED, session=self.id, device=self.device_id,
+                               folder=folder, name=name, destination=str(destination_path),
+                               metadata=frame_metadata.to_dict() if frame_metadata is not None else None)
+                return True
 
             self._camera.take_photo(
                 max_files_count=self._settings.max_number_of_files,
                 delete_after_download=self._settings.delete_photo_after_download,
-                callback=download_callback)
+                callback=self._download_callback(destination_path, frame_metadata),
+                defer_file=defer_file if self._settings.transfer_mode != TRANSFER_IMMEDIATE else None)
+
+            journal.record(journal.EVENT_CAPTURED, session=self.id,
+                           frame=frame_count.current_frame_index if frame_count is not None else None)
+
+            the_strip_map.set_frame(StripFrame(
+                index=info.index,
+                position=info.position,
+                frame=str(frame_count) if frame_count is not None else None,
+                crop=info.crop,
+                quality=info.quality))
+            strip_map.save(the_strip_map)
 
             # Increase the frame counter
-            if self._current_frame is not None:
+            if self._rescanned_strip_map is None and self._current_frame is not None:
                 self._current_frame = self._current_frame.next()
 
             # Notify as soon as the photo is taken, don't wait to download files
@@ -112,6 +181,8 @@ class Session:
                            })
 
         def on_scan_finished(count: int):
+            if self._deferred_files:
+                self._is_transferring = True
             self._is_scanning = False
             self._callback("session",
                            {
@@ -119,6 +190,7 @@ class Session:
                                "id": self.id,
                                "data": count,
                            })
+            self._transfer_deferred_files()
             self.stop()
 
         self._scanner.on_next_photo = on_photo
@@ -128,6 +200,8 @@ class Session:
                         "id": self.id,
                         })
         self._scanner.on_session_stop = on_stop
+        self._scanner.on_progress = lambda data: self._callback(
+            "progress", {"id": self.id, "data": data})
 
     def start_scan_async(self):
         def scan():
@@ -136,8 +210,66 @@ class Session:
             except:
                 log.exception("Unable to scan roll")
                 self._scanner.stop_session()
+                # No transfer after a failure: the files left on the camera are in the journal
+                self._is_transferring = False
 
         threading.Thread(target=scan).start()
+        self._notify_scan_started()
+
+    def scan(self) -> int:
+        """
+        Scan the whole roll and wait until it's finished
+
+        :returns: The number of photos taken
+        """
+        self._notify_scan_started()
+        try:
+            return self._scanner.scan_roll()
+        except:
+            self._scanner.stop_session()
+            self._is_transferring = False
+            raise
+
+    def rescan_async(self, first: int, last: int):
+        """
+        Scan again the frames of the last roll, from index first to last (included).
+        The film must not have been moved since.
+
+        :raises StripMapDoesNotExist: No roll scanned, or frames not found
+        :raises SessionIsBusy: Already scanning or transferring files
+        :raises FrameSeekingNotSupported: The scanner can't go back to a frame
+        """
+        if not isinstance(self._scanner, CanSeekFrames):
+            raise FrameSeekingNotSupported("The scanner can't go back to a frame")
+        if self._is_scanning or self._is_transferring:
+            raise SessionIsBusy(f"Session is scanning: {self.id}")
+
+        last_strip_map = _LAST_STRIP_MAPS.get(self.device_id)
+        if last_strip_map is None:
+            raise StripMapDoesNotExist("No roll scanned")
+        frames = last_strip_map.find_frames(first, last)
+        if not frames:
+            raise StripMapDoesNotExist(f"Frames not found in the strip map: {first} to {last}")
+
+        photos = [PhotoInfo(index=f.index, crop=f.crop, position=f.position) for f in frames]
+        self._rescanned_strip_map = last_strip_map
+
+        def rescan():
+            try:
+                self._scanner.rescan_frames(photos)
+            except:
+                log.exception("Unable to scan frames again")
+                self._scanner.stop_session()
+                self._is_transferring = False
+
+        threading.Thread(target=rescan).start()
+        self._notify_scan_started(is_new_roll=False)
+
+    def _notify_scan_started(self, is_new_roll: bool = True):
+        if is_new_roll:
+            # The positions of the previous roll are lost
+            _LAST_STRIP_MAPS[self.device_id] = self._strip_map
+
         self._is_scanning = True
         self._callback("session",
                        {
@@ -145,6 +277,54 @@ class Session:
                            "id": self.id,
                        })
 
+    def _is_deferred(self, name: str) -> bool:
+        if self._settings.transfer_mode == TRANSFER_DEFERRED_ALL:
+            return True
+        return Path(name).suffix.lower() not in _IMMEDIATE_EXTENSIONS
+
+    def _download_callback(self, destination_path: Path,
+                           frame_metadata: Optional[MetaData]) -> camera.DownloadCallback:
+        return _download_callback(self.id, destination_path, frame_metadata, self._exif_tagger)
+
+    def _transfer_deferred_files(self) -> None:
+        """
+        Download all the files left on the camera during the scan.
+        Each file is tagged and moved by the tagger thread while the next one is downloaded.
+        """
+        if not self._deferred_files:
+            return
+
+        self._is_transferring = True
+        deferred_files, self._deferred_files = self._deferred_files, []
+        log.info("Transferring %s files from the camera", len(deferred_files))
+        self._callback("session", {
+            "event": "transfer_started",
+            "id": self.id,
+            "data": len(deferred_files),
+        })
+
+        transferred = 0
+        try:
+            for f in deferred_files:
+                try:
+                    self._camera.download_file(
+                        f.folder, f.name,
+                        delete_after_download=self._settings.delete_photo_after_download,
+                        callback=self._download_callback(f.destination, f.metadata))
+                    journal.record(journal.EVENT_TRANSFERRED, device=self.device_id, folder=f.folder, name=f.name)
+                    transferred += 1
+                except camera.CameraException as e:
+                    # Still on the camera card
+                    log.error("Unable to transfer %s/%s: %s", f.folder, f.name, e.message)
+        finally:
+            self._is_transferring = False
+
+        self._callback("session", {
+            "event": "transfer_finished",
+            "id": self.id,
+            "data": transferred,
+        })
+
     def skip_holes_async(self, number_of_holes: int):
         if isinstance(self._scanner, CanSkipHoles):
             threading.Thread(target=lambda n: self._scanner.skip_holes(
@@ -153,18 +333,127 @@ class Session:
     def stop(self):
         if self.id in SESSIONS:
             del SESSIONS[self.id]
+            journal.record(journal.EVENT_SESSION_END, session=self.id)
+
+        if self._deferred_files:
+            # Still in the journal: transferred at the next start
+            log.warning("Scan stopped, files left on the camera: %s",
+                        ", ".join(f"{f.folder}/{f.name}" for f in self._deferred_files))
+            self._deferred_files = []
 
         self._camera.close()
         self._scanner.stop_session()
 
+    @property
+    def destination(self) -> Path:
+        return self._destination_storage
+
     @property
     def is_scanning(self) -> bool:
         return self._is_scanning
 
+    @property
+    def is_transferring(self) -> bool:
+        return self._is_transferring
+
     @property
     def support_hole_skipping(self) -> bool:
         return isinstance(self._scanner, scanner_device.CanSkipHoles)
 
+    @property
+    def support_frame_seeking(self) -> bool:
+        return isinstance(self._scanner, scanner_device.CanSeekFrames)
+
+
+def _download_callback(session_id: Optional[int], destination_path: Path, frame_metadata: Optional[MetaData],
+                       exif_tagger: Callable[[Path, MetaData, Callable[[Path], None]], None]) -> camera.DownloadCallback:
+    def download_callback(file: Path, content_hash: Optional[str] = None):
+        if frame_metadata is None:
+            return
+
+        # Such as a file downloaded again after a crash: already tagged and moved
+        if file_index.is_duplicate(content_hash, frame_metadata.roll_id):
+            log.info("Skipping duplicate of an indexed file: %s", file)
+            file.unlink(missing_ok=True)
+            return
+
+        journal.record(journal.EVENT_DOWNLOADED, session=session_id, file=str(file),
+                       destination=str(destination_path), metadata=frame_metadata.to_dict(),
+                       content_hash=content_hash)
+
+        # Notify the exif tagger to write that info into the file
+        exif_tagger(file, frame_metadata,
+                    lambda f: _tagged_callback(f, destination_path, session_id, frame_metadata, content_hash))
+
+    return download_callback
+
+
+def _tagged_callback(file: Path, destination_path: Path,
+                     session_id: Optional[int], metadata: Optional[MetaData],
+                     content_hash: Optional[str] = None):
+    journal.record(journal.EVENT_TAGGED, file=str(file))
+    _move_to_destination(file, destination_path, session_id, metadata, tagged=True, content_hash=content_hash)
+
+
+def _move_to_destination(file: Path, destination_path: Path,
+                         session_id: Optional[int], metadata: Optional[MetaData],
+                         tagged: bool = False, content_hash: Optional[str] = None):
+    if file:
+        destination_path.mkdir(parents=True, exist_ok=True)
+        destination_file = destination_path / file.name
+        # Verified and synced before the temporary file is removed
+        file_transfer.move_file(file, destination_file)
+        journal.record(journal.EVENT_MOVED, file=str(file))
+
+        frame = metadata.exposure_number if metadata is not None else None
+        roll_id = metadata.roll_id if metadata is not None else None
+        manifest.record_file(destination_file, session_id, frame, roll_id)
+        file_index.record_file(destination_file, session_id, frame, roll_id, tagged, content_hash)
+        thumbnails.submit(destination_file)
+        if tagged:
+            positives.submit(destination_file, metadata, session_id)
+
+
+def resume_pending_files(pending_files: List[journal.PendingFile],
+                         exif_tagger: Callable[[Path, MetaData, Callable[[Path], None]], None]) -> None:
+    """
+    Finish tagging and moving the files left behind by a crash
+    """
+    for p in pending_files:
+        if not p.file.exists():
+            # Moved just before the crash, or lost
+            log.warning("Pending file not found: %s", p.file)
+            journal.record(journal.EVENT_MOVED, file=str(p.file))
+        elif p.tagged or p.metadata is None:
+            _move_to_destination(p.file, p.destination, p.session, p.metadata,
+                                 tagged=p.tagged, content_hash=p.content_hash)
+        else:
+            log.info("Resuming tagging of: %s", p.file)
+            exif_tagger(p.file, p.metadata,
+                        lambda f, p=p: _tagged_callback(f, p.destination, p.session, p.metadata, p.content_hash))
+
+
+def resume_deferred_files(the_camera: camera.Camera, deferred_files: List[journal.PendingDeferredFile],
+                          exif_tagger: Callable[[Path, MetaData, Callable[[Path], None]], None]) -> None:
+    """
+    Download the files left on the camera card by an interrupted session
+
+    :raises CameraException: Camera not connected
+    """
+    the_camera.connect()
+    try:
+        for f in deferred_files:
+            log.info("Resuming transfer of: %s/%s", f.folder, f.name)
+            try:
+                the_camera.download_file(f.folder, f.name,
+                                         callback=_download_callback(f.session, f.destination, f.metadata, exif_tagger))
+                journal.record(journal.EVENT_TRANSFERRED, device=f.device, folder=f.folder, name=f.name)
+            except camera.CameraException as e:
+                # Still on the camera card: next start
+                log.error("Unable to transfer %s/%s: %s", f.folder, f.name, e.message)
+    finally:
+        the_camera.close()
+
 
 def get_session(id: int) -> Session:
     session = SESSIONS.get(id)
@@ -178,22 +467,52 @@ def get_or_new_session(the_camera: camera.Camera,
                        destination_storage: pathlib.Path,
                        settings: SessionSettings,
                        callback: Callable[[str, Any], None],
-                       exif_tagger: Callable[[Path, MetaData, Callable[[Path], None]], None]) -> Session:
+                       exif_tagger: Callable[[Path, MetaData, Callable[[Path], None]], None],
+                       device_id: str = DEFAULT_DEVICE) -> Session:
 
-    # In reality, we only support one session
-    if SESSIONS:
-        key = next(iter(SESSIONS))
-        return SESSIONS[key]
+    # In reality, we only support one session per device
+    existing_session = next((s for s in SESSIONS.values() if s.device_id == device_id), None)
+    if existing_session is not None:
+        return existing_session
 
     # No existing session, create a new one
     new_session = Session(the_camera, the_scanner, destination_storage,
-                          settings, callback, exif_tagger)
+                          settings, callback, exif_tagger, device_id)
     SESSIONS[new_session.id] = new_session
     return new_session
 
 
-def list_session_ids() -> List[int]:
-    return list(SESSIONS.keys())
+def new_session(the_camera: camera.Camera,
+                the_scanner: scanner_device.Scanner,
+                destination_storage: pathlib.Path,
+                settings: SessionSettings,
+                callback: Callable[[str, Any], None],
+                exif_tagger: Callable[[Path, MetaData, Callable[[Path], None]], None],
+                device_id: str = DEFAULT_DEVICE) -> Session:
+
+    # Roll over: idle sessions of the device are replaced by the new one
+    for existing_session in [s for s in SESSIONS.values() if s.device_id == device_id]:
+        if existing_session.is_scanning or existing_session.is_transferring:
+            raise SessionIsBusy(f"Session is scanning: {existing_session.id}")
+        existing_session.stop()
+
+    new_session = Session(the_camera, the_scanner, destination_storage,
+                          settings, callback, exif_tagger, device_id)
+    SESSIONS[new_session.id] = new_session
+    return new_session
+
+
+def active_destinations() -> List[Path]:
+    """
+    Destination folders of the sessions, which may still receive files
+    """
+    return [s.destination for s in SESSIONS.values()]
+
+
+def list_session_ids(device_id: Optional[str] = None) -> List[int]:
+    return [k for k, s in SESSIONS.items() if device_id is None or s.device_id == device_id]
 
 
 SESSIONS: Dict[int, Session] = {}
+# Device => strip map of the roll scanned last, the only one whose positions are still valid
+_LAST_STRIP_MAPS: Dict[str, StripMap] = {}
@@ -1,8 +1,12 @@
+import atexit
+import copy
 import logging
+import os
 import pathlib
 import threading
-from dataclasses import dataclass
-from typing import Optional
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional
 
 from dataclasses_json import dataclass_json
 
@@ -10,7 +14,12 @@ from scanner.session import SessionSettings
 
 log = logging.getLogger(__name__)
 
+# Writes are delayed to group rapid changes
+WRITE_DELAY = 0.5   # seconds
+
 _saver_lock = threading.Lock()
+_write_lock = threading.Lock()
+_write_requested = threading.Event()
 
 
 @dataclass_json
@@ -25,17 +34,33 @@ class CameraSettings:
 @dataclass_json
 @dataclass
 class ApplicationSettings:
-    last_camera_settings: CameraSettings = CameraSettings()
+    last_camera_settings: CameraSettings = field(default_factory=CameraSettings)
     last_session_settings: Optional[SessionSettings] = None
+    # Camera model => last settings used with that model
+    camera_settings_by_model: Dict[str, CameraSettings] = field(default_factory=dict)
+    # Film type => calibrated settings
+    calibration_by_film_type: Dict[str, CameraSettings] = field(default_factory=dict)
+
+    def camera_settings(self, camera_model: Optional[str]) -> CameraSettings:
+        """
+        Settings of the camera model, to be modified
+        """
+        if not camera_model:
+            return self.last_camera_settings
+        return self.camera_settings_by_model.setdefault(camera_model, CameraSettings())
+
+    def last_camera_settings_for(self, camera_model: Optional[str]) -> CameraSettings:
+        return self.camera_settings_by_model.get(camera_model, self.last_camera_settings)
 
 
 _settings_file: pathlib.Path
 _current_settings = ApplicationSettings()
+_writer_thread: Optional[threading.Thread] = None
 
 
 def init_settings(settings_filename: str):
     with _saver_lock:
-        global _settings_file, _current_settings
+        global _settings_file, _current_settings, _writer_thread
 
         _settings_file = pathlib.Path(settings_filename)
         try:
@@ -50,35 +75,70 @@ def init_settings(settings_filename: str):
         except:
             log.exception("Unable to read settings file")
 
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=_write_behind, daemon=True)
+            _writer_thread.start()
+            atexit.register(flush_settings)
+
 
 def get_settings():
     return _current_settings
 
 
+def flush_settings() -> None:
+    """
+    Write the pending changes right now
+    """
+    if _write_requested.is_set():
+        _write_requested.clear()
+        _write_settings()
+
+
 class SettingsSaver:
     __slots__ = ['_settings', ]
-        
+
     def __enter__(self) -> ApplicationSettings:
         # It's not possible to use multiple savers at the same time
         _saver_lock.acquire()
 
         # Deep copy of the settings
-        if _current_settings is not None:
-            self._settings = ApplicationSettings.from_json(_current_settings.to_json())
-        else:
-            self._settings = ApplicationSettings()
-
+        self._settings = copy.deepcopy(_current_settings)
         return self._settings
-    
+
     def __exit__(self, type, value, traceback):
         try:
-            # Pretty-print the saved file
-            raw_json = self._settings.to_json(indent=4)
-            with open(_settings_file, 'w') as f:
-                f.write(raw_json)
-
-            # Store locally
-            global _current_settings
-            _current_settings = self._settings
+            if type is None:
+                # Available right away, written to the disk later
+                global _current_settings
+                _current_settings = self._settings
+                _write_requested.set()
         finally:
             _saver_lock.release()
+
+
+def _write_behind() -> None:
+    while True:
+        _write_requested.wait()
+        # Let rapid changes accumulate
+        time.sleep(WRITE_DELAY)
+        if _write_requested.is_set():
+            _write_requested.clear()
+            _write_settings()
+
+
+def _write_settings() -> None:
+    with _write_lock:
+        with _saver_lock:
+            # Pretty-print the saved file
+            raw_json = _current_settings.to_json(indent=4)
+
+        # Atomic replacement, so that a crash never leaves a partial file
+        tmp_file = _settings_file.with_name(_settings_file.name + ".tmp")
+        try:
+            with open(tmp_file, 'w') as f:
+                f.write(raw_json)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, _settings_file)
+        except:
+            log.exception("Unable to write settings file")
@@ -0,0 +1,114 @@
+"""
+Position of each captured frame on the film strip, for each scanned roll.
+The positions are in signed motor steps since the start of the roll: as long as the film
+isn't moved by hand, the scanner can go straight back to a frame to scan it again.
+"""
+
+from dataclasses import dataclass, field
+import logging
+import os
+import pathlib
+import threading
+from typing import List, Optional, Tuple
+
+from dataclasses_json import dataclass_json
+
+from scanner.metadata import MetaData
+from scanner.quality import QualityScores
+
+log = logging.getLogger(__name__)
+
+
+@dataclass_json
+@dataclass
+class StripFrame:
+    index: int
+    position: Optional[int]     # Motor steps since the start of the roll
+    frame: Optional[str] = None     # Frame name
+    crop: Optional[Tuple[float, float, float, float]] = None
+    quality: Optional[QualityScores] = None
+
+
+@dataclass_json
+@dataclass
+class StripMap:
+    session: int
+    destination: str
+    metadata: Optional[MetaData] = None
+    frames: List[StripFrame] = field(default_factory=list)
+
+    @property
+    def roll_id(self) -> Optional[str]:
+        return self.metadata.roll_id if self.metadata is not None else None
+
+    def find_frames(self, first: int, last: int) -> List[StripFrame]:
+        return [f for f in self.frames if first <= f.index <= last]
+
+    def set_frame(self, strip_frame: StripFrame) -> None:
+        for i, f in enumerate(self.frames):
+            if f.index == strip_frame.index:
+                self.frames[i] = strip_frame
+                return
+        self.frames.append(strip_frame)
+
+
+class StripMapDoesNotExist(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class StripMapStore:
+    """
+    One JSON file per session
+    """
+    __slots__ = ['_directory', '_lock', ]
+
+    def __init__(self, directory: pathlib.Path) -> None:
+        self._directory = directory
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def save(self, strip_map: StripMap) -> None:
+        strip_map_file = self._file(strip_map.session)
+        tmp_file = strip_map_file.with_name(strip_map_file.name + ".tmp")
+        with self._lock:
+            raw_json = strip_map.to_json(indent=4)
+            with open(tmp_file, 'w') as f:
+                f.write(raw_json)
+            os.replace(tmp_file, strip_map_file)
+
+    def load(self, session: int) -> StripMap:
+        try:
+            with open(self._file(session), 'r') as f:
+                return StripMap.from_json(f.read())
+        except FileNotFoundError:
+            raise StripMapDoesNotExist(f"Strip map not found: {session}")
+
+    def list_sessions(self) -> List[int]:
+        return sorted(int(f.stem) for f in self._directory.glob("*.json") if f.stem.isdigit())
+
+    def _file(self, session: int) -> pathlib.Path:
+        return self._directory / f"{session}.json"
+
+
+_store: Optional[StripMapStore] = None
+
+
+def init_strip_maps(directory: str) -> StripMapStore:
+    global _store
+    _store = StripMapStore(pathlib.Path(directory))
+    return _store
+
+
+def get_strip_maps() -> Optional[StripMapStore]:
+    return _store
+
+
+def save(strip_map: StripMap) -> None:
+    if _store is None:
+        return
+
+    try:
+        _store.save(strip_map)
+    except Exception:
+        log.exception("Unable to save the strip map of session %s", strip_map.session)
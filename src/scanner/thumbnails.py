@@ -0,0 +1,218 @@
+"""
+Thumbnails of the scanned photos, generated in the background.
+RAW files embed a JPEG preview, which is much faster to decode than the RAW data.
+Thumbnails are stored in a cache directory, the least recently used ones are
+removed when the cache is full.
+"""
+
+import collections
+import io
+import logging
+import mmap
+import os
+import pathlib
+import queue
+import tempfile
+import threading
+from typing import Optional, OrderedDict, Tuple
+
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+# Size name => maximum width or height
+SIZES = {
+    "small": 256,
+    "medium": 1024,
+}
+DEFAULT_SIZE = "small"
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024  # bytes
+JPEG_QUALITY = 85
+
+PILLOW_FORMATS = {".jpg", ".jpeg", ".png", ".tif", ".tiff"}
+_JPEG_START = b"\xff\xd8\xff"
+# Enough to read the dimensions after the EXIF segment
+HEADER_SIZE = 256 * 1024
+
+
+class ThumbnailCache:
+    __slots__ = ['_cache_path', '_root', '_max_bytes', '_entries', '_total_bytes', '_lock', '_queue', ]
+
+    def __init__(self, cache_path: pathlib.Path, root: pathlib.Path, max_bytes: int = DEFAULT_CACHE_SIZE) -> None:
+        self._cache_path = cache_path
+        self._root = root
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Thumbnail file => size in bytes, least recently used first
+        self._entries: OrderedDict[pathlib.Path, int] = collections.OrderedDict()
+        self._total_bytes = 0
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._load()
+
+        threading.Thread(target=self._generate_thread, daemon=True).start()
+
+    def submit(self, file: pathlib.Path) -> None:
+        """
+        Generate the thumbnails of a file in the background
+        """
+        self._queue.put(file)
+
+    def get(self, name: str, size: str = DEFAULT_SIZE) -> Optional[pathlib.Path]:
+        """
+        Thumbnail of the file of the share, generated now if needed.
+
+        :returns: None if the file doesn't exist, or has no image to show
+        """
+        source = (self._root / name).resolve()
+        if self._root.resolve() not in source.parents or not source.is_file():
+            return None
+
+        thumbnail = self._thumbnail_path(source, size)
+        try:
+            with self._lock:
+                is_cached = thumbnail in self._entries and self._is_up_to_date(thumbnail, source)
+                if is_cached:
+                    self._entries.move_to_end(thumbnail)
+
+            if is_cached:
+                # Persist the recent use for the next start
+                os.utime(thumbnail)
+            else:
+                self._generate(source)
+        except FileNotFoundError:
+            # Removed outside of the application
+            return None
+        except (ValueError, OSError) as e:
+            # Such as a RAW file without embedded preview
+            log.warning("No thumbnail for %s: %s", source, e)
+            return None
+        return thumbnail
+
+    def _generate_thread(self) -> None:
+        while True:
+            file = self._queue.get()
+            try:
+                self._generate(file)
+            except Exception:
+                log.exception("Unable to generate the thumbnails of %s", file)
+
+    def _generate(self, source: pathlib.Path) -> None:
+        # Largest size first, the smaller ones are downscaled from it
+        image = None
+        for size, pixels in sorted(SIZES.items(), key=lambda s: s[1], reverse=True):
+            if image is None:
+                image = _open_preview(source, pixels)
+            image.thumbnail((pixels, pixels))
+
+            thumbnail = self._thumbnail_path(source, size)
+            thumbnail.parent.mkdir(parents=True, exist_ok=True)
+            # Unique name: the request and the worker may generate the same thumbnail
+            with tempfile.NamedTemporaryFile(dir=thumbnail.parent, prefix=thumbnail.name,
+                                             suffix=".tmp", delete=False) as tmp_file:
+                try:
+                    image.save(tmp_file, "JPEG", quality=JPEG_QUALITY)
+                except BaseException:
+                    os.unlink(tmp_file.name)
+                    raise
+            os.replace(tmp_file.name, thumbnail)
+            self._add_entry(thumbnail)
+
+    def _add_entry(self, thumbnail: pathlib.Path) -> None:
+        with self._lock:
+            self._total_bytes -= self._entries.pop(thumbnail, 0)
+            size = thumbnail.stat().st_size
+            self._entries[thumbnail] = size
+            self._total_bytes += size
+
+            while self._total_bytes > self._max_bytes and len(self._entries) > 1:
+                oldest, oldest_size = self._entries.popitem(last=False)
+                self._total_bytes -= oldest_size
+                try:
+                    oldest.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def _is_up_to_date(self, thumbnail: pathlib.Path, source: pathlib.Path) -> bool:
+        try:
+            thumbnail_time = thumbnail.stat().st_mtime
+        except FileNotFoundError:
+            # Removed outside of the application: generated again
+            self._total_bytes -= self._entries.pop(thumbnail)
+            return False
+        return thumbnail_time >= source.stat().st_mtime
+
+    def _thumbnail_path(self, source: pathlib.Path, size: str) -> pathlib.Path:
+        relative = source.resolve().relative_to(self._root.resolve())
+        return self._cache_path / size / relative.with_name(relative.name + ".jpg")
+
+    def _load(self) -> None:
+        files = [f for f in self._cache_path.glob('**/*.jpg') if f.is_file()]
+        stats = {f: f.stat() for f in files}
+
+        # Last use is the modification time
+        for f in sorted(files, key=lambda f: stats[f].st_mtime):
+            self._entries[f] = stats[f].st_size
+            self._total_bytes += stats[f].st_size
+        log.info("Thumbnail cache: %s files, %s bytes", len(self._entries), self._total_bytes)
+
+
+def open_image(source: pathlib.Path) -> Image.Image:
+    """
+    Image of the file, or the JPEG embedded in it for RAW files
+    """
+    if source.suffix.lower() in PILLOW_FORMATS:
+        return Image.open(source)
+    return _open_embedded_jpeg(source)
+
+
+def _open_preview(source: pathlib.Path, pixels: int) -> Image.Image:
+    image = open_image(source)
+
+    # JPEG only: decode directly at a reduced scale
+    image.draft('RGB', (pixels, pixels))
+    return image.convert('RGB')
+
+
+def _open_embedded_jpeg(source: pathlib.Path) -> Image.Image:
+    """
+    Largest JPEG embedded in a RAW file
+    """
+    with open(source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        best: Optional[Tuple[int, int]] = None    # (pixels, offset)
+        offset = content.find(_JPEG_START)
+        while offset >= 0:
+            try:
+                # Only the header is read
+                with Image.open(io.BytesIO(content[offset:offset + HEADER_SIZE])) as candidate:
+                    if candidate.format == "JPEG":
+                        pixels = candidate.width * candidate.height
+                        if best is None or pixels > best[0]:
+                            best = (pixels, offset)
+            except (OSError, SyntaxError, ValueError):
+                # Not an image, just the same bytes
+                pass
+            offset = content.find(_JPEG_START, offset + len(_JPEG_START))
+
+        if best is None:
+            raise ValueError(f"No embedded preview: {source}")
+
+        image = Image.open(io.BytesIO(content[best[1]:]))
+    return image
+
+
+_cache: Optional[ThumbnailCache] = None
+
+
+def init_thumbnails(cache_path: pathlib.Path, root: pathlib.Path, max_bytes: int = DEFAULT_CACHE_SIZE) -> ThumbnailCache:
+    global _cache
+    _cache = ThumbnailCache(cache_path, root, max_bytes)
+    return _cache
+
+
+def get_thumbnails() -> Optional[ThumbnailCache]:
+    return _cache
+
+
+def submit(file: pathlib.Path) -> None:
+    if _cache is not None:
+        _cache.submit(file)
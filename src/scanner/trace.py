@@ -0,0 +1,103 @@
+"""
+Trace of the scan loops: one JSON line per cycle, such as the detections or the
+light measures of each motor step. Records are queued and written by a background
+thread, so the loops only pay for building a dictionary.
+When the file gets too large, it's renamed with a ".1" suffix and a new one is started.
+"""
+
+import json
+import logging
+import pathlib
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 32 * 1024 * 1024     # bytes
+# Beyond it, records are dropped rather than blocking the loops
+QUEUE_SIZE = 10000
+WRITE_INTERVAL = 1.0    # seconds
+
+
+class Trace:
+    __slots__ = ['_trace_file', '_max_size', '_queue', '_dropped', '_must_stop', '_thread', ]
+
+    def __init__(self, trace_file: pathlib.Path, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self._trace_file = trace_file
+        self._max_size = max_size
+        self._queue: queue.Queue = queue.Queue(QUEUE_SIZE)
+        self._dropped = 0
+        self._must_stop = threading.Event()
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def record(self, kind: str, **data) -> None:
+        try:
+            self._queue.put_nowait({"kind": kind, "time": time.time(), **data})
+        except queue.Full:
+            self._dropped += 1
+
+    def close(self) -> None:
+        self._must_stop.set()
+        self._thread.join()
+
+    def _write(self) -> None:
+        f = open(self._trace_file, 'a')
+        try:
+            while True:
+                is_stopping = self._must_stop.wait(WRITE_INTERVAL)
+
+                # Written by batches
+                records: List[Dict[str, Any]] = []
+                while True:
+                    try:
+                        records.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if self._dropped:
+                    records.append({"kind": "dropped", "time": time.time(), "count": self._dropped})
+                    self._dropped = 0
+
+                for r in records:
+                    try:
+                        f.write(json.dumps(r, default=str) + "\n")
+                    except ValueError:
+                        log.exception("Unable to trace: %s", r.get("kind"))
+                f.flush()
+
+                if f.tell() >= self._max_size:
+                    f.close()
+                    self._trace_file.replace(self._trace_file.with_name(self._trace_file.name + ".1"))
+                    f = open(self._trace_file, 'a')
+
+                if is_stopping:
+                    return
+        except Exception:
+            log.exception("Trace stopped")
+        finally:
+            f.close()
+
+
+_trace: Optional[Trace] = None
+
+
+def init_trace(trace_filename: str, max_size: int = DEFAULT_MAX_SIZE) -> Trace:
+    global _trace
+    trace_file = pathlib.Path(trace_filename)
+    trace_file.parent.mkdir(parents=True, exist_ok=True)
+    _trace = Trace(trace_file, max_size)
+    return _trace
+
+
+def record(kind: str, **data) -> None:
+    if _trace is not None:
+        _trace.record(kind, **data)
+
+
+def close_trace() -> None:
+    global _trace
+    if _trace is not None:
+        _trace.close()
+        _trace = None
@@ -29,6 +29,12 @@ def parse_arguments() -> argparse.Namespace:
                         help='Verbose mode')
     parser.add_argument('--dryrun', action='store_true',
                         help='Dry run without camera')
+    parser.add_argument('--log_rate', default='10', type=float,
+                        help='Maximum number of info messages per second from each line of code, 0 for no limit')
+    parser.add_argument('--trace', default='/storage/trace.jsonl', type=str,
+                        help='JSON lines file of the data of each scan cycle')
+    parser.add_argument('--trace_size', default='32', type=int,
+                        help='Maximum size of the trace file, in MB, before it is rotated')
 
     # Hardware configuration
     parser.add_argument('--pin1', '-p1', default='5', type=int, help='BCM pin for IN1')
@@ -40,13 +46,40 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument('--buttonstart', '-s', default='20', type=int, help='BCM pin for the start button')
     parser.add_argument('--buttonskip', '-k', default='21', type=int, help='BCM pin for the skip button')
     parser.add_argument('--infrared', '-ir', action='store_true', help='Use infrared LED')
+    parser.add_argument('--scanner', default='detector', type=str, choices=['detector', 'hole_counter'],
+                        help='How the frames are found: object detection on the previews, or holes counted with the lux meter')
+    parser.add_argument('--lux_gain', type=int, choices=[0, 1], help='Lux meter gain: 0 (1x) or 1 (16x), automatic by default')
+    parser.add_argument('--lux_integration_time', type=int, choices=[0, 1, 2], help='Lux meter integration time: 0 (13.7ms), 1 (101ms) or 2 (402ms), the fastest usable one by default')
+    parser.add_argument('--devices', type=str, help='JSON file of the additional devices: id, backlight, pin1 to pin4 and camera_port of each, and optionally scanner, led, led_use_infrared, lux_gain and lux_integration_time')
     parser.add_argument('--use_edge_tpu', '-tpu', action='store_true', help='Use Coral Edge TPU')
 
+    # Object detection model
+    parser.add_argument('--model_variant', type=str, help='Object detection model variant, or "auto" to select the fastest one')
+    parser.add_argument('--model_previews', type=str, help='Directory of recorded previews, used to select the model variant')
+    parser.add_argument('--inference_workers', default='1', type=int, help='Number of object detection interpreters, shared by all the devices')
+    parser.add_argument('--remote_inference', type=str, help='Inference worker on the LAN, host:port: the local interpreters are used when it doesn\'t answer')
+    parser.add_argument('--model_min_accuracy', default='0.95', type=float, help='Minimum accuracy of the automatically selected model variant')
+
     # Storage paths
     parser.add_argument('--destination', '-d', default='/share', type=str, help='Destination path')
     parser.add_argument('--archive', '-a', default='/archive', type=str, help='Archive path')
     parser.add_argument('--temp', '-t', default='/tmp', type=str, help='Temporary path')
     parser.add_argument('--settings', default='/configuration/settings.json', type=str, help='Settings storage file')
+    parser.add_argument('--user_films', default='/configuration/films_user.csv', type=str, help='File of the films added by users')
+    parser.add_argument('--queue', default='/configuration/queue.json', type=str, help='Roll queue storage file')
+    parser.add_argument('--journal', default='/storage/journal.jsonl', type=str, help='Session journal file, used to recover after a crash')
+    parser.add_argument('--manifest', default='/storage/manifest.jsonl', type=str, help='Manifest of the files which reached the destination path')
+    parser.add_argument('--thumbnails', default='/storage/thumbnails', type=str, help='Thumbnail cache path')
+    parser.add_argument('--thumbnails_size', default='512', type=int, help='Maximum size of the thumbnail cache, in MB')
+    parser.add_argument('--strip_maps', default='/storage/strip_maps', type=str, help='Position of the frames of each scanned roll')
+    parser.add_argument('--file_index', default='/storage/file_index.sqlite', type=str, help='Index of the files in the share and the archive')
+    parser.add_argument('--min_free_space', default='1024', type=int, help='Free space kept on the temporary, destination and archive paths, in MB: the scans pause below it')
+    parser.add_argument('--max_backlog', default='40', type=int, help='Maximum number of files waiting to be downloaded, tagged and moved: the scans pause above it')
+
+    # Post-processing
+    parser.add_argument('--positives', action='store_true', help='Convert the colour negatives to positive JPEG files')
+    parser.add_argument('--positives_workers', default='1', type=int, help='Number of positive conversion processes')
+    parser.add_argument('--positives_queue', default='8', type=int, help='Maximum number of photos waiting for conversion, the next ones are skipped')
 
     # Web server configuration 
     parser.add_argument('--port', default='5000', type=int, help='Server port to listen to')
@@ -1,37 +1,60 @@
+import dataclasses
 import logging
 import pathlib
 import sys
 import threading
-import queue
-from typing import Any, Callable
+from typing import Any, Callable, Optional
 from http import HTTPStatus
 
-from flask import Flask
-from flask_restx import Api, Resource, fields
+from flask import Flask, request, send_file
+from flask_restx import Api, Resource, fields, inputs
 from flask_socketio import SocketIO
 
 from scanner import scanner_device, utils, archive, session
-from scanner import exif_tagger
+from scanner import calibration
+from scanner import event_bus
+from scanner import file_index
 from scanner import frame_counter
-from scanner import detector_scanner
+from scanner import journal
+from scanner import log_pipeline
+from scanner import manifest
+from scanner import devices
+from scanner import exif_tagger
+from scanner import model_benchmark
+from scanner import model_registry
+from scanner import object_detection
+from scanner import positives
+from scanner import reference_data
+from scanner import remote_inference
+from scanner import resources
+from scanner import roll_queue
 from scanner import settings
-from scanner.exif import develop_process, film_type, films
-from scanner.hardware import camera
+from scanner import strip_map
+from scanner import thumbnails
+from scanner import trace
+from scanner.exif import films
+from scanner.hardware import camera, camera_supervisor
 from scanner.metadata import MetaData
-from scanner.session import Session, SessionSettings, SessionDoesNotExist
+from scanner.session import Session, SessionSettings, SessionDoesNotExist, SessionIsBusy, FrameSeekingNotSupported
 
 log = logging.getLogger(__name__)
 
 SOCKET_IO_NAMESPACE = "/scanner_events"
 METADATA_PREFIX = "metadata_"
+MAX_LONG_POLLING_WAIT = 60.0
+REFERENCE_MAX_AGE = 24 * 3600
+THUMBNAIL_MAX_AGE = 3600
+
+BROADCAST_WAIT = 1.0
 
 thread = None
 thread_lock = threading.Lock()
-message_queue: queue.SimpleQueue = queue.SimpleQueue()
+message_bus = event_bus.EventBus()
 
 archive_storage = archive.Archive()
-capture_camera: camera.Camera
+capture_camera: camera_supervisor.SupervisedCamera
 the_scanner: scanner_device.Scanner
+the_roll_queue: roll_queue.RollQueue
 exif_tag_func: Callable[[pathlib.Path, MetaData,
                          Callable[[pathlib.Path], None]], None]
 
@@ -46,11 +69,85 @@ api = Api(app, version='1.0', title='RoboScan API',
 ns = api.namespace('scanner', description='Scanner API')
 
 file_details = api.model('File', {
-    'name': fields.String(required=True, description='The file name')
+    'name': fields.String(required=True, description='The file name'),
+    'size': fields.Integer(required=True, description='File size in bytes'),
+    'session': fields.Integer(required=False, description='Session ID'),
+    'frame': fields.Integer(required=False, description='Frame number'),
+    'roll_id': fields.String(required=False, description='Metadata: roll identifier'),
+    'captured_at': fields.Float(required=False, description='Capture time (UNIX timestamp)'),
+    'tagged': fields.Boolean(required=True, description='True if the metadata were written into the file'),
+})
+
+file_list_model = api.model('FileList', {
+    'total': fields.Integer(required=False, description='Number of files matching the filters, if asked'),
+    'next': fields.String(required=False, description='Value of "after" to get the next page, if any'),
+    'files': fields.List(fields.Nested(file_details), required=True, description='Page of files, sorted by name'),
 })
 
 file_operation_result = api.model('FileOperationResult', {
-    'count': fields.Integer(required=True, description='The number of files modified'),
+    'count': fields.Integer(required=True, description='The number of files modified, 0 for a background job until it runs'),
+    'job_id': fields.Integer(required=False, description='ID of the background job modifying the files'),
+})
+
+duplicate_file_model = api.model('DuplicateFile', {
+    'location': fields.String(required=True, description='share or archive'),
+    'name': fields.String(required=True, description='File path, relative to the location'),
+})
+
+duplicate_group_model = api.model('DuplicateGroup', {
+    'size': fields.Integer(required=True, description='File size in bytes'),
+    'content_hash': fields.String(required=True, description='SHA-256 of the files'),
+    'files': fields.List(fields.Nested(duplicate_file_model), required=True, description='Files with the same content, the first one is kept'),
+    'reclaimable_bytes': fields.Integer(required=True, description='Space used by the copies which are not hard links'),
+})
+
+duplicate_report_model = api.model('DuplicateReport', {
+    'groups': fields.List(fields.Nested(duplicate_group_model), required=True, description='Groups of identical files'),
+    'files_scanned': fields.Integer(required=True, description='Number of files in the share and the archive'),
+    'files_hashed': fields.Integer(required=True, description='Number of files read entirely, sharing their size with another file'),
+    'reclaimable_bytes': fields.Integer(required=True, description='Space which hard links would reclaim'),
+    'reclaimed_bytes': fields.Integer(required=True, description='Space reclaimed by this call'),
+    'elapsed_seconds': fields.Float(required=True, description='Duration of the search'),
+})
+
+archive_job_model = api.model('ArchiveJob', {
+    'id': fields.Integer(required=True, description='Job ID'),
+    'operation': fields.String(required=True, description='Operation: move, delete, find_duplicates or link_duplicates'),
+    'status': fields.String(required=True, description='Job status: pending, running, done, failed or cancelled'),
+    'session': fields.Integer(required=False, description='Only the files of this session'),
+    'roll_id': fields.String(required=False, description='Only the files of this roll'),
+    'total': fields.Integer(required=True, description='Number of files to process, known once the job runs, or so far for the duplicates'),
+    'processed': fields.Integer(required=True, description='Number of files processed, or read for the duplicates'),
+    'failed': fields.Integer(required=True, description='Number of files which could not be processed'),
+    'created_at': fields.Float(required=False, description='Submission time (UNIX timestamp)'),
+    'finished_at': fields.Float(required=False, description='End time (UNIX timestamp)'),
+    'error': fields.String(required=False, description='Error message, if the job failed'),
+    'duplicates': fields.Nested(duplicate_report_model, required=False, allow_null=True,
+                                description='Duplicate files, once the search is finished'),
+})
+
+positives_statistics_model = api.model('PositivesStatistics', {
+    'enabled': fields.Boolean(required=True, description='True if the colour negatives are converted'),
+    'queued': fields.Integer(required=False, description='Number of photos waiting for conversion, or being converted'),
+    'converted': fields.Integer(required=False, description='Number of photos converted'),
+    'failed': fields.Integer(required=False, description='Number of conversion errors'),
+    'skipped': fields.Integer(required=False, description='Number of photos skipped because the queue was full'),
+    'average_seconds': fields.Float(required=False, description='Average conversion time of a photo, in seconds'),
+    'last_seconds': fields.Float(required=False, description='Conversion time of the last photo, in seconds'),
+})
+
+storage_status_model = api.model('StorageStatus', {
+    'name': fields.String(required=True, description='Storage: temp, destination or archive'),
+    'path': fields.String(required=True, description='Path of the storage'),
+    'free_bytes': fields.Integer(required=False, description='Free space, in bytes, if the path is available'),
+})
+
+resources_status_model = api.model('ResourcesStatus', {
+    'enabled': fields.Boolean(required=True, description='True if the resources are watched'),
+    'state': fields.String(required=False, description='ok, slow: the scans slow down, or paused: the scans wait'),
+    'storages': fields.List(fields.Nested(storage_status_model), required=False, description='Free space of each storage'),
+    'backlog': fields.Raw(required=False, description='Number of files waiting, by stage: downloads and tags'),
+    'reasons': fields.List(fields.String, required=False, description='Limits reached'),
 })
 
 status_model = api.model('Status', {
@@ -61,16 +158,51 @@ session_id = api.model('Session', {
     'id': fields.Integer(required=True, description='Session ID'),
 })
 
+device_model = api.model('Device', {
+    'id': fields.String(required=True, description='Device ID'),
+    'camera_model': fields.String(required=False, description='Camera model, once connected'),
+    'sessions': fields.List(fields.Integer, required=True, description='Active sessions of the device'),
+})
+
 session_details = api.model('SessionDetails', {
     'id': fields.Integer(required=True, description='Session ID'),
+    'device': fields.String(required=False, description='Device of the session'),
     'is_scanning': fields.Boolean(required=True, description='True if a scan is on-going'),
+    'is_transferring': fields.Boolean(required=False, description='True if the files left on the camera are being downloaded'),
     'feature_skip_hole': fields.Boolean(required=True, description='True if the scanner supports skipping holes'),
+    'feature_rescan': fields.Boolean(required=False, description='True if the scanner can go back to the frames of the last roll'),
 })
 
 skip_holes_model = api.model('SkipHoles', {
     'number_of_holes': fields.Integer(required=True, description='Number of holes to skip'),
 })
 
+rescan_model = api.model('Rescan', {
+    'first': fields.Integer(required=True, description='Index of the first frame to scan again, starting at 0'),
+    'last': fields.Integer(required=True, description='Index of the last frame to scan again (included)'),
+})
+
+quality_scores_model = api.model('QualityScores', {
+    'focus': fields.Float(required=True, description='Variance of the Laplacian of the preview: the higher, the sharper'),
+    'clipped_ratio': fields.Float(required=True, description='Ratio of the clipped pixels'),
+    'crop_completeness': fields.Float(required=False, description='Aspect ratio of the photo compared to a full frame, 1.0 is complete'),
+    'failures': fields.List(fields.String, required=True, description='Failed checks: focus, exposure or crop'),
+})
+
+strip_frame_model = api.model('StripFrame', {
+    'index': fields.Integer(required=True, description='Index of the photo in the roll, starting at 0'),
+    'position': fields.Integer(required=False, description='Motor steps since the start of the roll'),
+    'frame': fields.String(required=False, description='Frame name'),
+    'crop': fields.List(fields.Float, required=False, description='Photo bounding box (x1, y1, x2, y2)'),
+    'quality': fields.Nested(quality_scores_model, required=False, allow_null=True, description='Quality of the preview, when the photo was taken'),
+})
+
+strip_map_model = api.model('StripMap', {
+    'session': fields.Integer(required=True, description='Session ID'),
+    'roll_id': fields.String(required=False, description='Metadata: roll identifier'),
+    'frames': fields.List(fields.Nested(strip_frame_model), required=True, description='Captured frames'),
+})
+
 error_model = api.model('Error', {
     'message': fields.String(required=True, description='Error message')
 })
@@ -92,6 +224,26 @@ film_model = api.model('Film', {
     'name': fields.String(required=True, description='Film name (without the brand)'),
 })
 
+camera_status_model = api.model('CameraStatus', {
+    'model': fields.String(required=False, description='Camera model'),
+    'errors': fields.Integer(required=True, description='Number of camera errors'),
+    'retries': fields.Integer(required=True, description='Number of operations retried'),
+    'reconnections': fields.Integer(required=True, description='Number of successful reconnections'),
+    'failures': fields.Integer(required=True, description='Number of operations which failed despite the retries'),
+    'last_error': fields.String(required=False, description='Last camera error'),
+})
+
+calibration_model = api.model('Calibration', {
+    'film_type': fields.String(required=False, description='Film type the settings are calibrated for'),
+    'iso': fields.String(required=False, description='ISO'),
+    'shutter_speed': fields.String(required=False, description='Shutter speed'),
+    'aperture': fields.String(required=False, description='Aperture'),
+    'exposure_compensation': fields.String(required=False, description='Exposure compensation'),
+    'level': fields.Float(required=False, description='Level of the film base (0-255) with these settings'),
+    'preview_count': fields.Integer(required=False, description='Number of previews used for the calibration'),
+    'duration': fields.Float(required=False, description='Calibration time in seconds'),
+})
+
 camera_setting_model = api.model('CameraSetting', {
     'value': fields.String(required=True, description='Camera setting value'),
     'active': fields.Boolean(required=False, description='True if it is the currently active setting'),
@@ -102,6 +254,8 @@ session_settings_model = api.model('SessionSettings', {
     'initial_frame': fields.String(required=False, description='Frame name of the first photo'),
     'max_number_of_files': fields.Integer(required=False, description='Maximum number of files to download per photo'),
     'delete_photo_after_download': fields.Boolean(required=False, description='Should photos be deleted from the camera after download'),
+    'transfer_mode': fields.String(required=False, enum=session.TRANSFER_MODES,
+                                   description='When files are downloaded: immediate, deferred (only JPEG files during the scan) or deferred_all (nothing during the scan)'),
     'metadata_lens_serial_number': fields.String(required=False, description='Metadata: lens serial number'),
     'metadata_roll_id': fields.String(required=False, description='Metadata: roll identifier'),
     'metadata_film_maker': fields.String(required=False, description='Metadata: film maker'),
@@ -119,14 +273,59 @@ session_settings_model = api.model('SessionSettings', {
     'metadata_filter': fields.String(required=False, description='Metadata: filter name'),
 })
 
+roll_job_model = api.model('RollJob', {
+    'id': fields.Integer(required=True, description='Job ID'),
+    'folder': fields.String(required=True, description='Output folder of the roll'),
+    'status': fields.String(required=True, description='Job status: pending, running, done or failed'),
+    'roll_id': fields.String(required=False, description='Metadata: roll identifier'),
+    'enqueued_at': fields.Float(required=False, description='Enqueue time (UNIX timestamp)'),
+    'started_at': fields.Float(required=False, description='Scan start time (UNIX timestamp)'),
+    'finished_at': fields.Float(required=False, description='Scan end time (UNIX timestamp)'),
+    'photo_count': fields.Integer(required=False, description='Number of photos taken'),
+    'error': fields.String(required=False, description='Error message, if the scan failed'),
+})
+
+roll_job_position_model = api.model('RollJobPosition', {
+    'position': fields.Integer(required=True, description='New position of the job in the queue, starting at 0'),
+})
+
+roll_queue_status_model = api.model('RollQueueStatus', {
+    'is_running': fields.Boolean(required=True, description='True if the queue is being processed'),
+    'pending': fields.Integer(required=True, description='Number of rolls waiting to be scanned'),
+    'done': fields.Integer(required=True, description='Number of rolls scanned'),
+    'failed': fields.Integer(required=True, description='Number of rolls which failed'),
+    'rolls_per_hour': fields.Float(required=True, description='Throughput of the finished rolls'),
+})
+
+file_change_model = api.model('FileChange', {
+    'sequence': fields.Integer(required=True, description='Sequence number of the file in the manifest'),
+    'name': fields.String(required=True, description='File path, relative to the share'),
+    'size': fields.Integer(required=True, description='File size in bytes'),
+    'sha256': fields.String(required=True, description='SHA-256 hash of the file content'),
+    'time': fields.Float(required=True, description='Time the file reached the share (UNIX timestamp)'),
+    'session': fields.Integer(required=False, description='Session ID'),
+    'frame': fields.Integer(required=False, description='Frame number'),
+    'roll_id': fields.String(required=False, description='Metadata: roll identifier'),
+})
+
+file_changes_model = api.model('FileChanges', {
+    'cursor': fields.Integer(required=True, description='Cursor to use as "since" for the next call'),
+    'files': fields.List(fields.Nested(file_change_model), required=True, description='New files'),
+})
+
 # Parsers
 new_session_parser = api.parser()
+new_session_parser.add_argument('device', type=str, default=scanner_device.DEFAULT_DEVICE,
+                                location='json', help='Device (camera and scanner) of the session')
 new_session_parser.add_argument(
     'initial_frame', type=str, location='json', help='Frame name of the first photo')
 new_session_parser.add_argument('max_number_of_files', type=int, default=1,
                                 location='json', help='Maximum number of files to download per photo')
 new_session_parser.add_argument('delete_photo_after_download', type=bool, default=False,
                                 location='json', help='Should photos be deleted from the camera after download?')
+new_session_parser.add_argument('transfer_mode', type=str, default=session.TRANSFER_IMMEDIATE,
+                                choices=session.TRANSFER_MODES, location='json',
+                                help='When files are downloaded: immediate, deferred (only JPEG files during the scan) or deferred_all (nothing during the scan)')
 
 new_session_parser.add_argument('metadata_lens_serial_number',
                                 type=str, location='json', help='Metadata: lens serial number')
@@ -159,6 +358,59 @@ new_session_parser.add_argument(
 new_session_parser.add_argument(
     'metadata_filter', type=str, location='json', help='Metadata: filter name')
 
+enqueue_roll_parser = new_session_parser.copy()
+enqueue_roll_parser.add_argument(
+    'folder', type=str, location='json', help='Output folder of the roll (default: roll identifier)')
+
+file_changes_parser = api.parser()
+file_changes_parser.add_argument(
+    'since', type=int, default=0, location='args', help='Cursor returned by the previous call')
+file_changes_parser.add_argument(
+    'limit', type=int, default=manifest.MAX_PAGE_SIZE, location='args', help='Maximum number of files to return')
+file_changes_parser.add_argument(
+    'wait', type=float, default=0.0, location='args', help='Seconds to wait for a new file if there is none (long polling)')
+
+file_list_parser = api.parser()
+file_list_parser.add_argument(
+    'after', type=str, location='args', help='Name of the last file of the previous page')
+file_list_parser.add_argument(
+    'limit', type=int, default=file_index.DEFAULT_PAGE_SIZE, location='args', help='Maximum number of files to return')
+file_list_parser.add_argument(
+    'session', type=int, location='args', help='Only the files of this session')
+file_list_parser.add_argument(
+    'roll_id', type=str, location='args', help='Only the files of this roll')
+file_list_parser.add_argument(
+    'tagged', type=inputs.boolean, location='args', help='Only the files with (or without) metadata')
+file_list_parser.add_argument(
+    'total', type=inputs.boolean, default=False, location='args', help='Count the files matching the filters')
+
+thumbnail_parser = api.parser()
+thumbnail_parser.add_argument(
+    'size', type=str, default=thumbnails.DEFAULT_SIZE, choices=list(thumbnails.SIZES.keys()),
+    location='args', help='Thumbnail size')
+
+archive_selection_parser = api.parser()
+archive_selection_parser.add_argument(
+    'session', type=int, location='args', help='Only the files of this session (default: all files)')
+archive_selection_parser.add_argument(
+    'roll_id', type=str, location='args', help='Only the files of this roll (default: all files)')
+
+reference_parser = api.parser()
+reference_parser.add_argument(
+    'q', type=str, location='args', help='Search text, such as the beginning of a name')
+reference_parser.add_argument(
+    'offset', type=inputs.natural, default=0, location='args', help='Number of items to skip')
+reference_parser.add_argument(
+    'limit', type=inputs.natural, location='args', help='Maximum number of items to return')
+
+calibration_parser = api.parser()
+calibration_parser.add_argument(
+    'film_type', type=str, location='json', help='Film type to store the calibration for')
+calibration_parser.add_argument(
+    'parameter', type=str, default=calibration.PARAMETER_SHUTTER_SPEED,
+    choices=[calibration.PARAMETER_SHUTTER_SPEED, calibration.PARAMETER_EXPOSURE_COMPENSATION],
+    location='json', help='Camera setting to adjust')
+
 camera_setting_parser = api.parser()
 camera_setting_parser.add_argument(
     'value', type=str, location='json', help='Value of the camera setting to set')
@@ -167,25 +419,109 @@ camera_setting_parser.add_argument(
 @ns.route('/archive/')
 class ArchiveResource(Resource):
     """Shows a list of all archived files, and lets you manage them"""
-    # @ns.doc('list_archive')
-    # @ns.marshal_list_with(file_details)
-    # def get(self):
-    #     """List all files"""
-    #     return DAO.todos
+    @ns.doc('list_archive')
+    @ns.expect(file_list_parser)
+    @ns.marshal_with(file_list_model, code=HTTPStatus.OK.value)
+    def get(self):
+        """List the archived files, page by page"""
+        return _list_files(file_index.LOCATION_ARCHIVE)
 
     @ns.doc('move_to_archive')
-    @ns.marshal_with(file_operation_result, code=HTTPStatus.CREATED.value)
+    @ns.expect(archive_selection_parser)
+    @ns.marshal_with(file_operation_result, code=HTTPStatus.ACCEPTED.value)
     def post(self):
-        """Move all photos to the archive"""
-        count = archive_storage.move_to_archive()
-        return {"count": count}, HTTPStatus.CREATED.value
+        """Move the photos to the archive, in the background"""
+        args = archive_selection_parser.parse_args()
+        job = archive_storage.move_to_archive(args.get('session'), args.get('roll_id'))
+        return {"count": job.total, "job_id": job.id}, HTTPStatus.ACCEPTED.value
 
     @ns.doc('delete_archive')
-    @ns.marshal_with(file_operation_result, code=HTTPStatus.OK.value)
+    @ns.expect(archive_selection_parser)
+    @ns.marshal_with(file_operation_result, code=HTTPStatus.ACCEPTED.value)
     def delete(self):
-        """Delete all photos from the archive"""
-        count = archive_storage.delete_archive()
-        return {"count": count}
+        """Delete the photos from the archive, in the background"""
+        args = archive_selection_parser.parse_args()
+        job = archive_storage.delete_archive(args.get('session'), args.get('roll_id'))
+        return {"count": job.total, "job_id": job.id}, HTTPStatus.ACCEPTED.value
+
+
+@ns.route('/share/')
+class ShareResource(Resource):
+    """Shows a list of the photos available on the share"""
+    @ns.doc('list_share')
+    @ns.expect(file_list_parser)
+    @ns.marshal_with(file_list_model, code=HTTPStatus.OK.value)
+    def get(self):
+        """List the photos of the share, page by page"""
+        return _list_files(file_index.LOCATION_SHARE)
+
+
+@ns.route('/thumbnail/<path:name>')
+@ns.response(404, 'File not found', error_model)
+@ns.param('name', 'File path, relative to the share')
+class ThumbnailResource(Resource):
+    @ns.doc('get_thumbnail')
+    @ns.expect(thumbnail_parser)
+    @ns.produces(['image/jpeg'])
+    def get(self, name):
+        """JPEG thumbnail of a photo of the share"""
+        args = thumbnail_parser.parse_args()
+        thumbnail = thumbnails.get_thumbnails().get(name, args['size'])
+        if thumbnail is None:
+            return {'message': f"File not found: {name}"}, HTTPStatus.NOT_FOUND.value
+
+        return send_file(thumbnail, mimetype='image/jpeg', max_age=THUMBNAIL_MAX_AGE, conditional=True)
+
+
+@ns.route('/archive/jobs/')
+class ArchiveJobListResource(Resource):
+    @ns.doc('list_archive_jobs')
+    @ns.marshal_list_with(archive_job_model, code=HTTPStatus.OK.value)
+    def get(self):
+        """List the recent archive jobs"""
+        return [j.to_dict() for j in archive_storage.list_jobs()]
+
+
+@ns.route('/archive/jobs/<int:job_id>/')
+@ns.response(404, 'Job not found', error_model)
+@ns.param('job_id', 'The archive job identifier')
+class ArchiveJobResource(Resource):
+    @ns.doc('get_archive_job')
+    @ns.marshal_with(archive_job_model, code=HTTPStatus.OK.value)
+    def get(self, job_id):
+        """Progress of an archive job"""
+        return archive_storage.get_job(job_id).to_dict()
+
+    @ns.doc('cancel_archive_job')
+    @ns.marshal_with(status_model, code=HTTPStatus.OK.value)
+    def delete(self, job_id):
+        """Cancel an archive job. The files already processed are not restored."""
+        archive_storage.cancel(job_id)
+        return {"success": True}
+
+
+@ns.route('/positives/')
+class PositivesResource(Resource):
+    @ns.doc('get_positives_statistics')
+    @ns.marshal_with(positives_statistics_model, code=HTTPStatus.OK.value)
+    def get(self):
+        """Queue depth and conversion time of the positive files of the colour negatives"""
+        converter = positives.get_positives()
+        if converter is None:
+            return {"enabled": False}
+        return dict(converter.statistics(), enabled=True)
+
+
+@ns.route('/resources/')
+class ResourcesResource(Resource):
+    @ns.doc('get_resources_status')
+    @ns.marshal_with(resources_status_model, code=HTTPStatus.OK.value)
+    def get(self):
+        """Free space of the storages and backlog of the files, which slow down or pause the scans"""
+        governor = resources.get_resources()
+        if governor is None:
+            return {"enabled": False}
+        return dict(governor.refresh().to_dict(), enabled=True)
 
 
 @ns.route('/camera/reset/')
@@ -203,6 +539,73 @@ class CameraResetResource(Resource):
         return {"success": True}
 
 
+@ns.route('/camera/status/')
+class CameraStatusResource(Resource):
+    @ns.doc('get_camera_status')
+    @ns.marshal_with(camera_status_model, code=HTTPStatus.OK.value)
+    def get(self):
+        """
+        Health of the camera connection
+        """
+        return dict(model=capture_camera.model, **capture_camera.statistics())
+
+
+@ns.route('/camera/calibration/')
+class CameraCalibrationListResource(Resource):
+    @ns.doc('list_calibrations')
+    @ns.marshal_list_with(calibration_model, code=HTTPStatus.OK.value)
+    def get(self):
+        """
+        List the calibrated settings, per film type
+        """
+        return [dict(film_type=film_type, **values.to_dict())
+                for film_type, values in settings.get_settings().calibration_by_film_type.items()]
+
+    @ns.doc('calibrate_camera')
+    @ns.expect(calibration_parser)
+    @ns.response(409, 'Scan in progress', error_model)
+    @ns.response(500, 'Camera error', error_model)
+    @ns.marshal_with(calibration_model, code=HTTPStatus.OK.value)
+    def post(self):
+        """
+        Calibrate the exposure on the backlit film base, and apply it
+
+        :raises camera.CameraException: In case of error when connecting to the camera
+        """
+        args = calibration_parser.parse_args(strict=True)
+        _ensure_not_scanning()
+
+        result = calibration.calibrate(capture_camera, args['parameter'])
+        values = settings.CameraSettings(iso=result.iso, shutter_speed=result.shutter_speed,
+                                         aperture=result.aperture, exposure_compensation=result.exposure_compensation)
+        _apply_camera_settings(values, args.get('film_type'))
+        return dict(film_type=args.get('film_type'), **result.to_dict())
+
+
+@ns.route('/camera/calibration/<string:film_type>/')
+@ns.response(404, 'No calibration for the film type', error_model)
+@ns.param('film_type', 'Film type')
+class CameraCalibrationResource(Resource):
+    @ns.doc('apply_calibration')
+    @ns.response(409, 'Scan in progress', error_model)
+    @ns.response(500, 'Camera error', error_model)
+    @ns.marshal_with(calibration_model, code=HTTPStatus.OK.value)
+    def post(self, film_type):
+        """
+        Apply the settings calibrated for the film type
+
+        :raises camera.CameraException: In case of error when connecting to the camera
+        :raises calibration.CalibrationDoesNotExist: If the film type was never calibrated
+        """
+        values = settings.get_settings().calibration_by_film_type.get(film_type)
+        if values is None:
+            raise calibration.CalibrationDoesNotExist(f"No calibration for {film_type}")
+        _ensure_not_scanning()
+
+        _apply_camera_settings(values, None)
+        return dict(film_type=film_type, **values.to_dict())
+
+
 @ns.route('/camera/iso/')
 class CameraIsoResource(Resource):
     @ns.doc('list_iso')
@@ -212,7 +615,7 @@ class CameraIsoResource(Resource):
         List of accepted values for the ISO camera setting
         """
         current_iso = capture_camera.iso
-        last_used_iso = settings.get_settings().last_camera_settings.iso
+        last_used_iso = settings.get_settings().last_camera_settings_for(capture_camera.model).iso
         return [
             {
                 'value': v,
@@ -237,6 +640,7 @@ class CameraIsoResource(Resource):
         capture_camera.iso = new_value
         with settings.SettingsSaver() as s:
             s.last_camera_settings.iso = new_value
+            s.camera_settings(capture_camera.model).iso = new_value
         return {"success": True}
 
 
@@ -249,7 +653,7 @@ class CameraShutterSpeedResource(Resource):
         List of accepted values for the shutter speed camera setting
         """
         current_shutter_speed = capture_camera.shutter_speed
-        last_used_shutter_speed = settings.get_settings().last_camera_settings.shutter_speed
+        last_used_shutter_speed = settings.get_settings().last_camera_settings_for(capture_camera.model).shutter_speed
         return [
             {
                 'value': v,
@@ -274,6 +678,7 @@ class CameraShutterSpeedResource(Resource):
         capture_camera.shutter_speed = new_value
         with settings.SettingsSaver() as s:
             s.last_camera_settings.shutter_speed = new_value
+            s.camera_settings(capture_camera.model).shutter_speed = new_value
         return {"success": True}
 
 
@@ -286,7 +691,7 @@ class CameraApertureResource(Resource):
         List of accepted values for the aperture camera setting
         """
         current_aperture = capture_camera.aperture
-        last_used_aperture = settings.get_settings().last_camera_settings.aperture
+        last_used_aperture = settings.get_settings().last_camera_settings_for(capture_camera.model).aperture
         return [
             {
                 'value': v,
@@ -311,6 +716,7 @@ class CameraApertureResource(Resource):
         capture_camera.aperture = new_value
         with settings.SettingsSaver() as s:
             s.last_camera_settings.aperture = new_value
+            s.camera_settings(capture_camera.model).aperture = new_value
         return {"success": True}
 
 
@@ -324,7 +730,7 @@ class CameraExposureCompensationResource(Resource):
         """
         current_exposure_compensation = capture_camera.exposure_compensation
         last_used_exposure_compensation = settings.get_settings(
-        ).last_camera_settings.exposure_compensation
+        ).last_camera_settings_for(capture_camera.model).exposure_compensation
         return [
             {
                 'value': v,
@@ -349,6 +755,7 @@ class CameraExposureCompensationResource(Resource):
         capture_camera.exposure_compensation = new_value
         with settings.SettingsSaver() as s:
             s.last_camera_settings.exposure_compensation = new_value
+            s.camera_settings(capture_camera.model).exposure_compensation = new_value
         return {"success": True}
 
 
@@ -375,32 +782,33 @@ class SessionListResource(Resource):
 
         # Parse webservice arguments
         args = new_session_parser.parse_args(strict=True)
-
-        initial_frame = frame_counter.from_string(args.get('initial_frame'))
-        metadata = {k[len(METADATA_PREFIX):]: v for k,
-                    v in args.items() if k.startswith(METADATA_PREFIX)}
-        log.info("Found metadata: %s", metadata)
-
-        # Build settings from it
-        session_settings = SessionSettings(
-            initial_frame=initial_frame,
-            max_number_of_files=args.get('max_number_of_files', 1),
-            delete_photo_after_download=args.get(
-                'delete_photo_after_download', False),
-            metadata=MetaData(exposure_number=None, **metadata)
-        )
+        session_settings = _build_session_settings(args)
 
         # Save as last used settings
         with settings.SettingsSaver() as s:
             s.last_session_settings = session_settings
 
         # Create a new session
+        device = devices.get_devices().get(args.get('device'))
         the_session = session.get_or_new_session(
-            capture_camera, the_scanner, archive_storage.photos_path,
-            session_settings, post_message, exif_tag_func)
+            device.camera, device.scanner, archive_storage.photos_path,
+            session_settings, post_message, device.exif_tagger, device.id)
         return _get_session_details(the_session), HTTPStatus.CREATED.value
 
 
+@ns.route('/devices/')
+class DeviceListResource(Resource):
+    @ns.doc('list_devices')
+    @ns.marshal_list_with(device_model, code=HTTPStatus.OK.value)
+    def get(self):
+        """List the devices (camera and scanner) driven by this service"""
+        return [{
+            "id": d.id,
+            "camera_model": d.camera.model,
+            "sessions": session.list_session_ids(d.id),
+        } for d in devices.get_devices().list_devices()]
+
+
 @ns.route('/session/last_used_settings/')
 class SessionLastUsedSettingsResource(Resource):
     @ns.doc('get_last_used_settings')
@@ -422,6 +830,7 @@ class SessionLastUsedSettingsResource(Resource):
         # Then the session settings
         output['delete_photo_after_download'] = last_used_settings.delete_photo_after_download
         output['max_number_of_files'] = last_used_settings.max_number_of_files
+        output['transfer_mode'] = last_used_settings.transfer_mode
         # We are forced to do this manually as there's a bug with customer encodes in dataclasses-json
         output['initial_frame'] = str(last_used_settings.initial_frame)
 
@@ -481,49 +890,227 @@ class SessionResource(Resource):
         return {"success": True}
 
 
+@ns.route('/session/<int:session_id>/rescan/')
+@ns.response(400, "The scanner can't go back to a frame", error_model)
+@ns.response(404, 'Session or frames not found', error_model)
+@ns.response(409, 'Scan in progress', error_model)
+class SessionRescanResource(Resource):
+    @ns.doc('rescan_frames')
+    @ns.expect(rescan_model, validate=True)
+    @ns.marshal_with(status_model, code=HTTPStatus.ACCEPTED.value)
+    def post(self, session_id: int):
+        """
+        Scan again some frames of the last roll, without scanning the whole roll
+
+        :raises SessionDoesNotExist: Session not found
+        :raises StripMapDoesNotExist: No roll scanned, or frames not found
+        :raises SessionIsBusy: Session is scanning
+        :raises FrameSeekingNotSupported: The scanner can't go back to a frame
+        """
+        the_session = session.get_session(session_id)
+        the_session.rescan_async(api.payload['first'], api.payload['last'])
+        return {"success": True}, HTTPStatus.ACCEPTED.value
+
+
+@ns.route('/strip_map/<int:session_id>/')
+@ns.response(404, 'Strip map not found', error_model)
+class StripMapResource(Resource):
+    @ns.doc('get_strip_map')
+    @ns.marshal_with(strip_map_model, code=HTTPStatus.OK.value)
+    def get(self, session_id: int):
+        """
+        Position of each frame scanned during the session
+
+        :raises StripMapDoesNotExist: Strip map not found
+        """
+        the_strip_map = strip_map.get_strip_maps().load(session_id)
+        return {
+            "session": the_strip_map.session,
+            "roll_id": the_strip_map.roll_id,
+            "frames": [f.to_dict() for f in the_strip_map.frames],
+        }
+
+
+@ns.route('/queue/')
+class RollQueueResource(Resource):
+    @ns.doc('list_roll_jobs')
+    @ns.marshal_list_with(roll_job_model, code=HTTPStatus.OK.value)
+    def get(self):
+        """List all rolls of the queue, in scanning order"""
+        return [_get_roll_job_details(j) for j in the_roll_queue.list_jobs()]
+
+    @ns.doc('enqueue_roll')
+    @ns.expect(enqueue_roll_parser)
+    @ns.marshal_with(roll_job_model, code=HTTPStatus.CREATED.value)
+    def post(self):
+        """Add a roll to scan at the end of the queue"""
+        args = enqueue_roll_parser.parse_args(strict=True)
+        job = the_roll_queue.enqueue(_build_session_settings(args), args.get('folder'))
+        return _get_roll_job_details(job), HTTPStatus.CREATED.value
+
+
+@ns.route('/queue/<int:job_id>/')
+@ns.response(404, 'Job not found', error_model)
+@ns.response(409, 'Job is running', error_model)
+class RollJobResource(Resource):
+    @ns.doc('roll_job_details')
+    @ns.marshal_with(roll_job_model, code=HTTPStatus.OK.value)
+    def get(self, job_id: int):
+        """
+        Get the details of a roll of the queue
+
+        :raises JobDoesNotExist: Job not found
+        """
+        return _get_roll_job_details(the_roll_queue.get_job(job_id))
+
+    @ns.doc('move_roll_job')
+    @ns.expect(roll_job_position_model, validate=True)
+    @ns.marshal_with(status_model, code=HTTPStatus.OK.value)
+    def put(self, job_id: int):
+        """
+        Move a roll in the queue
+
+        :raises JobDoesNotExist: Job not found
+        """
+        the_roll_queue.move(job_id, api.payload['position'])
+        return {"success": True}
+
+    @ns.doc('remove_roll_job')
+    @ns.marshal_with(status_model, code=HTTPStatus.OK.value)
+    def delete(self, job_id: int):
+        """
+        Remove a roll from the queue
+
+        :raises JobDoesNotExist: Job not found
+        :raises JobIsRunning: Job is being scanned
+        """
+        the_roll_queue.remove(job_id)
+        return {"success": True}
+
+
+@ns.route('/queue/status/')
+class RollQueueStatusResource(Resource):
+    @ns.doc('roll_queue_status')
+    @ns.marshal_with(roll_queue_status_model, code=HTTPStatus.OK.value)
+    def get(self):
+        """Get the progress and throughput of the queue"""
+        return the_roll_queue.statistics()
+
+    @ns.doc('start_roll_queue')
+    @ns.marshal_with(status_model, code=HTTPStatus.ACCEPTED.value)
+    def post(self):
+        """Start scanning the rolls of the queue, one after the other"""
+        the_roll_queue.start(_scan_queued_roll)
+        return {"success": True}, HTTPStatus.ACCEPTED.value
+
+    @ns.doc('stop_roll_queue')
+    @ns.marshal_with(status_model, code=HTTPStatus.OK.value)
+    def delete(self):
+        """Stop processing the queue once the current roll is scanned"""
+        the_roll_queue.stop()
+        return {"success": True}
+
+
+@ns.route('/files/changes/')
+class FileChangesResource(Resource):
+    @ns.doc('list_file_changes')
+    @ns.expect(file_changes_parser)
+    @ns.marshal_with(file_changes_model, code=HTTPStatus.OK.value)
+    def get(self):
+        """
+        List the files which reached the share since the given cursor
+        """
+        args = file_changes_parser.parse_args()
+        wait = max(0.0, min(args['wait'], MAX_LONG_POLLING_WAIT))
+        files, cursor = manifest.get_manifest().changes(args['since'], args['limit'], wait)
+        return {"cursor": cursor, "files": [f.to_dict() for f in files]}
+
+
+@ns.route('/files/duplicates/')
+class FileDuplicatesResource(Resource):
+    @ns.doc('find_file_duplicates')
+    @ns.marshal_with(archive_job_model, code=HTTPStatus.ACCEPTED.value)
+    def post(self):
+        """
+        Find the identical files of the share and the archive, in the background.
+        The duplicates are in the archive job, once finished.
+        """
+        return archive_storage.find_duplicates().to_dict(), HTTPStatus.ACCEPTED.value
+
+
+@ns.route('/files/duplicates/links/')
+class FileDuplicateLinksResource(Resource):
+    @ns.doc('link_file_duplicates')
+    @ns.marshal_with(archive_job_model, code=HTTPStatus.ACCEPTED.value)
+    def post(self):
+        """
+        Replace the identical files by hard links to a single copy, when they are on the same file system, in the background.
+        The files already replaced stay hard links if the archive job is cancelled.
+        """
+        return archive_storage.link_duplicates().to_dict(), HTTPStatus.ACCEPTED.value
+
+
 # Reference data
 @ns.route('/reference/film_type/')
 class FilmTypeListResource(Resource):
     @ns.doc('list_film_type')
-    @ns.marshal_list_with(film_type_model, code=HTTPStatus.OK.value)
+    @ns.expect(reference_parser)
+    @ns.response(HTTPStatus.OK.value, 'Success', [film_type_model])
     def get(self):
         """
         List all film types
         """
-        return [{'type': t} for t in film_type.get_film_types()]
+        return _reference_response(reference_data.FILM_TYPES, REFERENCE_MAX_AGE)
 
 
 @ns.route('/reference/frame_count/')
 class FrameCountListResource(Resource):
     @ns.doc('list_frame_count')
-    @ns.marshal_list_with(frame_count_model, code=HTTPStatus.OK.value)
+    @ns.expect(reference_parser)
+    @ns.response(HTTPStatus.OK.value, 'Success', [frame_count_model])
     def get(self):
         """
         List frame counts
         """
-        return [{'frame': f} for f in frame_counter.list_typical_frames()]
+        return _reference_response(reference_data.FRAME_COUNTS, REFERENCE_MAX_AGE)
 
 
 @ns.route('/reference/develop_process/')
 class DevelopProcessListResource(Resource):
     @ns.doc('list_develop_process')
-    @ns.marshal_list_with(develop_process_model, code=HTTPStatus.OK.value)
+    @ns.expect(reference_parser)
+    @ns.response(HTTPStatus.OK.value, 'Success', [develop_process_model])
     def get(self):
         """
         List development processes
         """
-        return [{'process': p} for p in develop_process.get_develop_processes()]
+        return _reference_response(reference_data.DEVELOP_PROCESSES, REFERENCE_MAX_AGE)
 
 
 @ns.route('/reference/film/')
 class FilmListResource(Resource):
     @ns.doc('list_film')
-    @ns.marshal_list_with(film_model, code=HTTPStatus.OK.value)
+    @ns.expect(reference_parser)
+    @ns.response(HTTPStatus.OK.value, 'Success', [film_model])
     def get(self):
         """
         List films
         """
-        return [{'make': m, 'name': n} for m, n in films.get_all_films()]
+        # Users can add films: always revalidate
+        return _reference_response(reference_data.FILMS, 0)
+
+    @ns.doc('add_film')
+    @ns.expect(film_model, validate=True)
+    @ns.response(409, 'Film already exists', error_model)
+    @ns.marshal_with(status_model, code=HTTPStatus.CREATED.value)
+    def post(self):
+        """
+        Add a film to the list
+
+        :raises FilmAlreadyExists: Film already in the list
+        """
+        reference_data.add_film(api.payload['make'], api.payload['name'])
+        return {"success": True}, HTTPStatus.CREATED.value
 
 
 # Static content / homepage
@@ -540,8 +1127,12 @@ def healthcheck():
 
 # Websocket
 @socketio.on('connect', namespace=SOCKET_IO_NAMESPACE)
-def scanner_events_connect():
-    log.info('Client connected')
+def scanner_events_connect(auth=None):
+    # Reconnecting clients give the last event they received, to catch up
+    last_sequence = auth.get('last_sequence') if isinstance(auth, dict) else None
+    log.info('Client connected: %s, last event: %s', request.sid, last_sequence)
+    message_bus.register(request.sid, last_sequence)
+
     with thread_lock:
         global thread
         if thread is None:
@@ -550,7 +1141,8 @@ def scanner_events_connect():
 
 @socketio.on('disconnect', namespace=SOCKET_IO_NAMESPACE)
 def scanner_events_disconnect():
-    log.info('Client disconnected')
+    log.info('Client disconnected: %s', request.sid)
+    message_bus.unregister(request.sid)
 
 
 @ns.errorhandler(camera.CameraException)
@@ -573,6 +1165,106 @@ def handle_session_not_found(error):
     return {'message': error.message}, 404
 
 
+@ns.errorhandler(strip_map.StripMapDoesNotExist)
+@ns.marshal_with(error_model, code=404)
+def handle_strip_map_not_found(error):
+    """
+    Strip map error
+    """
+    log.error("Strip map not found: %s", error)
+    return {'message': error.message}, 404
+
+
+@ns.errorhandler(devices.DeviceDoesNotExist)
+@ns.marshal_with(error_model, code=404)
+def handle_device_not_found(error):
+    """
+    Device error
+    """
+    log.error("Device not found: %s", error)
+    return {'message': error.message}, 404
+
+
+@ns.errorhandler(roll_queue.JobDoesNotExist)
+@ns.marshal_with(error_model, code=404)
+def handle_job_not_found(error):
+    """
+    Roll queue error
+    """
+    log.error("Job not found: %s", error)
+    return {'message': error.message}, 404
+
+
+@ns.errorhandler(roll_queue.JobIsRunning)
+@ns.marshal_with(error_model, code=409)
+def handle_job_running(error):
+    """
+    Roll queue error
+    """
+    log.error("Job is running: %s", error)
+    return {'message': error.message}, 409
+
+
+@ns.errorhandler(archive.ArchiveJobDoesNotExist)
+@ns.marshal_with(error_model, code=404)
+def handle_archive_job_not_found(error):
+    """
+    Archive error
+    """
+    log.error("Archive job not found: %s", error)
+    return {'message': error.message}, 404
+
+
+@ns.errorhandler(calibration.CalibrationError)
+@ns.marshal_with(error_model, code=400)
+def handle_calibration_error(error):
+    """
+    Calibration error
+    """
+    log.error("Calibration error: %s", error)
+    return {'message': error.message}, 400
+
+
+@ns.errorhandler(calibration.CalibrationDoesNotExist)
+@ns.marshal_with(error_model, code=404)
+def handle_calibration_not_found(error):
+    """
+    Calibration error
+    """
+    log.error("Calibration not found: %s", error)
+    return {'message': error.message}, 404
+
+
+@ns.errorhandler(reference_data.FilmAlreadyExists)
+@ns.marshal_with(error_model, code=409)
+def handle_film_already_exists(error):
+    """
+    Reference data error
+    """
+    log.error("Film already exists: %s", error)
+    return {'message': error.message}, 409
+
+
+@ns.errorhandler(FrameSeekingNotSupported)
+@ns.marshal_with(error_model, code=400)
+def handle_frame_seeking_not_supported(error):
+    """
+    Session error
+    """
+    log.error("Frame seeking not supported: %s", error)
+    return {'message': error.message}, 400
+
+
+@ns.errorhandler(SessionIsBusy)
+@ns.marshal_with(error_model, code=409)
+def handle_session_busy(error):
+    """
+    Session error
+    """
+    log.error("Session is busy: %s", error)
+    return {'message': error.message}, 409
+
+
 @ns.errorhandler(Exception)
 @ns.marshal_with(error_model, code=500)
 def default_error_handler(error):
@@ -583,13 +1275,20 @@ def default_error_handler(error):
 
 def message_broadcast():
     while True:
-        subject, payload = message_queue.get()
-        socketio.emit(subject, payload, namespace=SOCKET_IO_NAMESPACE)
+        if not message_bus.wait(BROADCAST_WAIT):
+            continue
+
+        # Each client has its own position in the events, so a slow one doesn't delay the others
+        for client_id in message_bus.client_ids:
+            for sequence, subject, payload in message_bus.take(client_id):
+                if isinstance(payload, dict):
+                    payload = {**payload, "sequence": sequence}
+                socketio.emit(subject, payload, namespace=SOCKET_IO_NAMESPACE, room=client_id)
 
 
 def post_message(subject: str, payload: Any):
-    if thread is not None:
-        message_queue.put((subject, payload))
+    # Never blocks: the events are kept for clients connecting later
+    message_bus.publish(subject, payload)
 
 
 def _ensure_path(pth: str) -> pathlib.Path:
@@ -601,40 +1300,205 @@ def _ensure_path(pth: str) -> pathlib.Path:
 def _get_session_details(the_session: Session):
     return {
         "id": the_session.id,
+        "device": the_session.device_id,
         "is_scanning": the_session.is_scanning,
+        "is_transferring": the_session.is_transferring,
         "feature_skip_hole": the_session.support_hole_skipping,
+        "feature_rescan": the_session.support_frame_seeking,
     }
 
 
+def _get_roll_job_details(job: roll_queue.RollJob):
+    return {
+        "id": job.id,
+        "folder": job.folder,
+        "status": job.status,
+        "roll_id": job.roll_id,
+        "enqueued_at": job.enqueued_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+        "photo_count": job.photo_count,
+        "error": job.error,
+    }
+
+
+def _reference_response(index: reference_data.ReferenceIndex, max_age: int):
+    args = reference_parser.parse_args()
+    result = index.response(args.get('q'), args['offset'], args.get('limit'))
+
+    # Precomputed response, the browser only revalidates it with the ETag
+    response = app.response_class(result.body, mimetype='application/json')
+    response.set_etag(result.etag)
+    response.headers['X-Total-Count'] = str(result.total_count)
+    if max_age > 0:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def _ensure_not_scanning() -> None:
+    # The camera settings are the ones of the default device
+    for sid in session.list_session_ids(scanner_device.DEFAULT_DEVICE):
+        the_session = session.get_session(sid)
+        if the_session.is_scanning or the_session.is_transferring:
+            raise SessionIsBusy(f"Session is scanning: {sid}")
+
+
+def _apply_camera_settings(values: settings.CameraSettings, film_type: Optional[str]) -> None:
+    # All the settings in one batch
+    capture_camera.apply_settings(iso=values.iso, shutter_speed=values.shutter_speed,
+                                  aperture=values.aperture, exposure_compensation=values.exposure_compensation)
+
+    with settings.SettingsSaver() as s:
+        s.last_camera_settings = dataclasses.replace(values)
+        if capture_camera.model:
+            s.camera_settings_by_model[capture_camera.model] = dataclasses.replace(values)
+        if film_type:
+            s.calibration_by_film_type[film_type] = dataclasses.replace(values)
+
+
+def _list_files(location: str):
+    args = file_list_parser.parse_args()
+    files, total = file_index.get_file_index().list_files(
+        location, after=args.get('after'), limit=args['limit'],
+        session=args.get('session'), roll_id=args.get('roll_id'), tagged=args.get('tagged'),
+        with_total=args['total'])
+
+    # A full page means that there might be a next one
+    is_full_page = len(files) >= max(1, min(args['limit'], file_index.MAX_PAGE_SIZE))
+    return {
+        "total": total,
+        "next": files[-1].name if is_full_page else None,
+        "files": [f.to_dict() for f in files],
+    }
+
+
+def _build_session_settings(args) -> SessionSettings:
+    initial_frame = frame_counter.from_string(args.get('initial_frame'))
+    metadata = {k[len(METADATA_PREFIX):]: v for k,
+                v in args.items() if k.startswith(METADATA_PREFIX)}
+    log.info("Found metadata: %s", metadata)
+
+    # Build settings from it
+    return SessionSettings(
+        initial_frame=initial_frame,
+        max_number_of_files=args.get('max_number_of_files', 1),
+        delete_photo_after_download=args.get(
+            'delete_photo_after_download', False),
+        transfer_mode=args.get('transfer_mode') or session.TRANSFER_IMMEDIATE,
+        metadata=MetaData(exposure_number=None, **metadata)
+    )
+
+
+def _scan_queued_roll(job: roll_queue.RollJob) -> int:
+    destination = _ensure_path(str(archive_storage.photos_path / job.folder))
+    the_session = session.new_session(
+        capture_camera, the_scanner, destination,
+        job.settings, post_message, exif_tag_func)
+    return the_session.scan()
+
+
+def _resume_after_crash(recovery: journal.RecoveryState) -> None:
+    session.resume_pending_files(recovery.pending_files, exif_tag_func)
+
+    # Files left on the camera cards by a deferred transfer
+    for device_id in sorted({f.device for f in recovery.deferred_files}):
+        try:
+            device = devices.get_devices().get(device_id)
+            session.resume_deferred_files(
+                device.camera, [f for f in recovery.deferred_files if f.device == device_id], device.exif_tagger)
+        except devices.DeviceDoesNotExist as e:
+            log.error("Unable to transfer the files left on the camera: %s", e.message)
+        except camera.CameraException as e:
+            log.error("Unable to transfer the files left on the camera of %s: %s", device_id, e.message)
+
+    if recovery.session_settings is not None:
+        # Next session will continue the interrupted roll
+        interrupted_settings = SessionSettings.from_dict(recovery.session_settings)
+        if recovery.next_frame is not None:
+            interrupted_settings = dataclasses.replace(
+                interrupted_settings, initial_frame=recovery.next_frame)
+        log.info("Resuming interrupted session with settings: %s", interrupted_settings)
+        with settings.SettingsSaver() as s:
+            s.last_session_settings = interrupted_settings
+        journal.record(journal.EVENT_SESSION_END, session=recovery.session_id)
+
+
 def main() -> None:
     args = utils.parse_arguments()
 
-    # Logging
+    # Logging: out of the way of the scan loops
     level = logging.DEBUG if args.verbose else logging.INFO
-    logging.basicConfig(
-        stream=sys.stdout,
-        level=level,
-        format="[%(asctime)s] %(levelname)s:%(name)s:%(message)s")
+    log_pipeline.init_logging(level, sys.stdout, rate=args.log_rate)
+    trace.init_trace(args.trace, args.trace_size * 1024 * 1024)
 
     # Storage
     archive_storage.photos_path = _ensure_path(args.destination)
     archive_storage.archive_path = _ensure_path(args.archive)
+    archive_storage.active_folders = session.active_destinations
     temporary_path = _ensure_path(args.temp)
 
     # Initialise recently used settings
     settings.init_settings(args.settings)
-
-    global capture_camera
-    capture_camera = camera.get_camera_type(args.dryrun)(temporary_path)
-
-    global the_scanner
-    # the_scanner = scanner.Scanner(
-    #     args.led, args.infrared, args.backlight, args.pin1, args.pin2, args.pin3, args.pin4)
-    the_scanner = detector_scanner.DetectorScanner(
-        capture_camera, args.backlight, args.pin1, args.pin2, args.pin3, args.pin4, args.use_edge_tpu)
-
-    global exif_tag_func
-    exif_tag_func = exif_tagger.async_tagger()
+    films.init_user_films(args.user_films)
+
+    # Change feed of the share
+    manifest.init_manifest(args.manifest, archive_storage.photos_path,
+                           lambda entry: post_message("file_ready", entry.to_dict()))
+    file_index.init_file_index(args.file_index, archive_storage.photos_path, archive_storage.archive_path)
+    archive_storage.start(post_message)
+    strip_map.init_strip_maps(args.strip_maps)
+    thumbnails.init_thumbnails(_ensure_path(args.thumbnails), archive_storage.photos_path,
+                               args.thumbnails_size * 1024 * 1024)
+    if args.positives:
+        positives.init_positives(args.positives_workers, args.positives_queue)
+
+    model_variant = model_benchmark.resolve_variant(
+        args.model_variant, args.use_edge_tpu, args.model_previews, args.model_min_accuracy)
+    log.info("Using model variant: %s", model_variant.name)
+    # Shared by all the devices
+    shared_detector = object_detection.SharedDetector(
+        str(model_registry.get_model_file(model_variant)), str(model_registry.get_labels_file()),
+        use_edge_tpu=model_variant.edge_tpu, size=args.inference_workers)
+    detector: object_detection.Detector = shared_detector
+    if args.remote_inference:
+        detector = remote_inference.RemoteDetector(remote_inference.parse_address(args.remote_inference), shared_detector)
+        log.info("Using remote inference: %s", args.remote_inference)
+
+    device_configurations = [devices.DeviceConfiguration(
+        scanner_device.DEFAULT_DEVICE, args.backlight, args.pin1, args.pin2, args.pin3, args.pin4,
+        scanner=args.scanner, led=args.led, led_use_infrared=args.infrared,
+        lux_gain=args.lux_gain, lux_integration_time=args.lux_integration_time)]
+    if args.devices:
+        device_configurations += devices.load_configurations(args.devices)
+    for configuration in device_configurations:
+        devices.get_devices().add(
+            devices.create_device(configuration, temporary_path, detector, args.dryrun))
+
+    # Default device, used by the camera settings and the roll queue
+    default_device = devices.get_devices().get(scanner_device.DEFAULT_DEVICE)
+    global capture_camera, the_scanner, exif_tag_func
+    capture_camera = default_device.camera
+    the_scanner = default_device.scanner
+    exif_tag_func = default_device.exif_tagger
+
+    # Scans slow down, then pause, before the storage or the tagging queues overflow
+    governor = resources.init_resources(
+        {"temp": temporary_path, "destination": archive_storage.photos_path, "archive": archive_storage.archive_path},
+        args.min_free_space * 1024 * 1024, args.max_backlog,
+        lambda status: post_message("resources", status.to_dict()))
+    governor.add_backlog_source(
+        "downloads", lambda: sum(d.camera.pending_files for d in devices.get_devices().list_devices()))
+    governor.add_backlog_source("tags", exif_tagger.pending_files)
+
+    # Finish what was interrupted by a crash
+    recovery = journal.init_journal(args.journal)
+    _resume_after_crash(recovery)
+
+    global the_roll_queue
+    the_roll_queue = roll_queue.RollQueue(pathlib.Path(args.queue), post_message)
 
     # See: https://github.com/noirbizarre/flask-restplus/issues/693
     if args.verbose: